@@ -0,0 +1,53 @@
+"""Compare the upload strategies of the Google Cloud Storage backend.
+
+Uploads files of several sizes with a single request, resumable uploads and
+parallel composite uploads, and prints the throughput of each. Run it against a
+local emulator (e.g. fake-gcs-server) or a test project:
+
+    STORAGE_EMULATOR_HOST=http://localhost:4443 python scripts/bench_gcs_upload.py
+"""
+import io
+import os
+import time
+import uuid
+
+from kinto_attachment.storage.gcloud import GoogleCloudStorage
+
+
+MB = 1024 * 1024
+
+BANDS = [
+    ('single request, 4 MB', 4 * MB, {}),
+    ('resumable (100 MB chunks), 64 MB', 64 * MB, {'chunk_size': 100 * MB}),
+    ('resumable (8 MB chunks), 64 MB', 64 * MB, {'chunk_size': 8 * MB}),
+    ('composite (8 x 32 MB), 256 MB', 256 * MB, {'composite_threshold': 1}),
+    ('resumable (8 MB chunks), 256 MB', 256 * MB, {}),
+]
+
+
+def measure(bucket_name, size, **kwargs):
+    storage = GoogleCloudStorage(
+        credentials=None,
+        project='test',
+        bucket_name=bucket_name,
+        auto_create_bucket=True,
+        uniform_bucket_level_access=True,
+        **kwargs,
+    )
+    content = io.BytesIO(os.urandom(size))
+    start = time.monotonic()
+    name = storage.save_file(content, 'file.bin', replace=True)
+    elapsed = time.monotonic() - start
+    assert storage.get_bucket().get_blob(name).size == size
+    storage.delete(name)
+    return size / MB / elapsed
+
+
+def main():
+    bucket_name = 'throughput-' + uuid.uuid4().hex[:8]
+    for label, size, kwargs in BANDS:
+        print('%-40s %8.1f MB/s' % (label, measure(bucket_name, size, **kwargs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Measure the per-request cost of resolving the attachment settings.
+
+Compares the lookups done on every upload before policies were precompiled
+(formatting resource URIs, probing the per-resource settings, parsing the
+extensions and mimetypes strings) with the precompiled policy lookup.
+
+    python scripts/bench_policy.py
+"""
+import timeit
+from types import SimpleNamespace
+
+from kinto_attachment.utils import (
+    DEFAULT_MIMETYPES,
+    compile_policies,
+    get_policy,
+    resolve_extensions,
+)
+
+
+SETTINGS = {
+    'attachment.folder': '{bucket_id}/{collection_id}',
+    'attachment.extensions': 'default+video',
+    'attachment.mimetypes': '.ftl:application/vnd.fluent;.db:application/vnd.sqlite3',
+    'attachment.max_size_bytes': '10485760',
+}
+RESOURCES = {
+    '/buckets/main/collections/%d' % i: {'keep_old_files': True} for i in range(100)
+}
+RESOURCES['/buckets/main'] = {'randomize': False}
+
+
+def setting_value(request, name, default):
+    # Per-request resolution, as done before policies.
+    value = request.registry.settings.get('attachment.{}'.format(name), default)
+    if 'bucket_id' in request.matchdict:
+        uri = '/buckets/{bucket_id}'.format(**request.matchdict)
+        if uri in request.registry.attachment_resources:
+            value = request.registry.attachment_resources[uri].get(name, value)
+        if 'collection_id' in request.matchdict:
+            uri = '/buckets/{bucket_id}/collections/{collection_id}'.format(**request.matchdict)
+            if uri in request.registry.attachment_resources:
+                value = request.registry.attachment_resources[uri].get(name, value)
+    return value
+
+
+def legacy(request):
+    mimetypes = {**DEFAULT_MIMETYPES}
+    conf_mimetypes = setting_value(request, 'mimetypes', default='')
+    mimetypes.update(dict([v.split(':') for v in conf_mimetypes.split(';')]))
+    resolve_extensions(setting_value(request, 'extensions', default='default'))
+    setting_value(request, 'max_size_bytes', default=None)
+    setting_value(request, 'keep_old_files', default=False)
+    setting_value(request, 'folder', default='')
+    setting_value(request, 'randomize', default=True)
+    setting_value(request, 'deduplicate', default=False)
+    setting_value(request, 'filename_pattern', default=None)
+
+
+def precompiled(request):
+    policy = get_policy(request)
+    policy.mimetypes, policy.extensions, policy.max_size_bytes, policy.keep_old_files
+    policy.folder, policy.randomize, policy.deduplicate, policy.filename_pattern
+
+
+def main(number=100000):
+    registry = SimpleNamespace(
+        settings=SETTINGS,
+        attachment_resources=RESOURCES,
+        attachment_policies=compile_policies(SETTINGS, RESOURCES),
+    )
+    matchdict = {'bucket_id': 'main', 'collection_id': '42', 'id': 'abc'}
+    request = SimpleNamespace(registry=registry, matchdict=matchdict)
+
+    for func in (legacy, precompiled):
+        elapsed = timeit.timeit(lambda: func(request), number=number)
+        print('%-12s %8.2f µs/request' % (func.__name__, elapsed / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
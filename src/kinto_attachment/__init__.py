@@ -1,3 +1,4 @@
+import logging
 from collections import defaultdict
 
 import pkg_resources
@@ -6,6 +7,8 @@ from pyramid.events import ApplicationCreated
 from pyramid.exceptions import ConfigurationError
 from pyramid.settings import asbool
 
+from kinto_attachment.compression import check_encoding
+from kinto_attachment.deltas import check_algorithm, check_python
 from kinto_attachment.migrations import KintoAttachmentMigration
 from kinto_attachment.storage import IFileStorage
 
@@ -13,6 +16,44 @@ from kinto_attachment.storage import IFileStorage
 #: Module version, as defined in PEP-0396.
 __version__ = pkg_resources.get_distribution(__package__).version
 
+logger = logging.getLogger(__name__)
+
+
+def warmup_storage(registry):
+    """Open the connections to the attachments storage, and time it."""
+    storage_impl = registry.getUtility(IFileStorage)
+    try:
+        with registry.metrics.timer("attachments.warmup.seconds"):
+            storage_impl.warmup()
+    except Exception:
+        # The connections will be opened lazily by the first request instead.
+        logger.warning("Could not warm up the attachments storage.", exc_info=True)
+
+
+# Callbacks run by :func:`post_fork` in Gunicorn workers.
+_post_fork_callbacks = []
+
+
+def register_post_fork(callback):
+    """Run *callback* in each worker process forked by uWSGI, or by Gunicorn if its
+    configuration uses the :func:`post_fork` hook.
+    """
+    try:
+        from uwsgidecorators import postfork
+    except ImportError:
+        _post_fork_callbacks.append(callback)
+    else:
+        postfork(callback)
+
+
+def post_fork(server, worker):
+    """Gunicorn ``post_fork`` server hook, e.g. in ``gunicorn.conf.py``::
+
+    from kinto_attachment import post_fork
+    """
+    for callback in _post_fork_callbacks:
+        callback()
+
 
 def includeme(config):
     # Process settings to remove storage wording.
@@ -20,6 +61,8 @@ def includeme(config):
 
     storage_settings = {}
     config.registry.attachment_resources = defaultdict(dict)
+    # Google Cloud Storage only transcodes gzip (see ``compression``).
+    gcloud = "attachment.gcloud.credentials" in settings
 
     for setting_name, setting_value in settings.items():
         if setting_name.startswith("attachment."):
@@ -38,10 +81,18 @@ def includeme(config):
                     message = "Configuration rule malformed: `{}`".format(setting_name)
                     raise ConfigurationError(message)
 
-                if name in ("randomize", "keep_old_files"):
+                if name in ("randomize", "keep_old_files", "deduplicate"):
                     config.registry.attachment_resources[resource_id][name] = asbool(setting_value)
                 elif name == "filename_pattern":
                     config.registry.attachment_resources[resource_id][name] = setting_value
+                elif name == "compress":
+                    if setting_value:
+                        check_encoding(setting_value, gcloud=gcloud)
+                    config.registry.attachment_resources[resource_id][name] = setting_value or None
+                elif name == "deltas":
+                    if setting_value:
+                        check_algorithm(setting_value)
+                    config.registry.attachment_resources[resource_id][name] = setting_value or None
                 elif name == "max_size_bytes":
                     config.registry.attachment_resources[resource_id][name] = int(setting_value)
                 else:
@@ -53,8 +104,37 @@ def includeme(config):
                 setting_name = setting_name.replace("attachment.", "storage.")
                 storage_settings[setting_name] = setting_value
 
+    if settings.get("attachment.compress"):
+        check_encoding(settings["attachment.compress"], gcloud=gcloud)
+    if settings.get("attachment.deltas"):
+        check_algorithm(settings["attachment.deltas"])
+    resources = config.registry.attachment_resources.values()
+    if settings.get("attachment.deltas") or any(r.get("deltas") for r in resources):
+        check_python(settings)
+    # The worker runs in another process, and would never see the queued files.
+    for setting_name, enabled in (
+        ("attachment.deletion_outbox", asbool(settings.get("attachment.deletion_outbox"))),
+        (
+            "attachment.compress_offload_min_size_bytes",
+            int(settings.get("attachment.compress_offload_min_size_bytes", 0)) > 0,
+        ),
+    ):
+        if enabled and "memory" in settings.get("storage_backend", ""):
+            raise ConfigurationError(
+                "`{}` requires a persistent storage backend, not `{}`".format(
+                    setting_name, settings["storage_backend"]
+                )
+            )
+
     config.add_settings(storage_settings)
 
+    # Resolve the settings of each bucket and collection once for all.
+    from kinto_attachment.utils import compile_policies
+
+    config.registry.attachment_policies = compile_policies(
+        settings, config.registry.attachment_resources
+    )
+
     # It may be useful to define an additional base_url setting.
     # (see workaround about relative base_url in README)
     extra_base_url = settings.get("attachment.extra.base_url", settings.get("attachment.base_url"))
@@ -73,8 +153,15 @@ def includeme(config):
     )
 
     # Register heartbeat to check attachments storage.
-    from kinto_attachment.views import attachments_ping
+    from kinto_attachment.views import HEARTBEAT_MODES, HeartbeatState, attachments_ping
 
+    heartbeat_mode = settings.get("attachment.heartbeat_mode", "write")
+    if heartbeat_mode not in HEARTBEAT_MODES:
+        message = "`attachment.heartbeat_mode` should be one of {}, not `{}`".format(
+            ", ".join(HEARTBEAT_MODES), heartbeat_mode
+        )
+        raise ConfigurationError(message)
+    config.registry.attachment_heartbeat = HeartbeatState()
     config.registry.heartbeats["attachments"] = attachments_ping
 
     # Enable attachment backend.
@@ -93,11 +180,26 @@ def includeme(config):
         config = event.app
         metrics_service = config.registry.metrics
         storage_impl = config.registry.getUtility(IFileStorage)
+        storage_impl.metrics = metrics_service
         core_metrics.watch_execution_time(metrics_service, storage_impl, prefix="backend")
 
+        if asbool(settings.get("attachment.warmup", False)):
+            registry = config.registry
+            warmup_storage(registry)
+            # Connections cannot be shared with worker processes forked from a preloaded app.
+            register_post_fork(lambda: warmup_storage(registry))
+
     config.add_subscriber(on_app_created, ApplicationCreated)
 
-    config.add_migration(KintoAttachmentMigration())
+    # File links are stored in a dedicated table on PostgreSQL, if enabled.
+    from kinto_attachment.links import load_link_store
+
+    config.registry.attachment_links = load_link_store(config.registry, settings)
+
+    link_table = asbool(settings.get("attachment.link_table", False))
+    config.add_migration(KintoAttachmentMigration(link_table=link_table))
 
     config.scan("kinto_attachment.views")
+    config.scan("kinto_attachment.uploads")
+    config.scan("kinto_attachment.batch")
     config.scan("kinto_attachment.listeners")
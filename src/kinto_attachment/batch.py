@@ -0,0 +1,266 @@
+"""Attach files to several records of a collection in a single request.
+
+The multipart body contains one file part per record, named after the record id.
+The optional ``data`` and ``permissions`` of each record are sent as ``<id>.data``
+and ``<id>.permissions`` form fields.
+
+Each record is checked (permission, posted fields, schema) before its file is stored,
+and its failures are reported in its own response. All the files of the valid records
+are stored first, then the records are updated, and the attachments they replace are
+removed. The records changed meanwhile by other requests are reported, and the files
+stored for them are removed. File links and record updates are committed together by
+the storage transaction of the request: the files themselves are written immediately,
+like for single uploads, and remain in the backend if the request fails afterwards. The
+``max_size_bytes`` limit applies to each file, and the request body is limited to
+``batch_max_files`` of them.
+"""
+
+import contextlib
+import json
+
+from kinto.core import Service
+from kinto.core.authorization import RouteFactory
+from kinto.core.errors import ERRORS, http_error
+from kinto.views import RelaxedUUID, object_exists_or_404
+from pyramid import httpexceptions
+from pyramid.security import NO_PERMISSION_REQUIRED
+
+from kinto_attachment import deltas, utils
+from kinto_attachment.views import (
+    DYNAMIC_PERMISSION,
+    SINGLE_FILE_FIELD,
+    check_request_body_size,
+    raise_too_large,
+)
+
+
+COLLECTION_PATH = "/buckets/{bucket_id}/collections/{collection_id}"
+
+DEFAULT_BATCH_MAX_FILES = 50
+
+_RECORD_FIELDS = ("data", "permissions")
+
+
+attachments = Service(
+    name="attachments-batch",
+    description="Attach files to several records of a collection",
+    path=COLLECTION_PATH + "/attachments",
+)
+
+
+def _bad_request(message, errno=ERRORS.INVALID_POSTED_DATA):
+    return http_error(httpexceptions.HTTPBadRequest(), errno=errno, message=message)
+
+
+@contextlib.contextmanager
+def _on_record(request, record_id):
+    """Temporarily target the record *record_id*, as if it was in the URL."""
+    backup_matchdict = request.matchdict
+    request.matchdict = {**backup_matchdict, "id": record_id}
+    try:
+        yield
+    finally:
+        request.matchdict = backup_matchdict
+
+
+def _error_result(record_id, error):
+    return {"id": record_id, "status": error.code, "body": json.loads(error.body)}
+
+
+def _check_collection_permission(request):
+    """Reject callers who can neither read the collection nor create records in it,
+    before its existence is checked (and revealed to them).
+
+    Permissions on each record are checked afterwards (see :func:`_prepare_record`).
+    """
+    context = RouteFactory(request)
+    context.permission_object_id = utils.collection_uri(request)
+    context.current_object = {}
+    for resource_name, permission in (("collection", "read"), ("record", "create")):
+        context.resource_name = resource_name
+        context.required_permission = permission
+        if request.has_permission(DYNAMIC_PERMISSION, context):
+            return
+    raise http_error(
+        httpexceptions.HTTPForbidden(),
+        errno=ERRORS.FORBIDDEN,
+        message="Unauthorized to attach files to this collection.",
+    )
+
+
+def _parse_parts(request):
+    """Group the posted parts by record id.
+
+    :returns: a dict ``{record_id: (file, {"data": ..., "permissions": ...})}``.
+    """
+    files = {}
+    fields = {}
+    for name, value in utils.parse_post(request).items():
+        if isinstance(value, str):
+            record_id, _, field = name.rpartition(".")
+            if field not in _RECORD_FIELDS:
+                error_msg = "body: %r should be a file or a '<id>.data' field" % name
+                raise _bad_request(error_msg)
+            record_fields = fields.setdefault(record_id, {})
+            if field in record_fields:
+                raise _bad_request("body: %r posted several times" % name)
+            record_fields[field] = value
+        elif name in files:
+            raise _bad_request("body: several files posted for record %r" % name)
+        else:
+            files[name] = value
+
+    for record_id in fields.keys() - files.keys():
+        raise _bad_request("body: no file posted for record %r" % record_id)
+    if not files:
+        raise _bad_request("Attachment missing.")
+
+    return {record_id: (files[record_id], fields.get(record_id, {})) for record_id in files}
+
+
+def _prepare_record(request, record_id, fields):
+    """Check the permission on the record, parse its posted fields and validate the
+    resulting record.
+
+    :returns: the posted record fields, and the :class:`utils.AttachmentRouteFactory`
+        context holding the current record.
+    :raises: :class:`pyramid.httpexceptions.HTTPException` if the record cannot be changed.
+    """
+    if not RelaxedUUID().match(record_id):
+        raise _bad_request("body: %r is not a valid record id" % record_id)
+
+    context = utils.AttachmentRouteFactory(request)
+    if not request.has_permission(DYNAMIC_PERMISSION, context):
+        raise http_error(
+            httpexceptions.HTTPForbidden(),
+            errno=ERRORS.FORBIDDEN,
+            message="Unauthorized to attach a file to this record.",
+        )
+
+    record = {"data": {}}
+    for field, value in fields.items():
+        try:
+            record[field] = json.loads(value)
+        except ValueError as e:
+            raise _bad_request("body: %s is not valid JSON (%s)" % (field, e))
+
+    utils.check_record(request, record, context, SINGLE_FILE_FIELD)
+    return record, context
+
+
+@attachments.post(permission=NO_PERMISSION_REQUIRED)
+def attachments_post(request):
+    if "multipart/form-data" not in request.headers.get("Content-Type", ""):
+        raise _bad_request(
+            "Content-Type should be multipart/form-data", errno=ERRORS.INVALID_PARAMETERS
+        )
+
+    _check_collection_permission(request)
+
+    max_files = int(
+        request.registry.settings.get("attachment.batch_max_files", DEFAULT_BATCH_MAX_FILES)
+    )
+    max_size_bytes = check_request_body_size(request, max_files=max_files)
+
+    # A missing bucket or collection fails the whole request.
+    object_exists_or_404(
+        request,
+        resource_name="collection",
+        parent_id=utils.bucket_uri(request),
+        object_id=request.matchdict["collection_id"],
+    )
+
+    try:
+        with utils.phase_timer(request, "parse"):
+            parts = _parse_parts(request)
+    except utils.RequestBodyTooLarge:
+        raise_too_large(max_size_bytes)
+    except ValueError as e:
+        raise _bad_request(str(e), errno=ERRORS.INVALID_PARAMETERS)
+    if len(parts) > max_files:
+        raise _bad_request(
+            "body: at most {} files can be posted at once.".format(max_files),
+            errno=ERRORS.INVALID_PARAMETERS,
+        )
+
+    policy = utils.get_policy(request)
+
+    results = {}
+    prepared = {}
+    record_uris = {}
+    for record_id, (_, fields) in parts.items():
+        with _on_record(request, record_id):
+            try:
+                prepared[record_id] = _prepare_record(request, record_id, fields)
+            except httpexceptions.HTTPException as e:
+                results[record_id] = _error_result(record_id, e)
+                # Validation errors are collected on the request, and would fail the batch.
+                del request.errors[:]
+            else:
+                record_uris[record_id] = utils.record_uri(request)
+
+    # Previous links are fetched at once, before the new ones are created.
+    old_links = utils.list_links(request, record_uris.values()) if prepared else []
+
+    # Store files. Invalid files (extension, size...) are reported and skipped.
+    # Previous versions are still stored, to compute patches from them (see ``deltas``).
+    attached = {}
+    for record_id, (_, context) in prepared.items():
+        content, _ = parts[record_id]
+        with (
+            _on_record(request, record_id),
+            deltas.previous_version(request, SINGLE_FILE_FIELD, content, context) as previous,
+        ):
+            folder = policy.folder.format(**request.matchdict) or None
+            try:
+                attachment = utils.save_file(request, content, folder=folder)
+            except httpexceptions.HTTPException as e:
+                results[record_id] = _error_result(record_id, e)
+                del request.errors[:]
+                continue
+            if previous:
+                with utils.phase_timer(request, "delta"):
+                    deltas.attach_delta(request, attachment, previous, content, folder)
+            attached[record_id] = attachment
+
+    # Update related records (validated by ``_prepare_record``).
+    updated = []
+    for record_id, attachment in attached.items():
+        record, context = prepared[record_id]
+        exists = context.current_object is not None
+        record["data"][SINGLE_FILE_FIELD] = attachment
+        with _on_record(request, record_id), utils.phase_timer(request, "record"):
+            try:
+                utils.update_record(request, record, context=context, checked=True)
+            except httpexceptions.HTTPException as e:
+                results[record_id] = _error_result(record_id, e)
+                del request.errors[:]
+                continue
+        updated.append(record_id)
+        results[record_id] = {
+            "id": record_id,
+            "status": 200 if exists else 201,
+            "body": attachment,
+        }
+
+    # Remove the files stored for the records that could not be updated.
+    failed_uris = [record_uris[record_id] for record_id in attached if record_id not in updated]
+    if failed_uris:
+        old_ids = {link["id"] for link in old_links}
+        new_links = utils.list_links(request, failed_uris)
+        utils.delete_links(request, [link for link in new_links if link["id"] not in old_ids])
+
+    # Remove the attachments being replaced.
+    updated_uris = {record_uris[record_id] for record_id in updated}
+    replaced_links = [link for link in old_links if link["record_uri"] in updated_uris]
+    utils.delete_links(request, replaced_links, keep_old_files=policy.keep_old_files)
+    if not policy.keep_old_files:
+        for record_id in updated:
+            _, context = prepared[record_id]
+            previous = (context.current_object or {}).get(SINGLE_FILE_FIELD)
+            if previous:
+                utils.observe_bytes(request, "deleted", previous["size"])
+
+    # Records created along the way must not change the status of the batch response.
+    request.response.status = 200
+    return {"responses": [results[record_id] for record_id in parts]}
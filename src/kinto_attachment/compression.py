@@ -0,0 +1,137 @@
+"""Pre-compressed variants of attachments.
+
+With the ``compress`` setting (``gzip``, ``br`` or ``zstd``), compressible files are
+compressed at upload time. Google Cloud Storage stores the compressed bytes with a
+``Content-Encoding``, and the local storage writes them next to the file, with the
+extension of the encoding (e.g. ``.gz`` for the nginx ``gzip_static`` module).
+Google Cloud Storage only decompresses ``gzip`` for clients that do not accept the
+encoding, so the other ones are only available with the local storage.
+
+By default, compression runs in the thread of the upload request, which is answered
+once the compressed variant is stored: the request is held for the whole compression
+(seconds for files of tens of MB with ``gzip``, longer with ``br``). With the
+``compress_offload_min_size_bytes`` setting, larger files are stored uncompressed, and
+compressed later by the worker (see :mod:`kinto_attachment.outbox`).
+
+Brotli and Zstandard require the ``brotli`` and ``zstandard`` packages.
+"""
+
+import hashlib
+import io
+import tempfile
+import zlib
+from typing import Any, NamedTuple
+
+from pyramid.exceptions import ConfigurationError
+
+
+#: File extensions of the encodings, as expected by web servers.
+ENCODINGS = {"gzip": ".gz", "br": ".br", "zstd": ".zst"}
+#: Encodings that Google Cloud Storage can serve decompressed.
+GCLOUD_ENCODINGS = ("gzip",)
+
+COMPRESSIBLE_MIMETYPES = (
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+)
+
+CHUNK_SIZE = 64 * 1024
+# Larger files are compressed into a temporary file.
+INLINE_MAX_SIZE = 1024 * 1024
+
+
+class Variant(NamedTuple):
+    """Compressed content of a file."""
+
+    encoding: str
+    file: Any
+    hash: str
+    size: int
+
+
+def check_encoding(encoding, gcloud=False):
+    """Raise :class:`ConfigurationError` if *encoding* is unknown or not installed, or
+    cannot be served by Google Cloud Storage when *gcloud* is ``True``.
+    """
+    if encoding not in ENCODINGS:
+        raise ConfigurationError(
+            "`{}` is not a supported compression. Use one of {}".format(
+                encoding, ", ".join(ENCODINGS)
+            )
+        )
+    if gcloud and encoding not in GCLOUD_ENCODINGS:
+        raise ConfigurationError(
+            "`{}` compression is not supported by Google Cloud Storage. Use {}".format(
+                encoding, ", ".join(GCLOUD_ENCODINGS)
+            )
+        )
+    try:
+        _compressor(encoding)
+    except ImportError as e:
+        raise ConfigurationError("`{}` compression is not available ({})".format(encoding, e))
+
+
+def is_compressible(mimetype):
+    mimetype = (mimetype or "").split(";")[0].strip().lower()
+    return (
+        mimetype.startswith("text/")
+        or mimetype in COMPRESSIBLE_MIMETYPES
+        or mimetype.endswith(("+json", "+xml"))
+    )
+
+
+def _compressor(encoding):
+    """:returns: the ``(compress, flush)`` functions of a new compressor for *encoding*."""
+    if encoding == "gzip":
+        # Gzip container, without timestamp: identical contents give identical files.
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress, compressor.flush
+    if encoding == "br":
+        import brotli
+
+        compressor = brotli.Compressor()
+        return compressor.process, compressor.finish
+
+    import zstandard
+
+    compressor = zstandard.ZstdCompressor().compressobj()
+    return compressor.compress, compressor.flush
+
+
+def _compress(fileobj, encoding, output):
+    compress, flush = _compressor(encoding)
+    m = hashlib.sha256()
+    size = 0
+    fileobj.seek(0)
+    while True:
+        chunk = fileobj.read(CHUNK_SIZE)
+        data = compress(chunk) if chunk else flush()
+        m.update(data)
+        size += len(data)
+        output.write(data)
+        if not chunk:
+            break
+    fileobj.seek(0)
+    output.seek(0)
+    return Variant(encoding, output, m.hexdigest(), size)
+
+
+def compress(fileobj, size, encoding, spool_path=None):
+    """Compress the content of *fileobj* (of *size* bytes) with *encoding*.
+
+    Compression runs in the calling thread. Small files are compressed in memory, and
+    larger ones into a temporary file in *spool_path* (default: the system temporary
+    directory).
+
+    :returns: a :class:`Variant`.
+    """
+    if size <= INLINE_MAX_SIZE:
+        return _compress(fileobj, encoding, io.BytesIO())
+    output = tempfile.TemporaryFile(dir=spool_path)
+    try:
+        return _compress(fileobj, encoding, output)
+    except BaseException:
+        output.close()
+        raise
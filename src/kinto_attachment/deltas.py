@@ -0,0 +1,225 @@
+"""Binary delta patches between successive versions of an attachment.
+
+With the ``deltas`` setting (``zstd`` or ``bsdiff``), replacing the file of a record
+stores a patch from the previous version to the new one, and advertises it in the
+``delta`` field of the attachment. Clients having the previous version can download
+the patch instead of the whole file.
+
+Patches are computed in a separate process (see :mod:`kinto_attachment.diffing`) run
+with the ``delta_python`` interpreter, killed after ``delta_timeout_seconds``, for files
+up to ``delta_max_size_bytes``, and are only kept if smaller than half of the new file.
+Both versions are streamed to the process through a temporary file. At most
+``MAX_CONCURRENT_DIFFS`` patches are computed at the same time by a worker: further
+replacements get no patch, and their previous version is not read.
+
+Zstandard patches are compressed frames whose dictionary is the previous version (like
+``zstd --patch-from``), and require the ``zstandard`` package. bsdiff patches require
+the ``bsdiff4`` package.
+"""
+
+import cgi
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+from pyramid.exceptions import ConfigurationError
+
+from kinto_attachment import diffing, utils
+
+
+logger = logging.getLogger(__name__)
+
+ALGORITHMS = {"zstd": ".zstpatch", "bsdiff": ".bsdiff"}
+
+DEFAULT_MAX_SIZE_BYTES = 64 * 1024 * 1024
+DEFAULT_TIMEOUT_SECONDS = 10
+# Patches are only worth it if smaller than this fraction of the new file.
+MAX_DELTA_RATIO = 0.5
+
+# Patches computed at the same time by a worker, each with both versions in memory of
+# its process.
+MAX_CONCURRENT_DIFFS = 2
+
+_slots = threading.BoundedSemaphore(MAX_CONCURRENT_DIFFS)
+
+
+def check_algorithm(algorithm):
+    """Raise :class:`ConfigurationError` if *algorithm* is unknown or not installed."""
+    if algorithm not in ALGORITHMS:
+        raise ConfigurationError(
+            "`{}` is not a supported delta algorithm. Use one of {}".format(
+                algorithm, ", ".join(ALGORITHMS)
+            )
+        )
+    try:
+        if algorithm == "zstd":
+            import zstandard  # noqa: F401
+        else:
+            import bsdiff4  # noqa: F401
+    except ImportError as e:
+        raise ConfigurationError("`{}` deltas are not available ({})".format(algorithm, e))
+
+
+def check_python(settings):
+    """Raise :class:`ConfigurationError` if patches cannot be computed with the Python
+    interpreter of the ``delta_python`` setting (default: the current one).
+
+    Under uWSGI, the current executable is the ``uwsgi`` binary, and the setting is
+    required.
+    """
+    python = _python(settings)
+    name = os.path.basename(python)
+    if not name.startswith(("python", "pypy")) or not os.access(python, os.X_OK):
+        raise ConfigurationError(
+            "`{}` is not a Python interpreter: set `attachment.delta_python`".format(python)
+        )
+
+
+def _python(settings):
+    return settings.get("attachment.delta_python") or sys.executable
+
+
+def _command(algorithm, python):
+    # Without the folder of the script in the path (``-P``), where modules of the package
+    # would shadow the standard ones.
+    return [python, "-P", diffing.__file__, algorithm]
+
+
+def run_diff(algorithm, stdin, timeout, python=sys.executable):
+    """Compute a patch in a separate process, from the *stdin* file holding both
+    versions (see :mod:`kinto_attachment.diffing`).
+
+    :raises subprocess.TimeoutExpired: if it takes more than *timeout* seconds (the
+        process is killed).
+    :raises subprocess.CalledProcessError: if it fails.
+    """
+    result = subprocess.run(
+        _command(algorithm, python),
+        stdin=stdin,
+        capture_output=True,
+        timeout=timeout,
+        check=True,
+    )
+    return result.stdout
+
+
+def _settings(request):
+    settings = request.registry.settings
+    max_size = int(settings.get("attachment.delta_max_size_bytes", DEFAULT_MAX_SIZE_BYTES))
+    timeout = float(settings.get("attachment.delta_timeout_seconds", DEFAULT_TIMEOUT_SECONDS))
+    return max_size, timeout
+
+
+def _patchable(request, file_field, content, context):
+    """:returns: the current attachment of the record, if a patch can be computed from
+    it to *content*."""
+    if not utils.get_policy(request).deltas or not isinstance(content, cgi.FieldStorage):
+        return None
+    previous = (context.current_object or {}).get(file_field)
+    max_size, _ = _settings(request)
+    # Compressed files would need to be decoded first.
+    if not previous or "compressed" in previous or previous["size"] > max_size:
+        return None
+    if content.file.seek(0, os.SEEK_END) > max_size:
+        return None
+    content.file.seek(0)
+    if not previous["location"].startswith(request.attachment.base_url):
+        return None
+    return previous
+
+
+@contextlib.contextmanager
+def previous_version(request, file_field, content, context=None):
+    """Copy the current file of the record to a temporary file, before it is replaced
+    by *content*, to compute a patch from it with :func:`attach_delta`.
+
+    The record is the one fetched by the *context* route factory (default: the one
+    of the request). One of the ``MAX_CONCURRENT_DIFFS`` slots is held until the end
+    of the block.
+
+    :returns: a ``(hash, file)`` tuple, or ``None`` if no patch can be computed.
+    """
+    previous = _patchable(request, file_field, content, context or request.context)
+    if previous is None:
+        yield None
+        return
+    # Memory and CPU are bounded: patches are not queued behind the running ones.
+    if not _slots.acquire(blocking=False):
+        logger.info("Too many delta computations running, skipped.")
+        yield None
+        return
+    try:
+        with tempfile.TemporaryFile() as stdin:
+            stdin.write(diffing.LENGTH_HEADER.pack(0))
+            try:
+                name = previous["location"][len(request.attachment.base_url) :]
+                request.attachment.download(name, stdin)
+            except Exception as e:
+                logger.warning("Could not read the previous attachment (%s)", e)
+                yield None
+                return
+            length = stdin.tell() - diffing.LENGTH_HEADER.size
+            stdin.seek(0)
+            stdin.write(diffing.LENGTH_HEADER.pack(length))
+            yield previous["hash"], stdin
+    finally:
+        _slots.release()
+
+
+def attach_delta(request, attachment, previous, content, folder):
+    """Store the patch from the *previous* version (see :func:`previous_version`) to the
+    new *content*, and describe it in the ``delta`` field of *attachment*, if worth it.
+    """
+    from_hash, stdin = previous
+    to_hash = attachment["hash"]
+    size = attachment["size"]
+    if from_hash == to_hash:
+        return
+
+    algorithm = utils.get_policy(request).deltas
+    _, timeout = _settings(request)
+    stdin.seek(0, os.SEEK_END)
+    content.file.seek(0)
+    shutil.copyfileobj(content.file, stdin)
+    content.file.seek(0)
+    stdin.seek(0)
+
+    try:
+        patch = run_diff(algorithm, stdin, timeout, _python(request.registry.settings))
+    except subprocess.TimeoutExpired:
+        logger.warning("Delta computation took more than %s seconds, skipped.", timeout)
+        return
+    except subprocess.CalledProcessError as e:
+        logger.warning(
+            "Delta computation failed (%s), skipped.", e.stderr.decode(errors="replace")
+        )
+        return
+    if len(patch) > size * MAX_DELTA_RATIO:
+        return
+
+    patch_hash = hashlib.sha256(patch).hexdigest()
+    filename = "{}-{}{}".format(from_hash[:16], to_hash[:16], ALGORITHMS[algorithm])
+    location = request.attachment.save_file(
+        io.BytesIO(patch),
+        filename,
+        folder=folder,
+        replace=True,
+        headers={"Content-Type": "application/octet-stream"},
+    )
+    # Removed along with the attachment. Named after the versions, the same patch can be
+    # shared between records: it is only deleted with its last link.
+    utils.link_file(request, location, content_hash=patch_hash)
+    attachment["delta"] = {
+        "algorithm": algorithm,
+        "from_hash": from_hash,
+        "hash": patch_hash,
+        "location": request.attachment.url(location),
+        "size": len(patch),
+    }
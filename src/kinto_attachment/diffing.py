@@ -0,0 +1,39 @@
+"""Binary diffs, computed in a separate process by :mod:`kinto_attachment.deltas`.
+
+This module is run as a script, and does not import anything from the package, so that
+the process starts quickly. The algorithm is passed as argument, and the input is the
+length of the previous version (8 bytes, big-endian), the previous version and the new
+one. The patch is written on the standard output.
+"""
+
+import struct
+import sys
+
+
+LENGTH_HEADER = struct.Struct(">Q")
+
+
+def diff(algorithm, old, new):
+    """:returns: the patch turning the *old* bytes into the *new* ones."""
+    if algorithm == "zstd":
+        import zstandard
+
+        dictionary = zstandard.ZstdCompressionDict(old, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        return zstandard.ZstdCompressor(level=19, dict_data=dictionary).compress(new)
+
+    import bsdiff4
+
+    return bsdiff4.diff(old, new)
+
+
+def main(args=None, stdin=None, stdout=None):
+    (algorithm,) = args if args is not None else sys.argv[1:]
+    data = (stdin or sys.stdin.buffer).read()
+    (length,) = LENGTH_HEADER.unpack_from(data)
+    start = LENGTH_HEADER.size
+    old, new = data[start : start + length], data[start + length :]
+    (stdout or sys.stdout.buffer).write(diff(algorithm, old, new))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,189 @@
+"""Links between records and their attached files.
+
+Links are used to find the files to delete when an attachment is replaced, or when
+its record, collection or bucket is deleted. A link is a dict with the relative
+``location`` of the file, the ``bucket_uri``, ``collection_uri`` and ``record_uri`` of
+its record, and the ``content_hash`` of deduplicated files.
+
+By default, links are stored as Kinto objects in the storage backend. On PostgreSQL,
+the ``link_table`` setting stores them in a dedicated ``attachment_links`` table instead.
+
+Deduplicated files are shared by the records with the same content: a file is reused
+if it exists, and deleted once no link points to it. Both are done under the lock of
+the content hash (see :meth:`ObjectLinkStore.lock`), so that a file is never deleted
+while a new link to it is being created.
+"""
+
+import logging
+
+from kinto.core.storage import Filter, postgresql
+from kinto.core.utils import COMPARISON
+from kinto.core.utils import sqlalchemy as sa
+from pyramid.settings import asbool
+
+
+logger = logging.getLogger(__name__)
+
+_FILE_LINKS_RESOURCE_NAME = "attachments"
+_FILE_LINKS_PARENT_ID = "__attachments__"
+
+_ID_COLUMNS = ("bucket_id", "collection_id", "record_id")
+_URI_FIELDS = ("bucket_uri", "collection_uri", "record_uri")
+
+
+def load_link_store(registry, settings):
+    """Return the link store to use with the configured storage backend."""
+    storage = registry.storage
+    if asbool(settings.get("attachment.link_table", False)):
+        if isinstance(storage, postgresql.Storage):
+            return PostgreSQLLinkStore(storage.client)
+        logger.warning("The attachment link table requires PostgreSQL, links stored as objects.")
+    return ObjectLinkStore(storage)
+
+
+def _advisory_lock(client, key):
+    # Transaction-level lock: released when the transaction of the request commits.
+    query = "SELECT pg_advisory_xact_lock(hashtext(:key));"
+    with client.connect() as conn:
+        conn.execute(sa.text(query), {"key": key})
+
+
+class ObjectLinkStore:
+    """Links stored as objects of the generic storage backend."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def create(self, link):
+        return self.storage.create(_FILE_LINKS_RESOURCE_NAME, _FILE_LINKS_PARENT_ID, link)
+
+    def list(self, field, uris, limit=None):
+        """Return the links whose *field* (e.g. ``record_uri``) is one of *uris*."""
+        return self.storage.list_all(
+            _FILE_LINKS_RESOURCE_NAME,
+            _FILE_LINKS_PARENT_ID,
+            filters=[Filter(field, list(uris), COMPARISON.IN)],
+            limit=limit,
+        )
+
+    def delete(self, links):
+        if not links:
+            return
+        self.storage.delete_all(
+            _FILE_LINKS_RESOURCE_NAME,
+            _FILE_LINKS_PARENT_ID,
+            filters=[Filter("id", [link["id"] for link in links], COMPARISON.IN)],
+            with_deleted=False,
+        )
+
+    def count(self, location):
+        """Return the number of links that point to the file stored at *location*."""
+        # A single-value IN, since EQ filters are compiled into containments that the
+        # ``location`` index cannot serve (see :mod:`kinto_attachment.migrations`).
+        return self.storage.count_all(
+            _FILE_LINKS_RESOURCE_NAME,
+            _FILE_LINKS_PARENT_ID,
+            filters=[Filter("location", [location], COMPARISON.IN)],
+        )
+
+    def lock(self, content_hash):
+        """Wait until no other transaction uses the files with *content_hash*, and hold
+        them until the end of the current transaction.
+
+        Only PostgreSQL has concurrent transactions: the lock does nothing with the other
+        backends.
+        """
+        if isinstance(self.storage, postgresql.Storage):
+            _advisory_lock(self.storage.client, content_hash)
+
+
+class PostgreSQLLinkStore:
+    """Links stored in the ``attachment_links`` table, with the ids of the bucket,
+    collection and record in separate columns.
+
+    The table is created by the plugin migration (see :mod:`kinto_attachment.migrations`).
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def _ids(uri):
+        # "/buckets/b/collections/c/records/r" -> ["b", "c", "r"]
+        return uri.split("/")[2::2]
+
+    @staticmethod
+    def _to_link(row):
+        link = {"id": row.id, "location": row.location}
+        ids = (row.bucket_id, row.collection_id, row.record_id)
+        uri = ""
+        for field, resource, object_id in zip(
+            _URI_FIELDS, ("buckets", "collections", "records"), ids
+        ):
+            uri += "/{}/{}".format(resource, object_id)
+            link[field] = uri
+        if row.content_hash is not None:
+            link["content_hash"] = row.content_hash
+        return link
+
+    def create(self, link):
+        bucket_id, collection_id, record_id = self._ids(link["record_uri"])
+        query = """
+        INSERT INTO attachment_links (bucket_id, collection_id, record_id, location, content_hash)
+        VALUES (:bucket_id, :collection_id, :record_id, :location, :content_hash)
+        RETURNING id;
+        """
+        placeholders = {
+            "bucket_id": bucket_id,
+            "collection_id": collection_id,
+            "record_id": record_id,
+            "location": link["location"],
+            "content_hash": link.get("content_hash"),
+        }
+        with self.client.connect() as conn:
+            result = conn.execute(sa.text(query), placeholders)
+            return {**link, "id": result.fetchone().id}
+
+    def list(self, field, uris, limit=None):
+        """Return the links whose *field* (e.g. ``record_uri``) is one of *uris*."""
+        columns = _ID_COLUMNS[: _URI_FIELDS.index(field) + 1]
+        conditions = []
+        placeholders = {}
+        for i, uri in enumerate(uris):
+            condition = []
+            for column, value in zip(columns, self._ids(uri)):
+                placeholders[f"{column}_{i}"] = value
+                condition.append(f"{column} = :{column}_{i}")
+            conditions.append("({})".format(" AND ".join(condition)))
+        if not conditions:
+            return []
+
+        query = """
+        SELECT id, bucket_id, collection_id, record_id, location, content_hash
+          FROM attachment_links
+         WHERE {}
+        """.format(" OR ".join(conditions))
+        if limit:
+            query += " LIMIT :limit"
+            placeholders["limit"] = limit
+        with self.client.connect(readonly=True) as conn:
+            result = conn.execute(sa.text(query), placeholders)
+            return [self._to_link(row) for row in result.fetchall()]
+
+    def delete(self, links):
+        if not links:
+            return
+        query = "DELETE FROM attachment_links WHERE id IN :ids;"
+        with self.client.connect() as conn:
+            conn.execute(sa.text(query), {"ids": tuple(link["id"] for link in links)})
+
+    def count(self, location):
+        """Return the number of links that point to the file stored at *location*."""
+        query = "SELECT COUNT(*) AS total FROM attachment_links WHERE location = :location;"
+        with self.client.connect(readonly=True) as conn:
+            result = conn.execute(sa.text(query), {"location": location})
+            return result.fetchone().total
+
+    def lock(self, content_hash):
+        """See :meth:`ObjectLinkStore.lock`."""
+        _advisory_lock(self.client, content_hash)
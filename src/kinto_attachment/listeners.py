@@ -2,7 +2,6 @@ from kinto.core.errors import http_error
 from kinto.core.events import ACTIONS, ResourceChanged
 from pyramid.events import subscriber
 from pyramid.exceptions import HTTPBadRequest
-from pyramid.settings import asbool
 
 from . import utils
 
@@ -18,16 +17,28 @@ def on_delete_record(event):
     When a bucket or collection is deleted, it removes the attachments of
     every underlying records.
     """
-    keep_old_files = asbool(utils.setting_value(event.request, "keep_old_files", default=False))
+    keep_old_files = utils.get_policy(event.request).keep_old_files
 
     # Retrieve attachments for these records using links.
     resource_name = event.payload["resource_name"]
     filter_field = "%s_uri" % resource_name
     uri = event.payload["uri"]
-    utils.delete_attachment(
+    deleted = utils.delete_attachment(
         event.request, link_field=filter_field, uri=uri, keep_old_files=keep_old_files
     )
 
+    labels = [("resource_name", resource_name)] + utils.metric_labels(event.request, uri)
+    event.request.registry.metrics.count(
+        "attachments.cascade_deleted_links", count=deleted, unique=labels
+    )
+    if keep_old_files or resource_name != "record":
+        # The sizes of the files are only known from the deleted records.
+        return
+    for change in event.impacted_objects:
+        attachment = change["old"].get("attachment")
+        if attachment:
+            utils.observe_bytes(event.request, "deleted", attachment["size"], uri=uri)
+
 
 @subscriber(ResourceChanged, for_resources=("record",), for_actions=(ACTIONS.UPDATE,))
 def on_update_record(event):
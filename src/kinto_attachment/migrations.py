@@ -7,21 +7,57 @@ from kinto.core.utils import sqlalchemy as sa
 logger = logging.getLogger(__name__)
 
 
+# Fields used to look up the file links of a record, a collection or a bucket.
+LINK_INDEXED_FIELDS = ("record_uri", "collection_uri", "bucket_uri")
+# Field used to count the references to a file (deduplication, deletion outbox).
+LINK_LOCATION_FIELD = "location"
+
+
+def _link_index_statement(field):
+    return f"""
+        CREATE INDEX IF NOT EXISTS idx_objects_attachments_{field}
+            ON objects ((data->'{field}'))
+            WHERE parent_id = '__attachments__' AND resource_name = 'attachments';
+        """
+
+
 class KintoAttachmentMigration(PostgreSQLPluginMigration):
     name = "kinto_attachment"
-    schema_version = 2
+    schema_version = 5
+
+    def __init__(self, link_table=False):
+        # Whether file links are stored in the ``attachment_links`` table.
+        self.link_table = link_table
+
+    def initialize_schema(self, client, dry_run=False):
+        super().initialize_schema(client, dry_run=dry_run)
+        if self.link_table:
+            # After the main schema, which creates the table.
+            LinkTableMigration().initialize_schema(client, dry_run=dry_run)
 
     def migrate_schema(self, start_version, dry_run=False):
         """
-        Migrate from 1 to 2.
+        Migrate from `start_version` to the latest version.
 
-        If `schema_version` is incremented one day, switch to file based migrations or
-        look at `start_version` to run only the relevant SQL commands.
+        If `schema_version` keeps being incremented, switch to file based migrations.
         """
         logger.info(
             f"Migrate PostgreSQL {self.name} from version {start_version} to {self.schema_version}."
         )
+        if start_version < 2:
+            self._migrate_resource_name()
+        if start_version < 3:
+            self._create_link_indexes()
+        if start_version < 4:
+            self._create_link_table()
+        if start_version < 5:
+            self._create_location_index()
+        logger.info(
+            f"PostgreSQL {self.name} schema migration {'simulated' if dry_run else 'done'}"
+        )
 
+    def _migrate_resource_name(self):
+        """Migrate from 1 to 2: set the resource name of file links."""
         with self.client.connect() as conn:
             result = conn.execute(
                 sa.text("""
@@ -50,6 +86,101 @@ class KintoAttachmentMigration(PostgreSQLPluginMigration):
         """
         with self.client.connect(force_commit=True) as conn:
             conn.execute(sa.text(sql))
+
+    def _create_link_indexes(self):
+        """Migrate from 2 to 3: index the lookups of file links.
+
+        The expressions match the JSONB comparisons generated by the ``IN`` filters of
+        the storage (``data->'record_uri' IN ('"/buckets/..."')``), and the indexes only
+        cover the file links rows of the ``objects`` table. ``EQ`` filters are compiled
+        into containments (``data @> '{...}'``) that these indexes cannot serve: the
+        link store only uses ``IN`` filters on links.
+        """
+        sql = (
+            "".join(_link_index_statement(field) for field in LINK_INDEXED_FIELDS)
+            + """
+        INSERT INTO metadata (name, value)
+            VALUES ('kinto_attachment_schema_version', '3');
+        """
+        )
+        with self.client.connect(force_commit=True) as conn:
+            conn.execute(sa.text(sql))
+
+    def _create_link_table(self):
+        """Migrate from 3 to 4: create the table of file links (see ``link_table`` setting)."""
+        sql = """
+        CREATE TABLE IF NOT EXISTS attachment_links (
+            id BIGSERIAL PRIMARY KEY,
+            bucket_id TEXT NOT NULL,
+            collection_id TEXT NOT NULL,
+            record_id TEXT NOT NULL,
+            location TEXT NOT NULL,
+            content_hash TEXT
+        );
+        -- Serves the lookups by bucket, collection and record.
+        CREATE INDEX IF NOT EXISTS idx_attachment_links_bucket_collection_record
+            ON attachment_links (bucket_id, collection_id, record_id);
+        CREATE INDEX IF NOT EXISTS idx_attachment_links_location
+            ON attachment_links (location);
+
+        INSERT INTO metadata (name, value)
+            VALUES ('kinto_attachment_schema_version', '4');
+        """
+        with self.client.connect(force_commit=True) as conn:
+            conn.execute(sa.text(sql))
+
+    def _create_location_index(self):
+        """Migrate from 4 to 5: index the reference counts of files (by ``location``)."""
+        sql = (
+            _link_index_statement(LINK_LOCATION_FIELD)
+            + """
+        INSERT INTO metadata (name, value)
+            VALUES ('kinto_attachment_schema_version', '5');
+        """
+        )
+        with self.client.connect(force_commit=True) as conn:
+            conn.execute(sa.text(sql))
+
+
+class LinkTableMigration(PostgreSQLPluginMigration):
+    """Move the file links stored as objects into the ``attachment_links`` table.
+
+    Versioned apart from the main schema, since the ``link_table`` setting can be enabled
+    anytime: the links are moved by the first migration run with the setting enabled.
+    """
+
+    name = "kinto_attachment_link_table"
+    schema_version = 2
+
+    def migrate_schema(self, start_version, dry_run=False):
+        if start_version < 2 and not dry_run:
+            self._move_links_to_table()
         logger.info(
             f"PostgreSQL {self.name} schema migration {'simulated' if dry_run else 'done'}"
         )
+
+    def _move_links_to_table(self):
+        """Migrate from 1 to 2: move the links into the table."""
+        sql = """
+        WITH moved AS (
+            DELETE FROM objects
+             WHERE parent_id = '__attachments__' AND resource_name = 'attachments'
+            RETURNING data
+        )
+        INSERT INTO attachment_links (bucket_id, collection_id, record_id, location, content_hash)
+            SELECT split_part(data->>'record_uri', '/', 3),
+                   split_part(data->>'record_uri', '/', 5),
+                   split_part(data->>'record_uri', '/', 7),
+                   data->>'location',
+                   data->>'content_hash'
+              FROM moved;
+        """
+        with self.client.connect(force_commit=True) as conn:
+            result = conn.execute(sa.text(sql))
+            conn.execute(
+                sa.text("""
+                INSERT INTO metadata (name, value)
+                    VALUES ('kinto_attachment_link_table_schema_version', '2');
+                """)
+            )
+        logger.info(f"Moved {result.rowcount} attachment links to the attachment_links table.")
@@ -0,0 +1,235 @@
+"""Asynchronous deletion and compression of attachment files.
+
+When the ``deletion_outbox`` setting is enabled, the files of removed attachments
+are not deleted from the storage backend during the request. Their locations are
+queued in the storage, in the same transaction as the removal of their links, and
+the ``kinto-attachment-worker`` command deletes them in batches, with retries.
+
+Likewise, files of at least ``compress_offload_min_size_bytes`` are stored uncompressed
+during the request (see the ``compress`` setting), and compressed by the worker.
+"""
+
+import argparse
+import logging
+import sys
+import tempfile
+import time
+
+import transaction
+from kinto.core.storage import Filter, Sort
+from kinto.core.storage import exceptions as storage_exceptions
+from kinto.core.utils import COMPARISON
+from pyramid.paster import bootstrap
+
+from kinto_attachment import compression, utils
+from kinto_attachment.storage import IFileStorage
+
+
+logger = logging.getLogger(__name__)
+
+_OUTBOX_RESOURCE_NAME = "deletions"
+_OUTBOX_PARENT_ID = "__attachment_deletions__"
+_COMPRESSIONS_RESOURCE_NAME = "compressions"
+_COMPRESSIONS_PARENT_ID = "__attachment_compressions__"
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_RETRY_DELAY_SECONDS = 30
+DEFAULT_POLL_INTERVAL_SECONDS = 10
+
+
+def enqueue_deletion(request, location, content_hash=None):
+    """Queue the file at *location* for deletion by the worker. The *content_hash* of
+    deduplicated files is locked when they are deleted (see :mod:`kinto_attachment.links`).
+    """
+    entry = {"location": location, "attempts": 0, "next_attempt": 0}
+    if content_hash:
+        entry["content_hash"] = content_hash
+    request.registry.storage.create(_OUTBOX_RESOURCE_NAME, _OUTBOX_PARENT_ID, entry)
+
+
+def enqueue_compression(request, location, filehash, encoding):
+    """Queue the compression with *encoding* of the file at *location*, attached to the
+    record of the request with the *filehash* content."""
+    entry = {
+        "record_uri": utils.record_uri(request),
+        "location": location,
+        "hash": filehash,
+        "encoding": encoding,
+        "attempts": 0,
+        "next_attempt": 0,
+    }
+    request.registry.storage.create(_COMPRESSIONS_RESOURCE_NAME, _COMPRESSIONS_PARENT_ID, entry)
+
+
+def _drain(
+    storage, resource_name, parent_id, process, verbs, batch_size, max_attempts, retry_delay
+):
+    """Run *process* on a batch of due entries of the queue, and remove them.
+
+    Failures are retried with an exponential backoff, and given up after *max_attempts*.
+
+    :returns: the number of processed entries.
+    """
+    now = int(time.time())
+    pending = storage.list_all(
+        resource_name,
+        parent_id,
+        filters=[Filter("next_attempt", now, COMPARISON.MAX)],
+        sorting=[Sort("next_attempt", 1)],
+        limit=batch_size,
+    )
+
+    verb, gerund = verbs
+    done = []
+    for entry in pending:
+        location = entry["location"]
+        try:
+            process(entry)
+        except Exception:
+            entry["attempts"] += 1
+            if entry["attempts"] < max_attempts:
+                logger.warning("Could not %s %r, will retry.", verb, location, exc_info=True)
+                entry["next_attempt"] = now + retry_delay * 2 ** (entry["attempts"] - 1)
+                storage.update(resource_name, parent_id, entry["id"], entry)
+                continue
+            logger.error("Giving up %s %r.", gerund, location, exc_info=True)
+        done.append(entry["id"])
+
+    if done:
+        storage.delete_all(
+            resource_name,
+            parent_id,
+            filters=[Filter("id", done, COMPARISON.IN)],
+            with_deleted=False,
+        )
+    return len(pending)
+
+
+def drain_deletions(
+    registry,
+    batch_size=DEFAULT_BATCH_SIZE,
+    max_attempts=DEFAULT_MAX_ATTEMPTS,
+    retry_delay=DEFAULT_RETRY_DELAY_SECONDS,
+):
+    """Delete a batch of queued files.
+
+    Files that are referenced again by a link (e.g. re-uploaded in deduplicated mode)
+    are kept. Failed deletions are retried with an exponential backoff, and given up
+    after *max_attempts*.
+
+    :returns: the number of processed entries.
+    """
+    backend = registry.getUtility(IFileStorage)
+
+    def delete(entry):
+        if entry.get("content_hash"):
+            registry.attachment_links.lock(entry["content_hash"])
+        if registry.attachment_links.count(entry["location"]) == 0:
+            backend.delete(entry["location"])
+
+    return _drain(
+        registry.storage,
+        _OUTBOX_RESOURCE_NAME,
+        _OUTBOX_PARENT_ID,
+        delete,
+        ("delete", "deleting"),
+        batch_size,
+        max_attempts,
+        retry_delay,
+    )
+
+
+def _compress(request, entry):
+    bucket_id, collection_id, record_id = entry["record_uri"].split("/")[2::2]
+    request.matchdict = {"bucket_id": bucket_id, "collection_id": collection_id, "id": record_id}
+    try:
+        record = request.registry.storage.get("record", utils.collection_uri(request), record_id)
+    except storage_exceptions.ObjectNotFoundError:
+        return
+    attachment = record.get("attachment") or {}
+    if attachment.get("location") != request.attachment.url(entry["location"]) or (
+        attachment.get("hash") != entry["hash"]
+    ):
+        # Replaced or removed meanwhile.
+        return
+
+    spool_path = request.attachment.spool_path
+    with tempfile.TemporaryFile(dir=spool_path) as file:
+        request.attachment.download(entry["location"], file)
+        variant = compression.compress(
+            file, attachment["size"], entry["encoding"], spool_path=spool_path
+        )
+        with variant.file:
+            if variant.size < attachment["size"]:
+                utils.attach_variant(request, record, entry["location"], file, variant)
+
+
+def drain_compressions(
+    request,
+    batch_size=DEFAULT_BATCH_SIZE,
+    max_attempts=DEFAULT_MAX_ATTEMPTS,
+    retry_delay=DEFAULT_RETRY_DELAY_SECONDS,
+):
+    """Compress a batch of queued files, with the *request* of the worker.
+
+    The compressed variant of each file is stored as a new file, that replaces the
+    uncompressed one in its record (see :func:`utils.attach_variant`). Files whose record
+    was changed or deleted meanwhile are skipped. Failed compressions are retried with an
+    exponential backoff, and given up after *max_attempts*.
+
+    :returns: the number of processed entries.
+    """
+    return _drain(
+        request.registry.storage,
+        _COMPRESSIONS_RESOURCE_NAME,
+        _COMPRESSIONS_PARENT_ID,
+        lambda entry: _compress(request, entry),
+        ("compress", "compressing"),
+        batch_size,
+        max_attempts,
+        retry_delay,
+    )
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Delete and compress the queued attachment files."
+    )
+    parser.add_argument("--ini", help="Kinto configuration file", default="config/kinto.ini")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument("--retry-delay", type=int, default=DEFAULT_RETRY_DELAY_SECONDS)
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL_SECONDS,
+        help="Seconds to wait when the queue is empty",
+    )
+    parser.add_argument("--once", action="store_true", help="Exit once the queue is drained")
+    parsed_args = parser.parse_args(args if args is not None else sys.argv[1:])
+
+    env = bootstrap(parsed_args.ini)
+    registry = env["registry"]
+    request = env["request"]
+    options = dict(
+        batch_size=parsed_args.batch_size,
+        max_attempts=parsed_args.max_attempts,
+        retry_delay=parsed_args.retry_delay,
+    )
+    try:
+        while True:
+            count = drain_deletions(registry, **options) + drain_compressions(request, **options)
+            # Records updated with compressed attachments.
+            for event in request.get_resource_events():
+                registry.notify(event)
+            transaction.commit()
+            for event in request.get_resource_events(after_commit=True):
+                registry.notify(event)
+            if count == 0:
+                if parsed_args.once:
+                    break
+                time.sleep(parsed_args.interval)
+    finally:
+        env["closer"]()
+    return 0
@@ -0,0 +1,59 @@
+"""Conditional updates of records.
+
+The plugin updates records from the version fetched by the
+:class:`~kinto_attachment.utils.AttachmentRouteFactory`. The update is only applied if
+the stored record still has the same ``last_modified``, so that changes or deletions
+made meanwhile by other requests are neither overwritten nor undone.
+
+With PostgreSQL, the version is compared by the ``UPDATE`` statement itself, which locks
+the row until the transaction of the request ends. The other backends have no such
+statement: the check is best-effort, and only relies on the version fetched by the
+route factory.
+"""
+
+import json
+
+from kinto.core.storage import postgresql
+from kinto.core.utils import sqlalchemy as sa
+
+
+def update_unmodified(storage, resource_name, parent_id, object_id, obj, last_modified):
+    """Replace the object *object_id* with *obj* if it was last modified at
+    *last_modified*, in a single statement with PostgreSQL (see above).
+
+    :returns: the stored object, or ``None`` if the object was changed or deleted.
+    """
+    if isinstance(storage, postgresql.Storage):
+        return _update_unmodified_postgresql(
+            storage.client, resource_name, parent_id, object_id, obj, last_modified
+        )
+    return storage.update(resource_name, parent_id, object_id, obj)
+
+
+def _update_unmodified_postgresql(client, resource_name, parent_id, object_id, obj, last_modified):
+    # Same as ``Storage.update()``, restricted to the expected version of an existing row.
+    data = {k: v for k, v in obj.items() if k not in ("id", "last_modified")}
+    query = """
+    UPDATE objects
+       SET data = (:data)::JSONB,
+           last_modified = from_epoch(:new_last_modified)
+     WHERE id = :object_id
+       AND parent_id = :parent_id
+       AND resource_name = :resource_name
+       AND NOT deleted
+       AND last_modified = from_epoch(:last_modified)
+    RETURNING as_epoch(last_modified) AS last_modified;
+    """
+    placeholders = {
+        "object_id": object_id,
+        "parent_id": parent_id,
+        "resource_name": resource_name,
+        "data": json.dumps(data),
+        "new_last_modified": obj.get("last_modified"),
+        "last_modified": last_modified,
+    }
+    with client.connect() as conn:
+        updated = conn.execute(sa.text(query), placeholders).fetchone()
+    if updated is None:
+        return None
+    return {**obj, "id": object_id, "last_modified": updated.last_modified}
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import re
 import unicodedata
@@ -11,6 +12,8 @@ from zope.interface import Attribute, Interface
 
 _FILENAME_ASCII_STRIP_RE = re.compile(r"[^A-Za-z0-9_.-]")
 
+MAX_KEY_LEVELS = 4
+
 
 class IFileStorage(Interface):
     base_url = Attribute("Base URL prepended to filenames to form public URLs.")
@@ -29,6 +32,9 @@ class IFileStorage(Interface):
         record_id="",
         replace=False,
         headers=None,
+        filename=None,
+        variant=None,
+        content_addressed=False,
     ):
         """Persist *fs* (a ``cgi.FieldStorage``-like object) and return the
         stored relative filename.
@@ -40,23 +46,128 @@ class IFileStorage(Interface):
         :param record_id: record ID substituted for ``{rid}`` in *filename_pattern*.
         :param replace: overwrite if a file with that name already exists.
         :param headers: dict of HTTP headers (used for ``Content-Type``).
+        :param filename: name to store the file under, instead of ``fs.filename``.
+        :param variant: compressed content of the file
+            (see :class:`kinto_attachment.compression.Variant`), stored along with it, or
+            instead of it with the ``Content-Encoding`` of the variant
+            (see :meth:`variant_name`).
+        :param content_addressed: the name is derived from the content (e.g. its hash):
+            an existing file with that name already has the same content.
         """
 
+    def variant_name(filename, encoding):
+        """Return the stored relative filename of the variant of *filename* compressed
+        with *encoding*: *filename* itself if the variant is stored instead of it."""
+
     def delete(filename):
-        """Remove *filename* from the store."""
+        """Remove *filename* from the store, if it exists.
+
+        :returns: ``False`` if there was no such file.
+        """
+
+    def read(filename):
+        """Return the stored bytes of *filename*."""
+
+    def download(filename, file):
+        """Write the stored bytes of *filename* into *file*, a chunk at a time."""
+
+    def delivery_headers(filename):
+        """Return the response headers that deliver *filename* to clients without the
+        application reading it: ``X-Accel-Redirect`` or ``X-Sendfile`` for the front
+        web server, or the ``Location`` to redirect them to.
+        """
+
+    def probe():
+        """Check that the store can be reached, without writing to it.
+
+        :raises: an exception if it cannot.
+        """
+
+    def warmup():
+        """Open the connections to the store ahead of the first request."""
+
+    def key_for(filename):
+        """Return the key under which *filename* is stored, according to the key layout."""
+
+    def delete_many(filenames):
+        """Remove all the *filenames* from the store, in as few round trips as possible."""
+
+    def stage(upload_id, offset, file):
+        """Write the content of *file* as a new chunk at *offset* of the staged upload
+        *upload_id*, and return its name. Staged chunks are never overwritten."""
+
+    def open_staged(upload_id, chunks):
+        """Return a readable file object with the *chunks* staged for *upload_id*,
+        concatenated in this order."""
+
+    def discard_staged(upload_id, chunks=None):
+        """Remove the *chunks* staged for *upload_id* (default: all its content), if any."""
+
+
+class IDirectUploadStorage(IFileStorage):
+    """File storage that lets clients upload files directly, without going through
+    the server (e.g. using signed URLs), and that assembles staged files server-side."""
+
+    def signed_upload_url(upload_id, size, md5, content_type, expires_in):
+        """Return the URL and the headers to upload the file of *upload_id*."""
+
+    def check_staged(upload_id, size, md5):
+        """Raise ``ValueError`` if the uploaded file does not match *size* and *md5*, and
+        return its SHA-256 hex digest, read back from the store."""
+
+    def assemble_staged(upload_id, chunks):
+        """Assemble the *chunks* staged for *upload_id* into a single staged file, and
+        return its SHA-256 hex digest and size, read back from the store."""
+
+    def commit_staged(
+        upload_id,
+        filename,
+        folder=None,
+        randomize=False,
+        filename_pattern=None,
+        record_id="",
+        replace=False,
+        headers=None,
+        content_addressed=False,
+    ):
+        """Move the staged file (uploaded directly, or assembled from chunks) into place,
+        and return the stored relative filename (see :meth:`IFileStorage.save`)."""
 
 
 class FileStorage:
     base_url = ""
+    # Directory where uploads are spooled while being received (default: the system one).
+    spool_path = None
+    # Number of hash-derived directory levels prepended to file names (see ``key_layout``).
+    key_levels = 0
+
+    def key_for(self, filename):
+        if not self.key_levels:
+            return filename
+        digest = hashlib.md5(filename.encode("utf-8"), usedforsecurity=False).hexdigest()
+        prefixes = [digest[2 * i : 2 * i + 2] for i in range(self.key_levels)]
+        return "/".join(prefixes + [filename])
+
+    def warmup(self):
+        pass
 
     def url(self, filename):
         return urllib.parse.urljoin(self.base_url, filename)
 
-    def save(self, fs, *args, **kwargs):
-        return self.save_file(fs.file, fs.filename, *args, **kwargs)
+    def delivery_headers(self, filename):
+        return {"Location": self.url(filename)}
 
-    @staticmethod
-    def _prepare_filename(filename, randomize=False, filename_pattern=None, record_id=""):
+    def variant_name(self, filename, encoding):
+        return filename
+
+    def delete_many(self, filenames):
+        for filename in filenames:
+            self.delete(filename)
+
+    def save(self, fs, *args, filename=None, **kwargs):
+        return self.save_file(fs.file, filename or fs.filename, *args, **kwargs)
+
+    def _prepare_filename(self, filename, randomize=False, filename_pattern=None, record_id=""):
         filename = secure_filename(os.path.basename(filename))
         if randomize:
             filename = random_filename(filename)
@@ -66,7 +177,24 @@ class FileStorage:
                 rid=record_id,
                 filename=filename,
             )
-        return filename
+        return self.key_for(filename)
+
+
+def parse_key_layout(value):
+    """Return the number of directory levels of the *value* of the ``key_layout`` setting.
+
+    ``flat`` (default) stores files directly in their folder, and ``hash:N`` spreads them
+    over ``N`` levels of 256 directories (e.g. ``hash:2`` gives ``3f/a2/<filename>``).
+    """
+    if value in (None, "", "flat"):
+        return 0
+    layout, _, levels = value.partition(":")
+    if layout != "hash" or not levels.isdigit() or not 1 <= int(levels) <= MAX_KEY_LEVELS:
+        raise pyramid_exceptions.ConfigurationError(
+            "Invalid key_layout %r: use 'flat' or 'hash:N' (1 <= N <= %s)"
+            % (value, MAX_KEY_LEVELS)
+        )
+    return int(levels)
 
 
 def register_file_storage_impl(config, impl):
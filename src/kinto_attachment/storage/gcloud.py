@@ -1,21 +1,35 @@
+import datetime
+import hashlib
 import mimetypes
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+from kinto.core.metrics import NoOpMetricsService
 from pyramid.exceptions import ConfigurationError
 from pyramid.settings import asbool
+from requests.adapters import HTTPAdapter
 from zope.interface import implementer
 
 from . import (
     FileStorage,
-    IFileStorage,
+    IDirectUploadStorage,
+    parse_key_layout,
     read_settings,
     register_file_storage_impl,
 )
 
 
 try:
-    from google.cloud.exceptions import NotFound
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud.exceptions import NotFound, PreconditionFailed
     from google.cloud.storage.blob import Blob
     from google.cloud.storage.client import Client
+    from google.oauth2 import service_account
 except ImportError:  # pragma: no cover
     raise RuntimeError(
         "Could not load Google Cloud Storage bindings.\n"
@@ -23,6 +37,16 @@ except ImportError:  # pragma: no cover
     )
 
 
+def _worker_threads():
+    """Return the number of threads of the uWSGI worker, if running under uWSGI."""
+    try:
+        import uwsgi
+    except ImportError:
+        return None
+    threads = uwsgi.opt.get("threads")
+    return int(threads) if threads else None
+
+
 def includeme(config):
     impl = GoogleCloudStorage.from_settings(config.registry.settings, prefix="storage.")
     register_file_storage_impl(config, impl)
@@ -30,9 +54,75 @@ def includeme(config):
 
 DEFAULT_BUCKET_ACL = "projectPrivate"
 DEFAULT_FILE_ACL = "publicRead"
+DEFAULT_STAGING_PREFIX = "uploads-staging/"
+# Staged uploads are reassembled in memory below this size, and spooled to disk above.
+STAGING_SPOOL_MAX_SIZE = 10 * 1024 * 1024
+# Maximum number of calls sent in a single GCS batch request.
+DELETE_BATCH_SIZE = 100
+# Files above this size are sent with resumable uploads, in chunks of ``chunk_size``.
+DEFAULT_RESUMABLE_THRESHOLD = 8 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# Resumable upload chunks must be a multiple of 256 KiB.
+CHUNK_SIZE_MULTIPLE = 256 * 1024
+DEFAULT_COMPOSITE_PART_SIZE = 32 * 1024 * 1024
+DEFAULT_UPLOAD_CONCURRENCY = 8
+# Maximum number of source objects of a GCS compose request.
+MAX_COMPOSE_SOURCES = 32
+
+
+class _FileRange:
+    """Read-only view of *length* bytes of *file* from *offset*.
+
+    Several ranges of the same file can be read from different threads: reads are
+    serialized with *lock*, since they share the position of the underlying file.
+    """
+
+    def __init__(self, file, offset, length, lock):
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.lock = lock
+        self.position = 0
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        with self.lock:
+            self.file.seek(self.offset + self.position)
+            data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self.position
+        elif whence == os.SEEK_END:
+            position += self.length
+        self.position = position
+        return position
+
+
+class _HashingWriter:
+    """Write-only file object computing the SHA-256 hash and the size of its content."""
+
+    def __init__(self):
+        self._sha256 = hashlib.sha256()
+        self.size = 0
 
+    def write(self, data):
+        self._sha256.update(data)
+        self.size += len(data)
+        return len(data)
 
-@implementer(IFileStorage)
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+
+@implementer(IDirectUploadStorage)
 class GoogleCloudStorage(FileStorage):
     @classmethod
     def from_settings(cls, settings, prefix):
@@ -46,6 +136,17 @@ class GoogleCloudStorage(FileStorage):
             ("gcloud.auto_create_acl", False, None),
             ("gcloud.cache_control", False, None),
             ("gcloud.uniform_bucket_level_access", False, False),
+            ("gcloud.staging_prefix", False, DEFAULT_STAGING_PREFIX),
+            ("gcloud.resumable_threshold", False, DEFAULT_RESUMABLE_THRESHOLD),
+            ("gcloud.chunk_size", False, DEFAULT_CHUNK_SIZE),
+            ("gcloud.composite_threshold", False, None),
+            ("gcloud.composite_part_size", False, DEFAULT_COMPOSITE_PART_SIZE),
+            ("gcloud.upload_concurrency", False, DEFAULT_UPLOAD_CONCURRENCY),
+            ("gcloud.pool_size", False, None),
+            ("gcloud.bucket_cache_ttl", False, None),
+            ("gcloud.missing_bucket_cache_ttl", False, None),
+            ("key_layout", False, None),
+            ("gcloud.signed_url_expires", False, None),
         )
         kwargs = read_settings(settings, options, prefix)
         kwargs = {k.replace("gcloud.", ""): v for k, v in kwargs.items()}
@@ -62,6 +163,17 @@ class GoogleCloudStorage(FileStorage):
         auto_create_acl=None,
         cache_control=None,
         uniform_bucket_level_access=False,
+        staging_prefix=DEFAULT_STAGING_PREFIX,
+        resumable_threshold=DEFAULT_RESUMABLE_THRESHOLD,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        composite_threshold=None,
+        composite_part_size=DEFAULT_COMPOSITE_PART_SIZE,
+        upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+        pool_size=None,
+        bucket_cache_ttl=None,
+        missing_bucket_cache_ttl=None,
+        key_layout=None,
+        signed_url_expires=None,
     ):
         if (acl or auto_create_acl) and uniform_bucket_level_access:
             raise ConfigurationError(
@@ -69,6 +181,12 @@ class GoogleCloudStorage(FileStorage):
                 'when "uniform_bucket_level_access" is enabled!'
             )
 
+        chunk_size = int(chunk_size)
+        if chunk_size <= 0 or chunk_size % CHUNK_SIZE_MULTIPLE:
+            raise ConfigurationError(
+                '"chunk_size" should be a multiple of %s bytes.' % CHUNK_SIZE_MULTIPLE
+            )
+
         self.uniform_bucket_level_access = asbool(uniform_bucket_level_access)
 
         if not self.uniform_bucket_level_access:
@@ -84,13 +202,35 @@ class GoogleCloudStorage(FileStorage):
         self.base_url = base_url
         self.auto_create_bucket = auto_create_bucket
         self.cache_control = cache_control
+        self.staging_prefix = staging_prefix
+        self.resumable_threshold = int(resumable_threshold)
+        self.chunk_size = chunk_size
+        self.composite_threshold = int(composite_threshold) if composite_threshold else None
+        self.composite_part_size = int(composite_part_size)
+        self.upload_concurrency = int(upload_concurrency)
+        self.pool_size = int(pool_size) if pool_size else None
+        self.bucket_cache_ttl = float(bucket_cache_ttl) if bucket_cache_ttl else None
+        self.missing_bucket_cache_ttl = (
+            float(missing_bucket_cache_ttl) if missing_bucket_cache_ttl else None
+        )
+        # Replaced by the application metrics service when the app starts.
+        self.metrics = NoOpMetricsService()
+        self.key_levels = parse_key_layout(key_layout)
+        # Downloads are redirected to signed URLs, valid for that many seconds.
+        self.signed_url_expires = int(signed_url_expires) if signed_url_expires else None
 
         self._client = None
-        self._bucket = None
+        # Bucket handles by name, as ``(bucket, expiration)``. Missing buckets are cached
+        # as ``None`` handles, and entries without expiration never expire.
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
 
     def get_connection(self):
         if self._client is None:
-            if self.credentials:
+            pool_size = self.pool_size or _worker_threads()
+            if pool_size:
+                self._client = self._pooled_client(pool_size)
+            elif self.credentials:
                 self._client = Client.from_service_account_json(
                     json_credentials_path=self.credentials
                 )
@@ -100,12 +240,69 @@ class GoogleCloudStorage(FileStorage):
                 self._client = Client()
         return self._client
 
+    def _pooled_client(self, pool_size):
+        """Create a client whose HTTP session keeps up to *pool_size* connections."""
+        if self.credentials:
+            credentials = service_account.Credentials.from_service_account_file(
+                self.credentials, scopes=Client.SCOPE
+            )
+            project = self.project or credentials.project_id
+        else:
+            credentials, project = google.auth.default(scopes=Client.SCOPE)
+            project = self.project or project
+        session = AuthorizedSession(credentials)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        kwargs = {"project": project} if project else {}
+        return Client(credentials=credentials, _http=session, **kwargs)
+
+    def warmup(self):
+        """Create the client and fetch the bucket metadata. This loads the credentials, obtains an access token,
+        and opens a connection, ahead of the first request.
+
+        Any existing client is dropped: after a fork, its connections are shared with
+        the parent process.
+        """
+        self._client = None
+        with self._buckets_lock:
+            self._buckets.clear()
+        self.get_connection()
+        self.get_bucket()
+
     def get_bucket(self, bucket_name=None):
-        if self._bucket is None:
-            self._bucket = self._get_or_create_bucket(self.bucket_name)
-        if bucket_name and bucket_name != self.bucket_name:
-            return self._get_or_create_bucket(bucket_name)
-        return self._bucket
+        """Return the handle of *bucket_name* (default: ``bucket_name`` setting).
+
+        Handles are cached, for ``bucket_cache_ttl`` seconds if set. Missing buckets are
+        cached for ``missing_bucket_cache_ttl`` seconds if set.
+        """
+        name = bucket_name or self.bucket_name
+        now = time.monotonic()
+        with self._buckets_lock:
+            cached = self._buckets.get(name)
+        if cached is not None:
+            bucket, expiration = cached
+            if expiration is None or now < expiration:
+                self.metrics.count("attachments.bucket_cache.hits")
+                if bucket is None:
+                    raise RuntimeError(self._missing_bucket_message(name))
+                return bucket
+
+        self.metrics.count("attachments.bucket_cache.misses")
+        try:
+            bucket = self._get_or_create_bucket(name)
+        except RuntimeError:
+            if self.missing_bucket_cache_ttl:
+                with self._buckets_lock:
+                    self._buckets[name] = (None, now + self.missing_bucket_cache_ttl)
+            raise
+        expiration = now + self.bucket_cache_ttl if self.bucket_cache_ttl else None
+        with self._buckets_lock:
+            self._buckets[name] = (bucket, expiration)
+        return bucket
+
+    @staticmethod
+    def _missing_bucket_message(name):
+        return "Bucket %s does not exist. Set auto_create_bucket=True to create it." % name
 
     def _get_or_create_bucket(self, name):
         try:
@@ -116,9 +313,7 @@ class GoogleCloudStorage(FileStorage):
                 if not self.uniform_bucket_level_access:
                     bucket.acl.save_predefined(self.auto_create_acl)
                 return bucket
-            raise RuntimeError(
-                "Bucket %s does not exist. Set auto_create_bucket=True to create it." % name
-            )
+            raise RuntimeError(self._missing_bucket_message(name))
 
     def exists(self, name, bucket_name=None):
         if not name:
@@ -127,10 +322,213 @@ class GoogleCloudStorage(FileStorage):
                 return True
             except RuntimeError:
                 return False
-        return bool(self.get_bucket(bucket_name).get_blob(name))
+        return Blob(name, self.get_bucket(bucket_name)).exists()
+
+    def read(self, name, bucket_name=None):
+        # As stored, even if compressed.
+        return Blob(name, self.get_bucket(bucket_name)).download_as_bytes(raw_download=True)
+
+    def download(self, name, file, bucket_name=None):
+        Blob(name, self.get_bucket(bucket_name)).download_to_file(file, raw_download=True)
+
+    def delivery_headers(self, name, bucket_name=None):
+        if not self.signed_url_expires:
+            return super().delivery_headers(name)
+        blob = Blob(name, self.get_bucket(bucket_name))
+        url = blob.generate_signed_url(
+            version="v4",
+            expiration=datetime.timedelta(seconds=self.signed_url_expires),
+            method="GET",
+        )
+        return {"Location": url}
+
+    def probe(self):
+        # A metadata GET, even if the bucket handle is cached.
+        self.get_bucket().reload()
+
+    @staticmethod
+    def _preconditions(replace):
+        # Without *replace*, writes only succeed if no live object has the same name
+        # (generation 0). GCS enforces it, and answers 412 otherwise.
+        return {} if replace else {"if_generation_match": 0}
+
+    @staticmethod
+    def _current_generation(bucket, filename):
+        """Return the preconditions to overwrite the current object named *filename*,
+        unless it changes meanwhile."""
+        existing = bucket.get_blob(filename)
+        return {"if_generation_match": existing.generation if existing else 0}
 
     def delete(self, filename, bucket_name=None):
-        self.get_bucket(bucket_name).delete_blob(filename)
+        try:
+            self.get_bucket(bucket_name).delete_blob(filename)
+        except NotFound:
+            # Already deleted (e.g. by a retried deletion).
+            return False
+        return True
+
+    def delete_many(self, filenames, bucket_name=None):
+        bucket = self.get_bucket(bucket_name)
+        for i in range(0, len(filenames), DELETE_BATCH_SIZE):
+            names = filenames[i : i + DELETE_BATCH_SIZE]
+            try:
+                with self.get_connection().batch():
+                    for filename in names:
+                        bucket.delete_blob(filename)
+            except NotFound:
+                # Batches only raise their last failure: the files are deleted again one
+                # at a time, ignoring the missing ones (e.g. already deleted by a retried
+                # request), so that the other failures are raised.
+                bucket.delete_blobs(names, on_error=lambda blob: None)
+
+    def _staged_name(self, upload_id, chunk=None):
+        # Chunks are named after their zero-padded offset and a unique suffix. The file
+        # uploaded directly (or assembled from chunks) is named after offset 0 alone.
+        return "{}{}/{}".format(self.staging_prefix, upload_id, chunk or "{:020d}".format(0))
+
+    def _staged_blobs(self, upload_id, bucket_name=None):
+        prefix = "{}{}/".format(self.staging_prefix, upload_id)
+        blobs = self.get_bucket(bucket_name).list_blobs(prefix=prefix)
+        return sorted(blobs, key=lambda blob: blob.name)
+
+    def stage(self, upload_id, offset, file, bucket_name=None):
+        # Each chunk is a separate (private) object, reassembled when the upload is
+        # finalized. It is never overwritten, even by concurrent requests.
+        chunk = "{:020d}-{}".format(offset, uuid.uuid4().hex)
+        blob = Blob(self._staged_name(upload_id, chunk), self.get_bucket(bucket_name))
+        blob.upload_from_file(file, content_type="application/octet-stream", if_generation_match=0)
+        return chunk
+
+    def open_staged(self, upload_id, chunks, bucket_name=None):
+        bucket = self.get_bucket(bucket_name)
+        staged = tempfile.SpooledTemporaryFile(max_size=STAGING_SPOOL_MAX_SIZE)
+        for chunk in chunks:
+            Blob(self._staged_name(upload_id, chunk), bucket).download_to_file(staged)
+        staged.seek(0)
+        return staged
+
+    def assemble_staged(self, upload_id, chunks, bucket_name=None):
+        """Compose the *chunks* staged for *upload_id* into a single staged object,
+        server-side, and return its SHA-256 hex digest and size, read back from GCS.
+
+        The composed object is committed like a file uploaded directly (see
+        :meth:`commit_staged`). The chunks are kept until the upload is discarded.
+        """
+        bucket = self.get_bucket(bucket_name)
+        sources = [Blob(self._staged_name(upload_id, chunk), bucket) for chunk in chunks]
+        staged = Blob(self._staged_name(upload_id), bucket)
+        self._compose(staged, bucket, sources, {})
+
+        # The hash is the one of the stored bytes, never computed from the chunks as sent.
+        return self._read_hash(staged)
+
+    @staticmethod
+    def _read_hash(blob):
+        """Stream the stored bytes of *blob*, and return their SHA-256 hex digest and size."""
+        writer = _HashingWriter()
+        blob.download_to_file(writer, raw_download=True)
+        return writer.hexdigest(), writer.size
+
+    def discard_staged(self, upload_id, chunks=None, bucket_name=None):
+        if chunks is None:
+            names = [blob.name for blob in self._staged_blobs(upload_id, bucket_name)]
+        else:
+            names = [self._staged_name(upload_id, chunk) for chunk in chunks]
+        self.delete_many(names, bucket_name=bucket_name)
+
+    def signed_upload_url(self, upload_id, size, md5, content_type, expires_in, bucket_name=None):
+        """Return a V4 signed URL (and the headers to send along) allowing a client to
+        upload the file of *upload_id* directly, as a single staged object.
+
+        The declared size and MD5 checksum are part of the signature, and enforced by GCS.
+        """
+        blob = Blob(self._staged_name(upload_id), self.get_bucket(bucket_name))
+        headers = {"x-goog-content-length-range": "{0},{0}".format(size)}
+        url = blob.generate_signed_url(
+            version="v4",
+            expiration=datetime.timedelta(seconds=expires_in),
+            method="PUT",
+            content_type=content_type,
+            content_md5=md5,
+            headers=headers,
+        )
+        return url, {"Content-Type": content_type, "Content-MD5": md5, **headers}
+
+    def check_staged(self, upload_id, size, md5, bucket_name=None):
+        """Raise ``ValueError`` if the object uploaded directly for *upload_id* is missing,
+        or does not match the declared size and MD5 checksum (from its metadata).
+
+        :returns: the SHA-256 hex digest of the object, read back from GCS.
+        """
+        blob = self.get_bucket(bucket_name).get_blob(self._staged_name(upload_id))
+        if blob is None:
+            raise ValueError("File was not uploaded.")
+        if blob.size != size or blob.md5_hash != md5:
+            raise ValueError("Uploaded file does not match the declared size and checksum.")
+        return self._read_hash(blob)[0]
+
+    def commit_staged(
+        self,
+        upload_id,
+        filename,
+        folder=None,
+        bucket_name=None,
+        randomize=False,
+        filename_pattern=None,
+        record_id="",
+        acl=None,
+        replace=False,
+        headers=None,
+        content_addressed=False,
+    ):
+        """Copy the object staged for *upload_id* (uploaded directly, or assembled by
+        :meth:`assemble_staged`) into place, server-side, with the same naming rules as
+        :meth:`save_file`, and return its name."""
+        filename = self._prepare_filename(filename, randomize, filename_pattern, record_id)
+
+        if folder:
+            filename = folder + "/" + filename
+
+        bucket = self.get_bucket(bucket_name)
+        blob = Blob(filename, bucket)
+        blob.content_type = (headers or {}).get("Content-Type") or "application/octet-stream"
+        blob.cache_control = self.cache_control
+        staged = Blob(self._staged_name(upload_id), bucket)
+        try:
+            # A single source: the metadata of the copy are the ones of *blob*.
+            blob.compose([staged], **self._preconditions(replace))
+        except PreconditionFailed:
+            if content_addressed:
+                # Already exists, with the same content.
+                return filename
+            # See ``save_file()``.
+            blob.compose([staged], **self._current_generation(bucket, filename))
+        if not self.uniform_bucket_level_access:
+            blob.acl.save_predefined(acl or self.acl)
+
+        return filename
+
+    def _compose(self, blob, bucket, sources, preconditions):
+        """Compose *sources* into *blob*, through intermediate objects under the staging
+        prefix (removed afterwards) if there are more than a single request accepts."""
+        prefix = "{}composite/{}/".format(self.staging_prefix, uuid.uuid4().hex)
+        parts = []
+        try:
+            while len(sources) > MAX_COMPOSE_SOURCES:
+                composed = []
+                for i in range(0, len(sources), MAX_COMPOSE_SOURCES):
+                    part = Blob("{}{:05d}".format(prefix, len(parts)), bucket)
+                    part.compose(sources[i : i + MAX_COMPOSE_SOURCES])
+                    parts.append(part)
+                    composed.append(part)
+                sources = composed
+            blob.compose(sources, **preconditions)
+        finally:
+            # Not listed: requests made within a batch are deferred until it ends.
+            for i in range(0, len(parts), DELETE_BATCH_SIZE):
+                with self.get_connection().batch():
+                    for part in parts[i : i + DELETE_BATCH_SIZE]:
+                        bucket.delete_blob(part.name)
 
     def save_file(
         self,
@@ -144,6 +542,8 @@ class GoogleCloudStorage(FileStorage):
         acl=None,
         replace=False,
         headers=None,
+        variant=None,
+        content_addressed=False,
     ):
         filename = self._prepare_filename(filename, randomize, filename_pattern, record_id)
 
@@ -155,21 +555,73 @@ class GoogleCloudStorage(FileStorage):
             content_type, _ = mimetypes.guess_type(filename)
         content_type = content_type or "application/octet-stream"
 
-        blob = self.get_bucket(bucket_name).get_blob(filename)
+        bucket = self.get_bucket(bucket_name)
+        blob = Blob(filename, bucket)
+        blob.cache_control = self.cache_control
+        blob.content_type = content_type
+        if variant:
+            # Stored compressed: GCS decompresses gzip for clients that do not accept it.
+            blob.content_encoding = variant.encoding
+            file = variant.file
 
-        if blob and not replace:
-            return filename
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
 
-        if not blob:
-            blob = Blob(filename, self.get_bucket(bucket_name))
+        def write(preconditions):
+            file.seek(0)
+            if self.composite_threshold and size >= self.composite_threshold:
+                self._upload_composite(blob, bucket, file, size, preconditions)
+                if not self.uniform_bucket_level_access:
+                    blob.acl.save_predefined(acl or self.acl)
+            else:
+                upload_kwargs = dict(preconditions)
+                if not self.uniform_bucket_level_access:
+                    upload_kwargs["predefined_acl"] = acl or self.acl
+                self._upload(blob, file, size, content_type=content_type, **upload_kwargs)
 
-        blob.cache_control = self.cache_control
-        file.seek(0)
+        try:
+            write(self._preconditions(replace))
+        except PreconditionFailed:
+            if content_addressed:
+                # Already exists, with the same content.
+                return filename
+            # Another object has the name (e.g. the previous version of the file, whose
+            # deletion is queued): overwrite it, and fail if it changes meanwhile.
+            write(self._current_generation(bucket, filename))
 
-        upload_kwargs = {"rewind": True, "content_type": content_type}
-        if not self.uniform_bucket_level_access:
-            upload_kwargs["predefined_acl"] = acl or self.acl
+        return filename
 
-        blob.upload_from_file(file, **upload_kwargs)
+    def _upload(self, blob, file, size, **upload_kwargs):
+        # Small files are sent in a single request. Larger files use a resumable upload,
+        # whose chunks bound the memory used, and are retried individually.
+        if size > self.resumable_threshold:
+            blob.chunk_size = self.chunk_size
+        blob.upload_from_file(file, size=size, **upload_kwargs)
 
-        return filename
+    def _upload_composite(self, blob, bucket, file, size, preconditions):
+        """Upload *file* as parts sent concurrently, and composed into *blob* by GCS.
+
+        The parts are temporary objects under the staging prefix, removed afterwards.
+        """
+        part_size = max(self.composite_part_size, -(-size // MAX_COMPOSE_SOURCES))
+        prefix = "{}composite/{}/".format(self.staging_prefix, uuid.uuid4().hex)
+        lock = threading.Lock()
+
+        def upload_part(index):
+            offset = index * part_size
+            length = min(part_size, size - offset)
+            part = Blob("{}{:05d}".format(prefix, index), bucket)
+            content = _FileRange(file, offset, length, lock)
+            self._upload(part, content, length, content_type="application/octet-stream")
+            return part
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.upload_concurrency) as executor:
+                parts = list(executor.map(upload_part, range(-(-size // part_size))))
+            blob.compose(parts, **preconditions)
+        finally:
+            uploaded = list(bucket.list_blobs(prefix=prefix))
+            if uploaded:
+                with self.get_connection().batch():
+                    for part in uploaded:
+                        part.delete()
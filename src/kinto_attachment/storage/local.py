@@ -1,20 +1,78 @@
+import errno
+import io
 import os
 import shutil
+import stat
+import tempfile
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+from pyramid.settings import asbool
 from zope.interface import implementer
 
+from ..compression import ENCODINGS
 from . import (
     FileStorage,
     IFileStorage,
+    parse_key_layout,
     read_settings,
     register_file_storage_impl,
+    secure_filename,
 )
 
 
+# Number of files removed in parallel by ``delete_many()``.
+DEFAULT_DELETE_CONCURRENCY = 8
+# Number of numbered names tried (``name.ext``, ``name-1.ext``...) before using a random suffix.
+NAME_PROBES = 3
+# Suffix of the files being written.
+TEMP_SUFFIX = ".tmp"
+
+
 def includeme(config):
     impl = LocalFileStorage.from_settings(config.registry.settings, prefix="storage.")
     register_file_storage_impl(config, impl)
 
+    if impl.spool_path:
+        os.makedirs(impl.spool_path, exist_ok=True)
+
+
+def copy_file(src, dest):
+    """Copy the whole content of *src* into *dest*, from its current position.
+
+    When both are backed by actual files, the copy happens in the kernel
+    (``copy_file_range()``, or ``sendfile()``), without going through user space buffers.
+    """
+    src.seek(0)
+    try:
+        src_fd = src.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        # In-memory file (e.g. small uploads).
+        shutil.copyfileobj(src, dest)
+        return
+
+    dest.flush()
+    dest_fd = dest.fileno()
+    start = dest.tell()
+    size = os.fstat(src_fd).st_size
+    offset = 0
+    try:
+        while offset < size:
+            if hasattr(os, "copy_file_range"):
+                copied = os.copy_file_range(src_fd, dest_fd, size - offset, offset_src=offset)
+            else:  # pragma: no cover
+                copied = os.sendfile(dest_fd, src_fd, offset, size - offset)
+            if not copied:
+                break
+            offset += copied
+    except OSError:
+        # Not supported between these files: copy the rest in user space.
+        pass
+    src.seek(offset)
+    dest.seek(start + offset)
+    shutil.copyfileobj(src, dest)
+
 
 @implementer(IFileStorage)
 class LocalFileStorage(FileStorage):
@@ -23,13 +81,41 @@ class LocalFileStorage(FileStorage):
         options = (
             ("base_path", True, None),
             ("base_url", False, ""),
+            ("staging_path", False, None),
+            ("spool_path", False, None),
+            ("delete_concurrency", False, DEFAULT_DELETE_CONCURRENCY),
+            ("key_layout", False, None),
+            ("accel_redirect", False, None),
+            ("sendfile", False, False),
         )
         kwargs = read_settings(settings, options, prefix)
         return cls(**kwargs)
 
-    def __init__(self, base_path, base_url=""):
+    def __init__(
+        self,
+        base_path,
+        base_url="",
+        staging_path=None,
+        spool_path=None,
+        delete_concurrency=DEFAULT_DELETE_CONCURRENCY,
+        key_layout=None,
+        accel_redirect=None,
+        sendfile=False,
+    ):
         self.base_path = base_path
+        # Internal location of the front web server that serves ``base_path``.
+        self.accel_redirect = accel_redirect.rstrip("/") + "/" if accel_redirect else None
+        self.sendfile = asbool(sendfile)
+        self.key_levels = parse_key_layout(key_layout)
         self.base_url = base_url
+        self.delete_concurrency = int(delete_concurrency)
+        # Uploaded files are spooled there: on the same file system as ``base_path``,
+        # they are saved without copy.
+        self.spool_path = spool_path
+        # Resumable uploads are staged outside of the (publicly served) base path.
+        self.staging_path = staging_path or os.path.join(
+            spool_path or tempfile.gettempdir(), "kinto-attachment-uploads"
+        )
 
     def path(self, filename):
         return os.path.join(self.base_path, filename)
@@ -37,12 +123,82 @@ class LocalFileStorage(FileStorage):
     def exists(self, filename):
         return os.path.exists(self.path(filename))
 
+    def read(self, filename):
+        with open(self.path(filename), "rb") as f:
+            return f.read()
+
+    def download(self, filename, file):
+        with open(self.path(filename), "rb") as f:
+            shutil.copyfileobj(f, file)
+
+    def delivery_headers(self, filename):
+        if self.accel_redirect:
+            return {"X-Accel-Redirect": self.accel_redirect + urllib.parse.quote(filename)}
+        if self.sendfile:
+            return {"X-Sendfile": os.path.abspath(self.path(filename))}
+        return super().delivery_headers(filename)
+
+    def variant_name(self, filename, encoding):
+        return filename + ENCODINGS[encoding]
+
+    def probe(self):
+        if not os.access(self.base_path, os.W_OK | os.X_OK):
+            raise IOError("%s is not a writable folder." % self.base_path)
+
     def delete(self, filename):
         if self.exists(filename):
             os.remove(self.path(filename))
             return True
         return False
 
+    def delete_many(self, filenames):
+        if len(filenames) <= 1 or self.delete_concurrency <= 1:
+            return super().delete_many(filenames)
+        # Removing files is I/O bound: overlap the system calls.
+        workers = min(self.delete_concurrency, len(filenames))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(self.delete, filenames))
+
+    def _staged_path(self, upload_id, chunk=""):
+        return os.path.join(self.staging_path, secure_filename(upload_id), chunk)
+
+    def stage(self, upload_id, offset, file):
+        # Each chunk is a new file: concurrent requests never write into the same one.
+        os.makedirs(self._staged_path(upload_id), exist_ok=True)
+        chunk = "{:020d}-{}".format(offset, uuid.uuid4().hex)
+        # Created like stored files (see ``_spool()``), since they can be linked into place.
+        path = self._staged_path(upload_id, chunk)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        with os.fdopen(fd, "wb") as dest:
+            shutil.copyfileobj(file, dest)
+        return chunk
+
+    def open_staged(self, upload_id, chunks):
+        if len(chunks) == 1:
+            return open(self._staged_path(upload_id, chunks[0]), "rb")
+        # Concatenated into a named file, that can be linked when saved (see ``_spool()``).
+        assembled = tempfile.NamedTemporaryFile(dir=self._staged_path(upload_id))
+        try:
+            # Private by default: give it the mode of the staged chunks.
+            mode = os.stat(self._staged_path(upload_id, chunks[0])).st_mode
+            os.fchmod(assembled.fileno(), stat.S_IMODE(mode))
+            for chunk in chunks:
+                with open(self._staged_path(upload_id, chunk), "rb") as src:
+                    copy_file(src, assembled)
+            assembled.flush()
+            assembled.seek(0)
+        except BaseException:
+            assembled.close()
+            raise
+        return assembled
+
+    def discard_staged(self, upload_id, chunks=None):
+        if chunks is None:
+            shutil.rmtree(self._staged_path(upload_id), ignore_errors=True)
+            return
+        for chunk in chunks:
+            self._remove_if_exists(self._staged_path(upload_id, chunk))
+
     def save_file(
         self,
         file,
@@ -51,31 +207,118 @@ class LocalFileStorage(FileStorage):
         randomize=False,
         filename_pattern=None,
         record_id="",
+        replace=False,
+        variant=None,
         **kwargs,
     ):
         filename = self._prepare_filename(filename, randomize, filename_pattern, record_id)
+        if folder:
+            filename = os.path.join(folder, filename)
 
-        dest_folder = os.path.join(self.base_path, folder) if folder else self.base_path
-        if not os.path.exists(dest_folder):
-            os.makedirs(dest_folder)
+        dest_folder, name = os.path.split(self.path(filename))
+        os.makedirs(dest_folder, exist_ok=True)
 
-        filename, path = self._resolve_name(filename, dest_folder)
+        # The content is written to a temporary file next to its destination, and only
+        # gets its final name once complete: readers never see a partial file.
+        tmp_paths = {"": self._tmp_path(dest_folder)}
+        if variant:
+            # Sibling file, served by web servers to clients that accept the encoding
+            # (see ``variant_name()``).
+            tmp_paths[ENCODINGS[variant.encoding]] = self._tmp_path(dest_folder)
+        try:
+            self._spool(file, tmp_paths[""])
+            if variant:
+                self._spool(variant.file, tmp_paths[ENCODINGS[variant.encoding]])
+            if replace:
+                for extension, tmp_path in tmp_paths.items():
+                    os.replace(tmp_path, os.path.join(dest_folder, name + extension))
+            else:
+                name = self._claim_name(tmp_paths, name, dest_folder)
+        finally:
+            for tmp_path in tmp_paths.values():
+                self._remove_if_exists(tmp_path)
 
-        file.seek(0)
-        with open(path, "wb") as dest:
-            shutil.copyfileobj(file, dest)
+        return os.path.join(os.path.dirname(filename), name)
 
-        if folder:
-            filename = os.path.join(folder, filename)
+    @staticmethod
+    def _tmp_path(folder):
+        return os.path.join(folder, ".{}{}".format(uuid.uuid4().hex, TEMP_SUFFIX))
+
+    @staticmethod
+    def _spool(file, tmp_path):
+        """Write the content of *file* at *tmp_path*, avoiding copies when possible."""
+        source = getattr(file, "name", None)
+        if isinstance(source, str) and os.path.isfile(source):
+            # Named file (e.g. staged upload): link it if it is on the same file system.
+            try:
+                os.link(source, tmp_path)
+            except OSError:
+                pass
+            else:
+                os.fsync(file.fileno())
+                return
+
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        with os.fdopen(fd, "wb") as dest:
+            copy_file(file, dest)
+            dest.flush()
+            os.fsync(dest.fileno())
 
-        return filename
+    @staticmethod
+    def _remove_if_exists(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
-    def _resolve_name(self, name, folder):
+    def _claim_name(self, tmp_paths, name, folder):
+        """Give the complete files at *tmp_paths* the first free name derived from *name*,
+        followed by the extensions they are keyed by (e.g. ``""`` for the file, and
+        ``".gz"`` for its compressed variant).
+
+        Names are claimed atomically, so concurrent saves (e.g. from several workers)
+        never overwrite each other, and a name is only kept if it is free for all the
+        files. After a few numbered candidates (``name-1.ext``...), a random suffix is
+        used to avoid probing long chains of collisions.
+        """
         basename, ext = os.path.splitext(name)
-        counter = 0
+        candidates = [name]
+        candidates += ["%s-%d%s" % (basename, i, ext) for i in range(1, NAME_PROBES)]
         while True:
-            path = os.path.join(folder, name)
-            if not os.path.exists(path):
-                return name, path
-            counter += 1
-            name = "%s-%d%s" % (basename, counter, ext)
+            for candidate in candidates:
+                claimed = []
+                for extension, tmp_path in tmp_paths.items():
+                    path = os.path.join(folder, candidate + extension)
+                    if not self._link(tmp_path, path):
+                        break
+                    claimed.append((tmp_path, path))
+                else:
+                    return candidate
+                # Only partially free: release the names claimed so far.
+                for tmp_path, path in claimed:
+                    if os.path.exists(tmp_path):
+                        os.remove(path)
+                    else:
+                        # Moved rather than linked (see ``_link()``).
+                        os.replace(path, tmp_path)
+            candidates = ["%s-%s%s" % (basename, uuid.uuid4().hex[:8], ext)]
+
+    @staticmethod
+    def _link(tmp_path, path):
+        """Create *path* as a link to *tmp_path*, unless it already exists."""
+        try:
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+        # Hard links are not supported by the file system: reserve the name instead,
+        # and atomically replace the empty placeholder.
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        os.replace(tmp_path, path)
+        return True
@@ -0,0 +1,316 @@
+"""Resumable upload sessions.
+
+Large files can be attached in several requests: a session is created, the file
+is sent as successive byte ranges (which can be resumed from the committed offset
+after a failure), and the session is finalized into a regular attachment.
+
+With storage backends that support it, the chunks are assembled server-side when the
+session is finalized, and the result is only read back to be hashed. The session can
+also be *direct*: the client uploads the whole file to a signed URL, and the server only
+reads it back to check its hash.
+"""
+
+import cgi
+import re
+import time
+
+from kinto.core import Service
+from kinto.core.authorization import DYNAMIC as DYNAMIC_PERMISSION
+from kinto.core.errors import ERRORS, http_error
+from kinto.core.storage import Filter, Sort
+from kinto.core.storage import exceptions as storage_exceptions
+from kinto.core.utils import COMPARISON
+from pyramid import httpexceptions
+from webob.byterange import ContentRange
+
+from kinto_attachment import utils, views
+from kinto_attachment.storage import IDirectUploadStorage
+
+
+_UPLOADS_RESOURCE_NAME = "uploads"
+_UPLOADS_PARENT_ID = "__attachment_uploads__"
+# Committed chunks of each session, by zero-padded offset.
+_CHUNKS_RESOURCE_NAME = "chunks"
+
+DEFAULT_UPLOAD_TTL_SECONDS = 24 * 3600
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+_MD5_BASE64_RE = re.compile(r"^[A-Za-z0-9+/]{22}==$")
+
+
+uploads = Service(
+    name="attachment-uploads",
+    description="Create a resumable upload session",
+    path=utils.RECORD_PATH + "/attachment/uploads",
+    factory=utils.AttachmentRouteFactory,
+)
+
+upload = Service(
+    name="attachment-upload",
+    description="Send, finalize or abort a resumable upload",
+    path=utils.RECORD_PATH + "/attachment/uploads/{upload_id}",
+    factory=utils.AttachmentRouteFactory,
+)
+
+
+def _bad_request(message, errno=ERRORS.INVALID_PARAMETERS):
+    return http_error(httpexceptions.HTTPBadRequest(), errno=errno, message=message)
+
+
+def _max_size_bytes(request):
+    return utils.get_policy(request).max_size_bytes
+
+
+def _json_body(request):
+    if not request.body:
+        return {}
+    try:
+        body = request.json
+    except ValueError as e:
+        raise _bad_request("body: invalid JSON (%s)" % e, errno=ERRORS.BADJSON)
+    if not isinstance(body, dict):
+        raise _bad_request("body: should be a JSON object", errno=ERRORS.INVALID_POSTED_DATA)
+    return body
+
+
+def _session_view(session):
+    return {
+        "id": session["id"],
+        "filename": session["filename"],
+        "mimetype": session["mimetype"],
+        "size": session["size"],
+        "offset": session["offset"],
+        "expires": session["expires"],
+        "direct": session.get("direct", False),
+    }
+
+
+def _chunks_parent_id(session):
+    return "{}/{}".format(_UPLOADS_PARENT_ID, session["id"])
+
+
+def _committed_chunks(request, session):
+    """Return the names of the staged chunks committed up to the session offset."""
+    chunks = request.registry.storage.list_all(
+        _CHUNKS_RESOURCE_NAME, _chunks_parent_id(session), sorting=[Sort("id", 1)]
+    )
+    return [chunk["name"] for chunk in chunks if int(chunk["id"]) < session["offset"]]
+
+
+def purge_expired_uploads(request):
+    """Discard the staged content and the sessions of abandoned uploads."""
+    storage = request.registry.storage
+    filters = [Filter("expires", int(time.time()), COMPARISON.LT)]
+    expired = storage.list_all(_UPLOADS_RESOURCE_NAME, _UPLOADS_PARENT_ID, filters=filters)
+    for session in expired:
+        request.attachment.discard_staged(session["id"])
+        storage.delete_all(_CHUNKS_RESOURCE_NAME, _chunks_parent_id(session), with_deleted=False)
+    if expired:
+        storage.delete_all(
+            _UPLOADS_RESOURCE_NAME, _UPLOADS_PARENT_ID, filters=filters, with_deleted=False
+        )
+
+
+def _get_session(request):
+    storage = request.registry.storage
+    upload_id = request.matchdict["upload_id"]
+    try:
+        session = storage.get(_UPLOADS_RESOURCE_NAME, _UPLOADS_PARENT_ID, upload_id)
+    except storage_exceptions.ObjectNotFoundError:
+        session = None
+
+    if session is not None and session["expires"] < time.time():
+        _end_session(request, session)
+        session = None
+
+    if session is None or session["record_uri"] != utils.record_uri(request):
+        raise http_error(
+            httpexceptions.HTTPNotFound(),
+            errno=ERRORS.MISSING_RESOURCE,
+            message="Upload session not found.",
+        )
+    return session
+
+
+def _end_session(request, session):
+    request.attachment.discard_staged(session["id"])
+    request.registry.storage.delete_all(
+        _CHUNKS_RESOURCE_NAME, _chunks_parent_id(session), with_deleted=False
+    )
+    request.registry.storage.delete(
+        _UPLOADS_RESOURCE_NAME, _UPLOADS_PARENT_ID, session["id"], with_deleted=False
+    )
+
+
+@uploads.post(permission=DYNAMIC_PERMISSION)
+def create_upload(request):
+    body = _json_body(request)
+
+    filename = body.get("filename")
+    if not filename or not isinstance(filename, str):
+        raise _bad_request("body: 'filename' is required.", errno=ERRORS.MISSING_PARAMETERS)
+    size = body.get("size")
+    if size is not None and (not isinstance(size, int) or size < 0):
+        raise _bad_request("body: 'size' should be a positive integer.")
+    mimetype = body.get("mimetype") or "application/octet-stream"
+
+    max_size_bytes = _max_size_bytes(request)
+    if size is not None and max_size_bytes > 0 and size > max_size_bytes:
+        views.raise_too_large(max_size_bytes)
+
+    direct = body.get("direct", False)
+    if direct:
+        if not IDirectUploadStorage.providedBy(request.attachment):
+            raise _bad_request("Direct uploads are not supported by the storage backend.")
+        if size is None:
+            raise _bad_request("body: 'size' is required for direct uploads.")
+        if not _SHA256_RE.match(str(body.get("hash"))):
+            raise _bad_request("body: 'hash' should be the SHA-256 hex digest of the file.")
+        if not _MD5_BASE64_RE.match(str(body.get("md5"))):
+            raise _bad_request("body: 'md5' should be the base64 MD5 digest of the file.")
+
+    purge_expired_uploads(request)
+
+    ttl = int(
+        request.registry.settings.get("attachment.upload_ttl_seconds", DEFAULT_UPLOAD_TTL_SECONDS)
+    )
+    session = {
+        "record_uri": utils.record_uri(request),
+        "filename": filename,
+        "mimetype": mimetype,
+        "size": size,
+        "offset": 0,
+        "expires": int(time.time()) + ttl,
+    }
+    if direct:
+        session.update(direct=True, hash=body["hash"], md5=body["md5"])
+    session = request.registry.storage.create(_UPLOADS_RESOURCE_NAME, _UPLOADS_PARENT_ID, session)
+
+    result = _session_view(session)
+    if direct:
+        url, headers = request.attachment.signed_upload_url(
+            session["id"], size=size, md5=session["md5"], content_type=mimetype, expires_in=ttl
+        )
+        result.update(upload_url=url, upload_headers=headers)
+
+    request.response.status = 201
+    return result
+
+
+@upload.get(permission=DYNAMIC_PERMISSION)
+def get_upload(request):
+    return _session_view(_get_session(request))
+
+
+@upload.put(permission=DYNAMIC_PERMISSION)
+def put_upload_chunk(request):
+    """Append the ``Content-Range`` bytes of the request body to the staged upload."""
+    session = _get_session(request)
+    if session.get("direct"):
+        raise _bad_request("Direct uploads are sent to the storage backend.")
+
+    content_range = ContentRange.parse(request.headers.get("Content-Range"))
+    if content_range is None:
+        raise _bad_request("Content-Range header should be 'bytes <start>-<end>/<size|*>'.")
+    start, stop = content_range.start, content_range.stop
+
+    if start != session["offset"]:
+        raise http_error(
+            httpexceptions.HTTPRequestRangeNotSatisfiable(),
+            errno=ERRORS.INVALID_PARAMETERS,
+            message="Chunk should start at offset {}.".format(session["offset"]),
+        )
+    if request.content_length != stop - start:
+        raise _bad_request("Content-Length does not match Content-Range.")
+    if session["size"] is not None and stop > session["size"]:
+        raise _bad_request("Chunk exceeds the declared size ({} bytes).".format(session["size"]))
+    max_size_bytes = _max_size_bytes(request)
+    if max_size_bytes > 0 and stop > max_size_bytes:
+        views.raise_too_large(max_size_bytes)
+
+    chunk = request.attachment.stage(session["id"], start, request.body_file)
+
+    # Commit the chunk, unless another request did it meanwhile for the same offset: the
+    # unicity of ids is enforced by the storage, even between concurrent transactions.
+    committed = {"id": "{:020d}".format(start), "name": chunk, "stop": stop}
+    try:
+        request.registry.storage.create(
+            _CHUNKS_RESOURCE_NAME, _chunks_parent_id(session), committed
+        )
+    except storage_exceptions.UnicityError:
+        request.attachment.discard_staged(session["id"], [chunk])
+        raise http_error(
+            httpexceptions.HTTPConflict(),
+            errno=ERRORS.CONSTRAINT_VIOLATED,
+            message="A chunk was committed at offset {} meanwhile.".format(start),
+        )
+
+    session["offset"] = stop
+    session = request.registry.storage.update(
+        _UPLOADS_RESOURCE_NAME, _UPLOADS_PARENT_ID, session["id"], session
+    )
+    return _session_view(session)
+
+
+@upload.post(permission=DYNAMIC_PERMISSION)
+def finalize_upload(request):
+    """Turn the staged upload into the record attachment.
+
+    The optional JSON body can contain the ``data`` and ``permissions`` of the record.
+    """
+    session = _get_session(request)
+    body = _json_body(request)
+
+    # Direct uploads are checked by the storage backend, from the uploaded object metadata.
+    if not session.get("direct"):
+        if session["offset"] == 0:
+            raise _bad_request("No data was uploaded.")
+        if session["size"] is not None and session["offset"] != session["size"]:
+            raise _bad_request(
+                "Upload is incomplete ({} of {} bytes).".format(session["offset"], session["size"])
+            )
+
+    record = {"data": {}}
+    for field in ("data", "permissions"):
+        if field in body:
+            record[field] = body.pop(field)
+    for field in body.keys():
+        error_msg = "body: %r not in ('data', 'permissions')" % field
+        raise _bad_request(error_msg, errno=ERRORS.INVALID_POSTED_DATA)
+
+    policy = utils.get_policy(request)
+    if session.get("direct"):
+        attachment = views.attach_file(
+            request, views.SINGLE_FILE_FIELD, session, record, save=utils.save_staged_file
+        )
+    elif IDirectUploadStorage.providedBy(request.attachment) and not (
+        policy.compress or policy.deltas
+    ):
+        # Assembled by the backend, and only read back to be hashed. The content is
+        # downloaded to be compressed or patched instead.
+        chunks = _committed_chunks(request, session)
+        filehash, size = request.attachment.assemble_staged(session["id"], chunks)
+        staged = {**session, "hash": filehash, "size": size}
+        attachment = views.attach_file(
+            request, views.SINGLE_FILE_FIELD, staged, record, save=utils.save_staged_file
+        )
+    else:
+        content = cgi.FieldStorage()
+        content.filename = session["filename"]
+        content.type = session["mimetype"]
+        chunks = _committed_chunks(request, session)
+        content.file = request.attachment.open_staged(session["id"], chunks)
+        try:
+            attachment = views.attach_file(request, views.SINGLE_FILE_FIELD, content, record)
+        finally:
+            content.file.close()
+
+    _end_session(request, session)
+    return attachment
+
+
+@upload.delete(permission=DYNAMIC_PERMISSION)
+def abort_upload(request):
+    _end_session(request, _get_session(request))
+    request.response.status = 204
+    request.response.headers.pop("Content-Type", None)
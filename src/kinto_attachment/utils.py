@@ -1,18 +1,35 @@
 import cgi
+import functools
 import hashlib
-import json
 import os
+import tempfile
+from types import MappingProxyType
+from typing import NamedTuple
 
 from kinto.authorization import RouteFactory
 from kinto.core import utils as core_utils
-from kinto.core.errors import raise_invalid
-from kinto.core.storage import Filter
+from kinto.core.errors import ERRORS, http_error, raise_invalid
+from kinto.core.events import ACTIONS
+from kinto.core.storage import exceptions as storage_exceptions
+from kinto.schema_validation import (
+    RefResolutionError,
+    ValidationError,
+    validate_from_bucket_schema_or_400,
+    validate_schema,
+)
+from kinto.views import object_exists_or_404
 from kinto.views.records import Record
 from pyramid import httpexceptions
+from pyramid.authorization import Everyone
+from pyramid.settings import asbool
+from webob.compat import cgi_FieldStorage
+from webob.multidict import MultiDict
+
+from kinto_attachment import compression, outbox
+from kinto_attachment.records import update_unmodified
 
 
-_FILE_LINKS_RESOURCE_NAME = "attachments"
-_FILE_LINKS_PARENT_ID = "__attachments__"
+_PERMISSIONS_FIELD = "__permissions__"
 
 RECORD_PATH = "/buckets/{bucket_id}/collections/{collection_id}/records/{id}"
 
@@ -21,6 +38,11 @@ DEFAULT_MIMETYPES = {
     ".geojson": "application/geojson",
 }
 
+# Size of the chunks read from uploaded files when computing their hash and size.
+HASH_CHUNK_SIZE = 64 * 1024
+# Number of file links removed at once when deleting a bucket or a collection.
+DEFAULT_DELETE_BATCH_SIZE = 1000
+
 _EXTENSION_GROUPS = {
     "documents": tuple("pdf rtf odf ods gnumeric abw doc docx xls xlsx".split()),
     "text": ("txt",),
@@ -61,6 +83,10 @@ def _extension_allowed(filename, extensions):
     return ext.lstrip(".").lower() in extensions
 
 
+# Route of the ``attachment`` service (see :mod:`kinto_attachment.views`).
+_DOWNLOAD_ROUTE = "attachment"
+
+
 class AttachmentRouteFactory(RouteFactory):
     def __init__(self, request):
         """
@@ -70,6 +96,8 @@ class AttachmentRouteFactory(RouteFactory):
         Attachment is not a Kinto resource.
 
         The required permission is:
+        * ``read`` on the related record to download its attachment (only on the
+          ``attachment`` endpoint: upload sessions require the permissions below);
         * ``write`` if the related record exists;
         * ``record:create`` on the related collection otherwise.
         """
@@ -80,12 +108,19 @@ class AttachmentRouteFactory(RouteFactory):
             request.validated.setdefault("header", {})
             request.validated.setdefault("querystring", {})
             resource = Record(request, context=self)
-            resource.object_id = request.matchdict["id"]
-            existing = resource.get()
-        except httpexceptions.HTTPNotFound:
+            object_id = request.matchdict["id"]
+            if not resource.model.id_generator.match(object_id):
+                raise_invalid(request, location="path", description="Invalid object id")
+            existing = resource.model.get_object(object_id)
+        except (httpexceptions.HTTPNotFound, storage_exceptions.ObjectNotFoundError):
             existing = None
 
-        if existing:
+        route = request.matched_route
+        if request.method in ("GET", "HEAD") and route and route.name == _DOWNLOAD_ROUTE:
+            # Readable records (or inherited from their collection and bucket).
+            self.permission_object_id = record_uri(request)
+            self.required_permission = "read"
+        elif existing:
             # Request write permission on the existing record.
             self.permission_object_id = record_uri(request)
             self.required_permission = "write"
@@ -96,8 +131,12 @@ class AttachmentRouteFactory(RouteFactory):
         # Set the current object in context, since it is used in the
         # authorization policy to distinguish operations on plural endpoints
         # from individual objects. See Kinto/kinto#918
+        # It is also reused by :func:`update_record`, to save another storage hit.
         self.current_object = existing
 
+    def get_permission_object_id(self, request, object_id=None):
+        return record_uri(request)
+
 
 def sha256(content):
     m = hashlib.sha256()
@@ -105,6 +144,107 @@ def sha256(content):
     return m.hexdigest()
 
 
+class FileTooLarge(Exception):
+    """Raised by :func:`hash_and_size` when the file exceeds the allowed size."""
+
+    def __init__(self, size, max_size):
+        super().__init__(size, max_size)
+        self.size = size
+        self.max_size = max_size
+
+
+def hash_and_size(fileobj, max_size=None, chunk_size=HASH_CHUNK_SIZE):
+    """Compute the SHA-256 hex digest and the size of *fileobj* by reading it in chunks.
+
+    The file is rewound before and after reading. If *max_size* is a positive integer,
+    reading stops as soon as the running byte count crosses it and :class:`FileTooLarge`
+    is raised.
+    """
+    m = hashlib.sha256()
+    size = 0
+    fileobj.seek(0)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise FileTooLarge(size, max_size)
+        m.update(chunk)
+    fileobj.seek(0)
+    return m.hexdigest(), size
+
+
+class RequestBodyTooLarge(Exception):
+    """Raised while reading a request body that exceeds the admitted size."""
+
+
+class LimitedBodyReader:
+    """Wrap the WSGI input stream and abort as soon as more than *limit* bytes are read."""
+
+    def __init__(self, raw, limit):
+        self.raw = raw
+        self.limit = limit
+        self.consumed = 0
+
+    def _count(self, data):
+        self.consumed += len(data)
+        if self.consumed > self.limit:
+            raise RequestBodyTooLarge()
+        return data
+
+    def read(self, *args):
+        return self._count(self.raw.read(*args))
+
+    def readline(self, *args):
+        return self._count(self.raw.readline(*args))
+
+    def seek(self, *args):
+        position = self.raw.seek(*args)
+        self.consumed = self.raw.tell()
+        return position
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+@functools.cache
+def _spooling_field_storage(spool_path):
+    """Return a multipart parser that spools the posted files in *spool_path*."""
+
+    class SpoolingFieldStorage(cgi_FieldStorage):
+        def make_file(self):
+            if self._binary_file or self.length >= 0:
+                return tempfile.TemporaryFile("wb+", dir=spool_path)
+            return tempfile.TemporaryFile(
+                "w+", encoding=self.encoding, newline="\n", dir=spool_path
+            )
+
+    return SpoolingFieldStorage
+
+
+def parse_post(request):
+    """Return the fields of the multipart body, like ``request.POST``.
+
+    The body is parsed as it is read, and the posted files are spooled in the
+    ``spool_path`` of the storage backend (default: the system temporary directory).
+    """
+    parsed = request.environ.get("webob._parsed_post_vars")
+    if parsed is not None and parsed[1] is request.body_file_raw:
+        return parsed[0]
+
+    environ = {**request.environ, "QUERY_STRING": ""}
+    environ.setdefault("CONTENT_LENGTH", "0")
+    field_storage = _spooling_field_storage(request.attachment.spool_path)
+    fields = field_storage(
+        fp=request.body_file, environ=environ, keep_blank_values=True, encoding="utf8"
+    )
+    post = MultiDict.from_fieldstorage(fields)
+    # Returned by ``request.POST`` from now on.
+    request.environ["webob._parsed_post_vars"] = (post, request.body_file_raw)
+    return post
+
+
 def _object_uri(request, resource_name, matchdict, prefix):
     uri = core_utils.instance_uri(request, resource_name=resource_name, **matchdict)
     if prefix:
@@ -128,110 +268,400 @@ def record_uri(request, prefix=False):
     return _object_uri(request, "record", request.matchdict, prefix)
 
 
-def patch_record(record, request):
-    # XXX: add util clone_request()
-    backup_pattern = request.matched_route.pattern
-    backup_body = request.body
-    backup_validated = request.validated
+def metric_labels(request, uri=None):
+    """Return the ``bucket_id`` and ``collection_id`` labels of the metrics about the
+    object at *uri* (default: the one of the request), empty above collections.
+    """
+    if uri is None:
+        ids = [request.matchdict.get("bucket_id", ""), request.matchdict.get("collection_id", "")]
+    else:
+        # "/buckets/b/collections/c/records/r" -> ["b", "c", "r"]
+        ids = uri.split("/")[2::2] + ["", ""]
+    return [("bucket_id", ids[0]), ("collection_id", ids[1])]
+
+
+def phase_timer(request, phase, uri=None):
+    """Time a *phase* of the attachment pipeline (e.g. ``hash``, ``backend``...)."""
+    labels = [("phase", phase)] + metric_labels(request, uri)
+    return request.registry.metrics.timer("attachments.phase.seconds", labels=labels)
+
+
+def observe_bytes(request, action, size, uri=None):
+    """Count the bytes of an ``uploaded`` or ``deleted`` file, and observe its size."""
+    labels = metric_labels(request, uri)
+    request.registry.metrics.count("attachments.%s_bytes" % action, count=size, unique=labels)
+    request.registry.metrics.observe("attachments.%s_size_bytes" % action, size, labels=labels)
 
-    # Instantiate record resource with current request.
-    context = RouteFactory(request)
-    context.resource_name = "record"
-    context.get_permission_object_id = lambda r, i: record_uri(r)
-    record_pattern = request.matched_route.pattern.replace("/attachment", "")
-    request.matched_route.pattern = record_pattern
 
-    # Simulate update of fields.
-    request.validated = dict(body=record, **backup_validated)
+def update_record(request, record, context=None, validate=True, checked=False):
+    """Apply the *record* ``data`` and ``permissions`` to the current record, or create it.
+
+    The record fetched by the :class:`AttachmentRouteFactory` *context* (default: the
+    one of the request) is updated directly in storage, and a ``ResourceChanged`` event
+    is emitted like with a regular record update.
+
+    The record is validated against the collection and bucket schemas on creation, or
+    if *validate* is ``True`` (i.e. when the changes are not only produced by the plugin),
+    unless it was *checked* already with :func:`check_record`.
+
+    :raises: :class:`pyramid.httpexceptions.HTTPPreconditionFailed` if the record was
+        created, changed or deleted since the *context* fetched it.
+    """
+    context = context or request.context
+    storage = request.registry.storage
+    parent_id = collection_uri(request)
+    object_id = request.matchdict["id"]
+
+    old, new = _merge_record(request, record, context)
+
+    if not checked and (validate or old is None):
+        _validate_record(request, new)
+
+    if old is not None:
+        # The changes are merged into the record fetched by the route factory: it must
+        # not have been changed or deleted since (``storage.update()`` would recreate it).
+        stored = update_unmodified(
+            storage, "record", parent_id, object_id, new, old["last_modified"]
+        )
+        if stored is None:
+            raise _modified_meanwhile()
+        action = ACTIONS.UPDATE
+    else:
+        try:
+            stored = storage.create("record", parent_id, new)
+        except storage_exceptions.UnicityError:
+            # Created by another request since it was looked up.
+            raise _modified_meanwhile()
+        action = ACTIONS.CREATE
+        request.response.status_code = 201
+
+    perm_object_id = record_uri(request)
+    permission = request.registry.permission
+    permission.replace_object_permissions(perm_object_id, record.get("permissions") or {})
+    if asbool(request.registry.settings["explicit_permissions"]):
+        principal = request.prefixed_userid or Everyone
+        permission.add_principal_to_ace(perm_object_id, "write", principal)
 
-    request.body = json.dumps(record).encode("utf-8")
-    resource = Record(request, context=context)
-    resource.object_id = request.matchdict["id"]
     setattr(request, "_attachment_auto_save", True)  # Flag in update listener.
+    request.notify_resource_event(
+        parent_id=parent_id,
+        timestamp=stored["last_modified"],
+        data=stored,
+        action=action,
+        old=old,
+        resource_name="record",
+        resource_data=dict(request.matchdict),
+    )
+    return stored
 
-    try:
-        saved = resource.patch()
-    except httpexceptions.HTTPNotFound:
-        saved = resource.put()
 
-    request.matched_route.pattern = backup_pattern
-    request.body = backup_body
-    request.validated = backup_validated
-    return saved
+def _modified_meanwhile():
+    return http_error(
+        httpexceptions.HTTPPreconditionFailed(),
+        errno=ERRORS.MODIFIED_MEANWHILE,
+        message="Resource was modified meanwhile",
+    )
+
+
+def _merge_record(request, record, context):
+    """:returns: the current record of *context* (without permissions), and the one
+    resulting from the *record* changes."""
+    existing = context.current_object
+    old = None
+    if existing is not None:
+        old = {k: v for k, v in existing.items() if k != _PERMISSIONS_FIELD}
+    new = {**(old or {}), **record["data"], "id": request.matchdict["id"]}
+    if not isinstance(record["data"].get("last_modified"), int):
+        # Let the storage bump the timestamp.
+        new.pop("last_modified", None)
+    return old, new
+
+
+def check_record(request, record, context, file_field):
+    """Validate the record that :func:`update_record` would store, before its file in
+    *file_field* is known (e.g. before storing it).
+    """
+    old, new = _merge_record(request, record, context)
+    if record["data"] or old is None:
+        _validate_record(request, new, ignore_fields=(file_field,))
+
+
+def _validate_record(request, new, ignore_fields=()):
+    """Validate the record like :meth:`kinto.views.records.Record.process_object`."""
+    settings = request.registry.settings
+    if not asbool(settings.get("experimental_collection_schema_validation")):
+        return
+
+    ignored_fields = ("last_modified", "schema", _PERMISSIONS_FIELD) + tuple(ignore_fields)
+
+    # The parent collection was fetched by the route factory.
+    collections = request.bound_data.setdefault("collections", {})
+    uri = collection_uri(request)
+    if uri not in collections:
+        collections[uri] = object_exists_or_404(
+            request,
+            resource_name="collection",
+            parent_id=bucket_uri(request),
+            object_id=request.matchdict["collection_id"],
+        )
+    collection = collections[uri]
+
+    if "schema" in collection:
+        try:
+            validate_schema(new, collection["schema"], ignore_fields=ignored_fields, id_field="id")
+        except ValidationError as e:
+            raise_invalid(request, name=e.field, description=e.message)
+        except RefResolutionError as e:
+            raise_invalid(request, name="schema", description=str(e))
+        # Assign the schema version to the record.
+        new["schema"] = collection["last_modified"]
+
+    validate_from_bucket_schema_or_400(
+        new, resource_name="record", request=request, ignore_fields=ignored_fields, id_field="id"
+    )
 
 
 def delete_attachment(request, link_field=None, uri=None, keep_old_files=False):
-    """Delete existing file and link."""
+    """Delete existing files and links.
+
+    Links are processed in pages of ``delete_batch_size``, so that removing a bucket or
+    a collection with many attachments runs with bounded memory, and files are deleted
+    from the backend a batch at a time.
+
+    Deduplicated files (see ``deduplicate`` setting) are shared between links, and are
+    only removed when the last link referencing them is deleted.
+
+    :returns: the number of deleted links.
+    """
     if link_field is None:
         link_field = "record_uri"
     if uri is None:
         uri = record_uri(request)
 
-    storage = request.registry.storage
-    filters = [Filter(link_field, uri, core_utils.COMPARISON.EQ)]
+    batch_size = get_policy(request).delete_batch_size
 
-    # Remove file.
-    if not keep_old_files:
-        file_links = storage.list_all(
-            _FILE_LINKS_RESOURCE_NAME, _FILE_LINKS_PARENT_ID, filters=filters
-        )
-        for link in file_links:
-            request.attachment.delete(link["location"])
+    deleted = 0
+    while True:
+        with phase_timer(request, "list_links", uri):
+            links = request.registry.attachment_links.list(link_field, [uri], limit=batch_size)
+        delete_links(request, links, keep_old_files=keep_old_files, uri=uri)
+        request.registry.metrics.count("attachments.deleted_links", count=len(links))
+        deleted += len(links)
+        if len(links) < batch_size:
+            break
+    return deleted
 
-    # Remove link.
-    storage.delete_all(
-        _FILE_LINKS_RESOURCE_NAME, _FILE_LINKS_PARENT_ID, filters=filters, with_deleted=False
-    )
 
+def list_links(request, record_uris):
+    """Return the file links of all the records in *record_uris*, in a single query."""
+    return request.registry.attachment_links.list("record_uri", record_uris)
 
-def save_file(request, content, folder=None, keep_link=True, replace=False):
-    randomize = setting_value(request, "randomize", default=True)
-    filename_pattern = setting_value(request, "filename_pattern", default=None)
-    record_id = request.matchdict.get("id", "")
 
-    overriden_mimetypes = {**DEFAULT_MIMETYPES}
-    conf_mimetypes = setting_value(request, "mimetypes", default="")
-    if conf_mimetypes:
-        overriden_mimetypes.update(dict([v.split(":") for v in conf_mimetypes.split(";")]))
+def delete_links(request, links, keep_old_files=False, uri=None):
+    """Delete the given file *links* (see :func:`list_links`) and their files.
 
+    *uri* is the object whose links are deleted, for the metrics labels.
+    """
+    if not links:
+        return
+    with phase_timer(request, "unlink", uri):
+        request.registry.attachment_links.delete(links)
+    if not keep_old_files:
+        with phase_timer(request, "delete_files", uri):
+            _delete_files(request, links)
+
+
+def _delete_files(request, file_links):
+    """Delete the files of the removed *file_links*, unless still referenced."""
+    shared_locations = set()
+    # Content hash of the files to delete, by location.
+    locations = {}
+    for link in file_links:
+        location = link["location"]
+        if link.get("content_hash"):
+            if location in shared_locations:
+                continue
+            shared_locations.add(location)
+            # Not reused by another request until the deletion is committed.
+            request.registry.attachment_links.lock(link["content_hash"])
+            if request.registry.attachment_links.count(location) > 0:
+                continue
+        locations[location] = link.get("content_hash")
+
+    if not locations:
+        return
+    if get_policy(request).deletion_outbox:
+        # Deleted later by the worker, once the transaction is committed.
+        for location, content_hash in locations.items():
+            outbox.enqueue_deletion(request, location, content_hash)
+    else:
+        request.attachment.delete_many(list(locations))
+        request.registry.metrics.count("attachments.deleted_files", count=len(locations))
+
+
+def _check_file(request, filename, content_type):
+    """Validate the extension of *filename* and return its mimetype."""
+    policy = get_policy(request)
+    if not _extension_allowed(filename, policy.extensions):
+        raise_invalid(request, location="body", description="File extension is not allowed.")
+
+    _, extension = os.path.splitext(filename)
+    return policy.mimetypes.get(extension, content_type)
+
+
+def save_file(request, content, folder=None, keep_link=True, replace=False):
     # Read file to compute hash.
     if not isinstance(content, cgi.FieldStorage):
         error_msg = "Filename is required."
         raise_invalid(request, location="body", description=error_msg)
 
     # Posted file attributes.
-    content.file.seek(0)
-    filecontent = content.file.read()
-    filehash = sha256(filecontent)
-    size = len(filecontent)
+    try:
+        with phase_timer(request, "hash"):
+            filehash, size = hash_and_size(
+                content.file, max_size=get_policy(request).max_size_bytes
+            )
+    except FileTooLarge as e:
+        error_msg = "File size (at least {} bytes) exceeds the limit ({} bytes).".format(
+            e.size, e.max_size
+        )
+        raise_invalid(request, location="body", description=error_msg)
     filename = content.filename
 
-    max_size_raw = setting_value(request, "max_size_bytes", default=None)
-    if max_size_raw is not None:
-        max_size_bytes = int(max_size_raw)
-        if max_size_bytes > 0 and size > max_size_bytes:
-            error_msg = "File size ({} bytes) exceeds the limit ({} bytes).".format(
-                size, max_size_bytes
+    mimetype = _check_file(request, filename, content.type)
+
+    encoding = get_policy(request).compress
+    variant = None
+    compress_later = None
+    offload_min_size = int(
+        request.registry.settings.get("attachment.compress_offload_min_size_bytes", 0)
+    )
+    if encoding and compression.is_compressible(mimetype):
+        if keep_link and 0 < offload_min_size <= size:
+            # Stored uncompressed, and compressed later by the worker.
+            compress_later = encoding
+        else:
+            with phase_timer(request, "compress"):
+                variant = compression.compress(
+                    content.file, size, encoding, spool_path=request.attachment.spool_path
+                )
+            if variant.size >= size:
+                # Not worth it.
+                variant.file.close()
+                variant = None
+
+    def store(**save_options):
+        if variant:
+            save_options["variant"] = variant
+        return request.attachment.save(content, **save_options)
+
+    try:
+        return _store_file(
+            request,
+            store,
+            filename,
+            filehash,
+            size,
+            mimetype,
+            folder,
+            keep_link,
+            replace,
+            variant,
+            compress_later=compress_later,
+        )
+    finally:
+        if variant:
+            variant.file.close()
+
+
+def save_staged_file(request, upload, folder=None):
+    """Attach the file staged in the storage backend for the *upload* session.
+
+    The staged file is moved into place by the backend, without going through the
+    server. Its SHA-256 hash is the one of the stored content, read back from the backend
+    (see :meth:`~kinto_attachment.storage.IDirectUploadStorage.assemble_staged` and
+    :meth:`~kinto_attachment.storage.IDirectUploadStorage.check_staged`). Files uploaded
+    directly must also match the declared size, MD5 checksum and hash. Since they can be
+    replaced through their signed URL until moved into place, they are never
+    deduplicated (see :func:`_store_file`).
+    """
+    mimetype = _check_file(request, upload["filename"], upload["mimetype"])
+
+    direct = upload.get("direct", False)
+    if direct:
+        try:
+            filehash = request.attachment.check_staged(
+                upload["id"], size=upload["size"], md5=upload["md5"]
             )
+        except ValueError as e:
+            raise_invalid(request, location="body", description=str(e))
+        if filehash != upload["hash"]:
+            error_msg = "Uploaded file does not match the declared hash."
             raise_invalid(request, location="body", description=error_msg)
 
-    extensions = resolve_extensions(setting_value(request, "extensions", default="default"))
-    if not _extension_allowed(filename, extensions):
-        raise_invalid(request, location="body", description="File extension is not allowed.")
+    def store(filename=None, **save_options):
+        return request.attachment.commit_staged(
+            upload["id"], filename or upload["filename"], **save_options
+        )
 
-    _, extension = os.path.splitext(filename)
-    mimetype = overriden_mimetypes.get(extension, content.type)
+    return _store_file(
+        request,
+        store,
+        upload["filename"],
+        upload["hash"],
+        upload["size"],
+        mimetype,
+        folder,
+        content_addressable=not direct,
+    )
+
+
+def _store_file(
+    request,
+    store,
+    filename,
+    filehash,
+    size,
+    mimetype,
+    folder,
+    keep_link=True,
+    replace=False,
+    variant=None,
+    content_addressable=True,
+    compress_later=None,
+):
+    policy = get_policy(request)
+    # Files without link cannot be reference counted, and are never deduplicated.
+    # Content addresses are only given to files whose content cannot change anymore.
+    deduplicate = keep_link and content_addressable and policy.deduplicate
+    record_id = request.matchdict.get("id", "")
 
     save_options = {
         "folder": folder,
-        "randomize": randomize,
-        "filename_pattern": filename_pattern,
+        # The other files cannot take the name of a content address.
+        "randomize": policy.randomize or (policy.deduplicate and not content_addressable),
+        "filename_pattern": policy.filename_pattern,
         "record_id": record_id,
         "replace": replace,
         "headers": {"Content-Type": mimetype},
     }
 
-    location = request.attachment.save(content, **save_options)
+    if deduplicate:
+        # Content-addressed name: identical uploads share the same stored file. The
+        # encoding is part of the address, since the stored bytes depend on it.
+        _, extension = os.path.splitext(filename)
+        encoding = "-" + variant.encoding if variant else ""
+        stored_name = filehash + encoding + extension.lower()
+        location = "/".join(p for p in (folder, request.attachment.key_for(stored_name)) if p)
+        # Not deleted by another request until the link to it is committed.
+        request.registry.attachment_links.lock(filehash)
+        if not request.attachment.exists(location):
+            save_options.update(randomize=False, filename_pattern=None, content_addressed=True)
+            with phase_timer(request, "backend"):
+                location = store(filename=stored_name, **save_options)
+    else:
+        with phase_timer(request, "backend"):
+            location = store(**save_options)
 
     # File metadata.
     fullurl = request.attachment.url(location)
@@ -242,31 +672,180 @@ def save_file(request, content, folder=None, keep_link=True, replace=False):
         "mimetype": mimetype,
         "size": size,
     }
+    locations = [location]
+    if variant:
+        # Served instead of the file to the clients that accept its encoding.
+        variant_location = request.attachment.variant_name(location, variant.encoding)
+        if variant_location != location:
+            # Separate file, removed along with the file.
+            locations.append(variant_location)
+        attachment["compressed"] = {
+            "content_encoding": variant.encoding,
+            "hash": variant.hash,
+            "location": request.attachment.url(variant_location),
+            "size": variant.size,
+        }
 
     if keep_link:
-        # Store link between record and attachment (for later deletion).
-        request.registry.storage.create(
-            _FILE_LINKS_RESOURCE_NAME,
-            _FILE_LINKS_PARENT_ID,
-            {
-                "location": location,  # store relative location.
-                "bucket_uri": bucket_uri(request),
-                "collection_uri": collection_uri(request),
-                "record_uri": record_uri(request),
-            },
-        )
+        # Flag shared files, whose deletion depends on the remaining references.
+        with phase_timer(request, "link"):
+            for stored in locations:
+                link_file(request, stored, content_hash=filehash if deduplicate else None)
+        # Heartbeat files are saved without link, and are not counted.
+        observe_bytes(request, "uploaded", attachment["size"])
+        if compress_later:
+            outbox.enqueue_compression(request, location, filehash, compress_later)
 
     return attachment
 
 
-def setting_value(request, name, default):
-    value = request.registry.settings.get("attachment.{}".format(name), default)
-    if "bucket_id" in request.matchdict:
-        uri = "/buckets/{bucket_id}".format(**request.matchdict)
-        if uri in request.registry.attachment_resources:
-            value = request.registry.attachment_resources[uri].get(name, value)
-        if "collection_id" in request.matchdict:
-            uri = "/buckets/{bucket_id}/collections/{collection_id}".format(**request.matchdict)
-            if uri in request.registry.attachment_resources:
-                value = request.registry.attachment_resources[uri].get(name, value)
-    return value
+def attach_variant(request, record, location, file, variant):
+    """Replace the uncompressed attachment of *record*, stored at *location*, with its
+    compressed *variant*.
+
+    The variant is stored as a new file (along with the uncompressed *file* with the
+    local storage), and is only advertised once written: the record is updated if it
+    was not changed meanwhile, and the previous file is then removed. A
+    ``ResourceChanged`` event is emitted like with a regular record update.
+
+    :returns: the updated record, or ``None`` if it was changed meanwhile.
+    """
+    policy = get_policy(request)
+    attachment = record["attachment"]
+    folder = policy.folder.format(**request.matchdict) or None
+
+    def store(filename=None, **save_options):
+        filename = filename or attachment["filename"]
+        return request.attachment.save_file(file, filename, variant=variant, **save_options)
+
+    stored = _store_file(
+        request,
+        store,
+        attachment["filename"],
+        attachment["hash"],
+        attachment["size"],
+        attachment["mimetype"],
+        folder,
+        variant=variant,
+    )
+
+    parent_id = collection_uri(request)
+    new = {**record, "attachment": {**attachment, **stored}}
+    updated = update_unmodified(
+        request.registry.storage, "record", parent_id, record["id"], new, record["last_modified"]
+    )
+
+    links = list_links(request, [record_uri(request)])
+    if updated is None:
+        # Changed meanwhile: drop the variant.
+        urls = {stored["location"], stored["compressed"]["location"]}
+        delete_links(
+            request, [link for link in links if request.attachment.url(link["location"]) in urls]
+        )
+        return None
+
+    old_links = [link for link in links if link["location"] == location]
+    delete_links(request, old_links, keep_old_files=policy.keep_old_files)
+    if old_links and not policy.keep_old_files:
+        observe_bytes(request, "deleted", attachment["size"])
+
+    setattr(request, "_attachment_auto_save", True)  # Flag in update listener.
+    request.notify_resource_event(
+        parent_id=parent_id,
+        timestamp=updated["last_modified"],
+        data=updated,
+        action=ACTIONS.UPDATE,
+        old=record,
+        resource_name="record",
+        resource_data=dict(request.matchdict),
+    )
+    return updated
+
+
+def link_file(request, location, content_hash=None):
+    """Store the link between the record of the request and the file at *location*,
+    for its later deletion."""
+    link = {
+        "location": location,  # store relative location.
+        "bucket_uri": bucket_uri(request),
+        "collection_uri": collection_uri(request),
+        "record_uri": record_uri(request),
+    }
+    if content_hash:
+        link["content_hash"] = content_hash
+    request.registry.attachment_links.create(link)
+
+
+class AttachmentPolicy(NamedTuple):
+    """Attachment settings in effect for a bucket or a collection.
+
+    Policies are resolved once at startup by :func:`compile_policies`, and looked up
+    for each request with :func:`get_policy`.
+    """
+
+    randomize: bool
+    keep_old_files: bool
+    deduplicate: bool
+    deletion_outbox: bool
+    delete_batch_size: int
+    filename_pattern: str
+    max_size_bytes: int
+    folder: str
+    extensions: frozenset
+    mimetypes: MappingProxyType
+    compress: str
+    deltas: str
+
+
+def _parse_mimetypes(value):
+    overriden_mimetypes = {**DEFAULT_MIMETYPES}
+    if value:
+        overriden_mimetypes.update(dict([v.split(":") for v in value.split(";")]))
+    return MappingProxyType(overriden_mimetypes)
+
+
+def compile_policies(settings, attachment_resources):
+    """Resolve the global settings and the per-resource overrides into policies.
+
+    :returns: a dict of :class:`AttachmentPolicy`, keyed by ``(bucket_id, collection_id)``,
+        ``(bucket_id, None)`` for buckets, and ``(None, None)`` for the global policy.
+    """
+    max_size_raw = settings.get("attachment.max_size_bytes")
+    base = AttachmentPolicy(
+        randomize=asbool(settings.get("attachment.randomize", True)),
+        keep_old_files=asbool(settings.get("attachment.keep_old_files", False)),
+        deduplicate=asbool(settings.get("attachment.deduplicate", False)),
+        deletion_outbox=asbool(settings.get("attachment.deletion_outbox", False)),
+        delete_batch_size=int(
+            settings.get("attachment.delete_batch_size", DEFAULT_DELETE_BATCH_SIZE)
+        ),
+        filename_pattern=settings.get("attachment.filename_pattern"),
+        max_size_bytes=int(max_size_raw) if max_size_raw is not None else 0,
+        folder=settings.get("attachment.folder", ""),
+        extensions=frozenset(resolve_extensions(settings.get("attachment.extensions", "default"))),
+        mimetypes=_parse_mimetypes(settings.get("attachment.mimetypes", "")),
+        compress=settings.get("attachment.compress") or None,
+        deltas=settings.get("attachment.deltas") or None,
+    )
+    policies = {(None, None): base}
+
+    # Buckets first, since collections inherit their bucket overrides.
+    for uri in sorted(attachment_resources, key=lambda u: u.count("/")):
+        parts = uri.split("/")
+        bucket_id = parts[2]
+        collection_id = parts[4] if len(parts) > 4 else None
+        parent = policies.get((bucket_id, None), base)
+        policies[(bucket_id, collection_id)] = parent._replace(**attachment_resources[uri])
+    return policies
+
+
+def get_policy(request):
+    """Return the :class:`AttachmentPolicy` of the bucket or collection of the request."""
+    policies = request.registry.attachment_policies
+    bucket_id = request.matchdict.get("bucket_id")
+    collection_id = request.matchdict.get("collection_id")
+    return (
+        policies.get((bucket_id, collection_id))
+        or policies.get((bucket_id, None))
+        or policies[(None, None)]
+    )
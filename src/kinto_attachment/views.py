@@ -1,5 +1,7 @@
 import cgi
 import json
+import threading
+import time
 from io import BytesIO
 
 from kinto.core import Service, logger
@@ -8,13 +10,17 @@ from kinto.core.errors import ERRORS, http_error
 from pyramid import httpexceptions
 from pyramid.settings import asbool
 
-from kinto_attachment import utils
+from kinto_attachment import deltas, utils
 
 
 HEARTBEAT_CONTENT = '{"test": "write"}'
 HEARTBEAT_FILENAME = "heartbeat"
 HEARTBEAT_FOLDER = "heartbeat-test"
+HEARTBEAT_MODES = ("write", "probe")
 SINGLE_FILE_FIELD = "attachment"
+# Allowance for multipart boundaries, part headers and the ``data``/``permissions`` fields
+# when comparing the request body size with ``max_size_bytes``.
+DEFAULT_MAX_SIZE_OVERHEAD_BYTES = 64 * 1024
 
 
 attachment = Service(
@@ -30,16 +36,55 @@ def attachment_post(request):
     return post_attachment_view(request, SINGLE_FILE_FIELD)
 
 
+@attachment.get(permission=DYNAMIC_PERMISSION)
+def attachment_get(request):
+    return get_attachment_view(request, SINGLE_FILE_FIELD)
+
+
 @attachment.delete(permission=DYNAMIC_PERMISSION)
 def attachment_delete(request):
     return delete_attachment_view(request, SINGLE_FILE_FIELD)
 
 
-def post_attachment_view(request, file_field):
-    keep_old_files = asbool(utils.setting_value(request, "keep_old_files", default=False))
+def raise_too_large(max_size_bytes):
+    raise http_error(
+        httpexceptions.HTTPRequestEntityTooLarge(),
+        errno=ERRORS.REQUEST_TOO_LARGE,
+        message="Request body exceeds the attachment size limit ({} bytes).".format(
+            max_size_bytes
+        ),
+    )
 
-    # Remove potential existing attachment.
-    utils.delete_attachment(request, keep_old_files=keep_old_files)
+
+def check_request_body_size(request, max_files=1):
+    """Reject the upload before parsing the multipart body if it cannot fit the
+    ``max_size_bytes`` limit of the target bucket or collection, for *max_files* files.
+
+    The ``Content-Length`` is checked upfront, and the input stream is wrapped so that
+    reading stops as soon as the limit is crossed (missing or lying ``Content-Length``).
+
+    :returns: the ``max_size_bytes`` value in effect (``0`` means no limit).
+    """
+    max_size_bytes = utils.get_policy(request).max_size_bytes
+    if max_size_bytes <= 0:
+        return max_size_bytes
+
+    overhead = int(
+        request.registry.settings.get(
+            "attachment.max_size_overhead_bytes", DEFAULT_MAX_SIZE_OVERHEAD_BYTES
+        )
+    )
+    body_limit = (max_size_bytes + overhead) * max_files
+
+    if request.content_length is not None and request.content_length > body_limit:
+        raise_too_large(max_size_bytes)
+
+    request.body_file_raw = utils.LimitedBodyReader(request.body_file_raw, body_limit)
+    return max_size_bytes
+
+
+def post_attachment_view(request, file_field):
+    max_size_bytes = check_request_body_size(request)
 
     if "multipart/form-data" not in request.headers.get("Content-Type", ""):
         raise http_error(
@@ -48,9 +93,12 @@ def post_attachment_view(request, file_field):
             message="Content-Type should be multipart/form-data",
         )
 
-    # Store file locally.
+    # Parse the multipart body (spooled to disk for large files).
     try:
-        content = request.POST.get(file_field)
+        with utils.phase_timer(request, "parse"):
+            content = utils.parse_post(request).get(file_field)
+    except utils.RequestBodyTooLarge:
+        raise_too_large(max_size_bytes)
     except ValueError as e:
         raise http_error(
             httpexceptions.HTTPBadRequest(), errno=ERRORS.INVALID_PARAMETERS.value, message=str(e)
@@ -63,12 +111,8 @@ def post_attachment_view(request, file_field):
             message="Attachment missing.",
         )
 
-    folder_pattern = utils.setting_value(request, "folder", default="")
-    folder = folder_pattern.format(**request.matchdict) or None
-    attachment = utils.save_file(request, content, folder=folder)
-
-    # Update related record.
-    posted_data = {k: v for k, v in request.POST.items() if k != file_field}
+    # Record fields posted along the file.
+    posted_data = {k: v for k, v in utils.parse_post(request).items() if k != file_field}
     record = {"data": {}}
     for field in ("data", "permissions"):
         if field in posted_data:
@@ -95,40 +139,177 @@ def post_attachment_view(request, file_field):
             httpexceptions.HTTPBadRequest(), errno=ERRORS.INVALID_POSTED_DATA, message=error_msg
         )
 
+    return attach_file(request, file_field, content, record)
+
+
+def attach_file(request, file_field, content, record, save=utils.save_file):
+    """Store the *content* file, replacing any previous attachment, and set its metadata
+    in the *file_field* of the related record, along with the optional ``data`` and
+    ``permissions`` of *record*.
+
+    *save* is the function storing *content* (see :func:`utils.save_file`).
+    """
+    policy = utils.get_policy(request)
+
+    # Copy the current version before it is removed, to compute a patch from it.
+    with deltas.previous_version(request, file_field, content) as previous:
+        # Remove potential existing attachment.
+        delete_previous(request, file_field, keep_old_files=policy.keep_old_files)
+
+        folder = policy.folder.format(**request.matchdict) or None
+        attachment = save(request, content, folder=folder)
+        if previous:
+            with utils.phase_timer(request, "delta"):
+                deltas.attach_delta(request, attachment, previous, content, folder)
+
+    # Update related record (posted fields are validated).
+    validate = bool(record["data"])
     record["data"][file_field] = attachment
 
-    utils.patch_record(record, request)
+    with utils.phase_timer(request, "record"):
+        utils.update_record(request, record, validate=validate)
 
     # Return attachment data (with location header)
     request.response.headers["Location"] = utils.record_uri(request, prefix=True)
     return attachment
 
 
-def delete_attachment_view(request, file_field):
-    keep_old_files = asbool(utils.setting_value(request, "keep_old_files", default=False))
+def get_attachment_view(request, file_field):
+    """Deliver the file of *file_field*, without reading it in the application.
 
+    The hash of the file is its ``ETag``: a strong one, unless the file has a compressed
+    version, that the front web server or the store can serve instead of the file to the
+    clients that accept its encoding (``Vary: Accept-Encoding``). The content is served by
+    the front web server (``X-Accel-Redirect`` or ``X-Sendfile``), or by the location the
+    client is redirected to, which also handle ``Range`` requests.
+    """
+    existing = request.context.current_object or {}
+    attachment = existing.get(file_field)
+    if not attachment:
+        raise http_error(
+            httpexceptions.HTTPNotFound(),
+            errno=ERRORS.MISSING_RESOURCE,
+            message="Attachment not found.",
+        )
+
+    response = request.response
+    compressed = "compressed" in attachment
+    response.etag = (attachment["hash"], not compressed)
+    if compressed:
+        response.vary = ("Accept-Encoding",)
+    response.headers.pop("Content-Type", None)
+    if attachment["hash"] in request.if_none_match:
+        response.status = 304
+        return response
+
+    base_url = request.attachment.base_url
+    location = attachment["location"]
+    if location.startswith(base_url):
+        headers = request.attachment.delivery_headers(location[len(base_url) :])
+    else:
+        # Stored under a previous base URL.
+        headers = {"Location": location}
+    response.headers.update(headers)
+    if "Location" in headers:
+        response.status = 307
+    else:
+        response.content_type = attachment["mimetype"]
+        response.headers["Accept-Ranges"] = "bytes"
+    return response
+
+
+def delete_previous(request, file_field, keep_old_files=False):
+    """Delete the files of the record, and count the bytes of its *file_field*."""
     utils.delete_attachment(request, keep_old_files=keep_old_files)
+    existing = request.context.current_object or {}
+    previous = existing.get(file_field)
+    if previous and not keep_old_files:
+        utils.observe_bytes(request, "deleted", previous["size"])
+
+
+def delete_attachment_view(request, file_field):
+    keep_old_files = utils.get_policy(request).keep_old_files
+
+    delete_previous(request, file_field, keep_old_files=keep_old_files)
 
     # Remove metadata.
     record = {"data": {}}
     record["data"][file_field] = None
-    utils.patch_record(record, request)
+    with utils.phase_timer(request, "record"):
+        utils.update_record(request, record, validate=False)
 
     request.response.status = 204
     request.response.headers.pop("Content-Type", None)
 
 
+class HeartbeatState:
+    """Last heartbeat result of the process, shared by concurrent pings."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.status = None
+        self.expiration = 0
+        self.last_write_check = None
+
+
 def attachments_ping(request):
     """Heartbeat view for the attachments backend.
-    :returns: ``True`` if succeeds to write and delete, ``False`` otherwise.
+
+    With ``heartbeat_ttl``, the result is reused for this number of seconds, and
+    concurrent pings wait for the running check instead of starting their own.
+
+    :returns: ``True`` if the backend is healthy, ``False`` otherwise.
     """
     # Do nothing if server is readonly.
     if asbool(request.registry.settings.get("readonly", False)):
         return True
 
+    ttl = float(request.registry.settings.get("attachment.heartbeat_ttl", 0))
+    if ttl <= 0:
+        return check_storage(request)
+
+    state = request.registry.attachment_heartbeat
+    with state.lock:
+        now = time.monotonic()
+        if state.status is None or now >= state.expiration:
+            state.status = check_storage(request)
+            state.expiration = now + ttl
+        return state.status
+
+
+def check_storage(request):
+    """Check the backend according to the ``heartbeat_mode`` setting.
+
+    * ``write`` (default): write and delete a file;
+    * ``probe``: check that the backend is reachable (e.g. bucket metadata, or writable
+      folder), with a write check every ``heartbeat_write_interval`` seconds if set.
+    """
+    settings = request.registry.settings
+    if settings.get("attachment.heartbeat_mode", "write") == "probe":
+        interval = float(settings.get("attachment.heartbeat_write_interval", 0))
+        state = request.registry.attachment_heartbeat
+        now = time.monotonic()
+        due = state.last_write_check is None or now - state.last_write_check >= interval
+        if not interval or not due:
+            return probe_storage(request)
+        state.last_write_check = now
+    return write_storage(request)
+
+
+def probe_storage(request):
+    """:returns: ``True`` if the backend can be reached, ``False`` otherwise."""
+    try:
+        request.attachment.probe()
+        return True
+    except Exception as e:
+        logger.exception(e)
+        return False
+
+
+def write_storage(request):
+    """:returns: ``True`` if succeeds to write and delete, ``False`` otherwise."""
     # We will fake a file upload, so pick a file extension that is allowed.
-    extensions_str = request.registry.settings.get("attachment.extensions", "default")
-    extensions = utils.resolve_extensions(extensions_str) or {"json"}
+    extensions = utils.get_policy(request).extensions or {"json"}
     allowed_extension = "." + list(extensions)[-1]
 
     status = False
@@ -1,4 +1,10 @@
+import base64
+import hashlib
 import io
+from unittest import mock
+
+import requests
+from google.cloud.exceptions import NotFound, PreconditionFailed
 
 
 class MockFS:
@@ -9,15 +15,60 @@ class MockFS:
         self.file = io.BytesIO(data)
 
 
+class _FakeGCSBatch:
+    """Batch whose failed calls are only raised at the end, like GCS batches: the last
+    failure is raised."""
+
+    def __init__(self, bucket):
+        self._bucket = bucket
+        self._failures = []
+
+    def fail(self, exception):
+        self._failures.append(exception)
+
+    def __enter__(self):
+        self._bucket._batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._bucket._batch = None
+        if exc_type is None and self._failures:
+            raise self._failures[-1]
+
+
 class _FakeGCSBucket:
     def __init__(self):
         self._blobs = {}
+        self._batch = None
 
     def get_blob(self, name):
         return self._blobs.get(name)
 
+    def reload(self):
+        pass
+
     def delete_blob(self, name):
+        exists = name in self._blobs
         self._blobs.pop(name, None)
+        if exists:
+            return
+        error = NotFound("No such object: %s" % name)
+        if self._batch is None:
+            raise error
+        # Deferred until the end of the batch.
+        self._batch.fail(error)
+
+    def delete_blobs(self, names, on_error=None):
+        for name in names:
+            try:
+                self.delete_blob(name)
+            except NotFound:
+                if on_error is None:
+                    raise
+                on_error(name)
+
+    def list_blobs(self, prefix=""):
+        return [blob for name, blob in self._blobs.items() if name.startswith(prefix)]
 
 
 class _FakeGCSBlob:
@@ -25,14 +76,65 @@ class _FakeGCSBlob:
         self.name = name
         self._bucket = bucket
         self.cache_control = None
+        self.content_type = None
+        self.content_encoding = None
+        self.chunk_size = None
+        self.data = b""
+        self.generation = None
+        self.acl = mock.Mock()
+
+    @property
+    def size(self):
+        return len(self.data)
 
-    def upload_from_file(self, file, **kwargs):
+    @property
+    def md5_hash(self):
+        return base64.b64encode(hashlib.md5(self.data).digest()).decode()
+
+    def generate_signed_url(self, **kwargs):
+        return "https://storage.googleapis.com/signed/" + self.name
+
+    def patch(self):
+        pass
+
+    def exists(self):
+        return self.name in self._bucket._blobs
+
+    def _write(self, data, if_generation_match):
+        current = self._bucket._blobs.get(self.name)
+        generation = current.generation if current else 0
+        if if_generation_match is not None and if_generation_match != generation:
+            raise PreconditionFailed(
+                "At least one of the pre-conditions you specified did not hold."
+            )
+        self.data = data
+        self.generation = generation + 1
         self._bucket._blobs[self.name] = self
 
+    def upload_from_file(self, file, if_generation_match=None, **kwargs):
+        self._write(file.read(), if_generation_match)
+
+    def compose(self, sources, if_generation_match=None):
+        data = b"".join(self._bucket._blobs[source.name].data for source in sources)
+        self._write(data, if_generation_match)
+
+    def download_as_bytes(self, raw_download=False):
+        return self._bucket._blobs[self.name].data
+
+    def download_to_file(self, file, raw_download=False):
+        file.write(self._bucket._blobs[self.name].data)
+
+    def delete(self):
+        self._bucket.delete_blob(self.name)
+
 
 class _FakeGCSClient:
+    SCOPE = ("https://www.googleapis.com/auth/devstorage.full_control",)
+
     def __init__(self, **kwargs):
         self._bucket = _FakeGCSBucket()
+        self._http = kwargs.get("_http") or requests.Session()
+        self.kwargs = kwargs
 
     @classmethod
     def from_service_account_json(cls, **kwargs):
@@ -40,3 +142,6 @@ class _FakeGCSClient:
 
     def get_bucket(self, name):
         return self._bucket
+
+    def batch(self):
+        return _FakeGCSBatch(self._bucket)
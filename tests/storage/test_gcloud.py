@@ -1,14 +1,38 @@
 import datetime
+import hashlib
 import io
+import os
+import sys
+import threading
 import unittest
 from unittest import mock
 
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud.exceptions import Forbidden, PreconditionFailed
 from pyramid.exceptions import ConfigurationError
 
-from kinto_attachment.storage.gcloud import GoogleCloudStorage
+from kinto_attachment.storage.gcloud import GoogleCloudStorage, _FileRange, _worker_threads
 from tests.storage import MockFS, _FakeGCSBlob, _FakeGCSClient
 
 
+class FileRangeTest(unittest.TestCase):
+    def setUp(self):
+        self.range = _FileRange(io.BytesIO(b"0123456789"), 2, 5, threading.Lock())
+
+    def test_reads_are_bounded_to_the_range(self):
+        self.assertEqual(self.range.read(3), b"234")
+        self.assertEqual(self.range.read(), b"56")
+        self.assertEqual(self.range.read(), b"")
+
+    def test_seek_and_tell_are_relative_to_the_range(self):
+        self.assertEqual(self.range.seek(-2, os.SEEK_END), 3)
+        self.assertEqual(self.range.read(None), b"56")
+        self.range.seek(1)
+        self.range.seek(1, os.SEEK_CUR)
+        self.assertEqual(self.range.tell(), 2)
+        self.assertEqual(self.range.read(1), b"4")
+
+
 def make_storage(**kwargs):
     defaults = dict(
         credentials="creds.json", bucket_name="test-bucket", base_url="https://cdn.example.com/"
@@ -102,11 +126,115 @@ class TestGoogleCloudStorage(unittest.TestCase):
         self.storage.delete("photo.jpg")
         self.assertFalse(self.storage.exists("photo.jpg"))
 
+    def test_delete_of_missing_file_is_ignored(self):
+        self.assertFalse(self.storage.delete("photo.jpg"))
+
+    def test_delete_many_sends_batches(self):
+        names = ["photo-%d.jpg" % i for i in range(150)]
+        for name in names:
+            self.storage.save_file(io.BytesIO(b"data"), name)
+        batch = _FakeGCSClient.batch
+        with mock.patch.object(_FakeGCSClient, "batch", autospec=True, side_effect=batch) as m:
+            self.storage.delete_many(names)
+        self.assertEqual(m.call_count, 2)
+        self.assertFalse(any(self.storage.exists(name) for name in names))
+
+    def test_delete_many_ignores_missing_files(self):
+        self.storage.save_file(io.BytesIO(b"data"), "photo.jpg")
+        self.storage.save_file(io.BytesIO(b"data"), "other.jpg")
+        self.storage.delete_many(["photo.jpg", "missing.jpg", "other.jpg"])
+        self.assertFalse(self.storage.exists("photo.jpg"))
+        self.assertFalse(self.storage.exists("other.jpg"))
+
+    def deny_deletion(self, denied):
+        """Fail the deletions of the *denied* file (deferred within batches)."""
+        bucket = self.storage.get_bucket()
+        delete_blob = bucket.delete_blob
+
+        def failing_delete_blob(name):
+            if name != denied:
+                return delete_blob(name)
+            error = Forbidden("Access denied")
+            if bucket._batch is None:
+                raise error
+            bucket._batch.fail(error)
+
+        return mock.patch.object(bucket, "delete_blob", failing_delete_blob)
+
+    def test_delete_many_raises_other_failures(self):
+        self.storage.save_file(io.BytesIO(b"data"), "photo.jpg")
+        with self.deny_deletion("photo.jpg"), self.assertRaises(Forbidden):
+            self.storage.delete_many(["photo.jpg"])
+
+    def test_delete_many_raises_other_failures_along_with_missing_files(self):
+        self.storage.save_file(io.BytesIO(b"data"), "photo.jpg")
+        # The batch only raises its last failure, for the missing file.
+        with self.deny_deletion("photo.jpg"), self.assertRaises(Forbidden):
+            self.storage.delete_many(["photo.jpg", "missing.jpg"])
+
     def test_save_accepts_fieldStorage_object(self):
         name = self.storage.save(MockFS("image.jpg", b"binary"))
         self.assertEqual(name, "image.jpg")
         self.assertTrue(self.storage.exists("image.jpg"))
 
+    def test_probe_fetches_the_bucket_metadata(self):
+        bucket = self.storage.get_bucket()
+        with mock.patch.object(bucket, "reload") as reload:
+            self.storage.probe()
+        self.assertTrue(reload.called)
+
+    def test_warmup_fetches_the_bucket(self):
+        with mock.patch.object(_FakeGCSClient, "get_bucket", autospec=True) as get_bucket:
+            self.storage.warmup()
+        get_bucket.assert_called_with(self.storage._client, "test-bucket")
+        self.assertIn("test-bucket", self.storage._buckets)
+
+    def test_warmup_replaces_the_existing_client(self):
+        client = self.storage.get_connection()
+        self.storage.warmup()
+        self.assertIsNot(self.storage._client, client)
+
+    def pooled_client(self, storage):
+        credentials = mock.Mock(project_id="creds-project")
+        with mock.patch(
+            "google.oauth2.service_account.Credentials.from_service_account_file",
+            return_value=credentials,
+        ) as from_file:
+            storage.warmup()
+        client = storage._client
+        if storage.credentials:
+            from_file.assert_called_with(storage.credentials, scopes=_FakeGCSClient.SCOPE)
+        self.assertIsInstance(client._http, AuthorizedSession)
+        return client
+
+    def test_warmup_sizes_the_connection_pool(self):
+        client = self.pooled_client(make_storage(pool_size="32"))
+        adapter = client._http.get_adapter("https://storage.googleapis.com")
+        self.assertEqual(adapter._pool_maxsize, 32)
+        self.assertEqual(client.kwargs["project"], "creds-project")
+
+    def test_warmup_sizes_the_connection_pool_to_uwsgi_threads(self):
+        uwsgi = mock.Mock(opt={"threads": b"16"})
+        with mock.patch.dict(sys.modules, {"uwsgi": uwsgi}):
+            client = self.pooled_client(self.storage)
+        adapter = client._http.get_adapter("https://storage.googleapis.com")
+        self.assertEqual(adapter._pool_maxsize, 16)
+
+    def test_pooled_client_uses_default_credentials(self):
+        storage = make_storage(credentials=None, pool_size="4")
+        with mock.patch("google.auth.default", return_value=(mock.Mock(), None)):
+            client = self.pooled_client(storage)
+        self.assertNotIn("project", client.kwargs)
+        storage = make_storage(credentials=None, project="my-project", pool_size="4")
+        with mock.patch("google.auth.default", return_value=(mock.Mock(), "other")):
+            client = self.pooled_client(storage)
+        self.assertEqual(client.kwargs["project"], "my-project")
+
+    def test_worker_threads_are_unknown_outside_uwsgi(self):
+        self.assertIsNone(_worker_threads())
+        with mock.patch.dict(sys.modules, {"uwsgi": mock.Mock(opt={})}):
+            self.assertIsNone(_worker_threads())
+
     def test_save_file_returns_filename(self):
         name = self.storage.save_file(io.BytesIO(b"data"), "doc.pdf")
         self.assertEqual(name, "doc.pdf")
@@ -116,6 +244,16 @@ class TestGoogleCloudStorage(unittest.TestCase):
         self.assertEqual(name, "a/b/doc.pdf")
         self.assertTrue(self.storage.exists("a/b/doc.pdf"))
 
+    def test_save_file_with_hash_key_layout(self):
+        storage = make_storage(key_layout="hash:2")
+        name = storage.save_file(io.BytesIO(b"data"), "doc.pdf", folder="a/b")
+        self.assertEqual(name, "a/b/36/97/doc.pdf")
+        self.assertTrue(storage.exists(name))
+
+    def test_invalid_key_layout_raises(self):
+        with self.assertRaises(ConfigurationError):
+            make_storage(key_layout="tree")
+
     def test_save_file_randomizes_filename(self):
         name = self.storage.save_file(io.BytesIO(b"data"), "original.jpg", randomize=True)
         self.assertNotEqual(name, "original.jpg")
@@ -143,15 +281,288 @@ class TestGoogleCloudStorage(unittest.TestCase):
         self.assertEqual(name, "20240601010101-abc123-file.txt")
         self.assertTrue(self.storage.exists(name))
 
-    def test_save_file_skips_existing_when_no_replace(self):
+    def test_save_file_skips_existing_content_addresses(self):
         self.storage.save_file(io.BytesIO(b"original"), "f.txt")
-        name = self.storage.save_file(io.BytesIO(b"new"), "f.txt", replace=False)
+        name = self.storage.save_file(io.BytesIO(b"new"), "f.txt", content_addressed=True)
         self.assertEqual(name, "f.txt")
+        self.assertEqual(self.storage.get_bucket().get_blob("f.txt").data, b"original")
+
+    def test_save_file_overwrites_the_current_generation_of_fixed_names(self):
+        self.storage.save_file(io.BytesIO(b"original"), "f.txt")
+        with mock.patch.object(
+            _FakeGCSBlob,
+            "upload_from_file",
+            autospec=True,
+            side_effect=_FakeGCSBlob.upload_from_file,
+        ) as upload:
+            name = self.storage.save_file(io.BytesIO(b"new"), "f.txt")
+        self.assertEqual(name, "f.txt")
+        self.assertEqual(self.storage.get_bucket().get_blob("f.txt").data, b"new")
+        create_only, overwrite = upload.call_args_list
+        self.assertEqual(overwrite.kwargs["if_generation_match"], 1)
+
+    def test_save_file_fails_if_fixed_name_changes_meanwhile(self):
+        self.storage.save_file(io.BytesIO(b"original"), "f.txt")
+        bucket = self.storage.get_bucket()
+        with mock.patch.object(
+            GoogleCloudStorage, "_current_generation", return_value={"if_generation_match": 42}
+        ):
+            with self.assertRaises(PreconditionFailed):
+                self.storage.save_file(io.BytesIO(b"new"), "f.txt")
+        self.assertEqual(bucket.get_blob("f.txt").data, b"original")
+
+    def test_save_file_does_not_fetch_existing_blob(self):
+        bucket = self.storage.get_bucket()
+        with mock.patch.object(bucket, "get_blob") as get_blob:
+            with mock.patch.object(_FakeGCSBlob, "upload_from_file") as upload:
+                self.storage.save_file(io.BytesIO(b"data"), "f.txt")
+                self.storage.save_file(io.BytesIO(b"data"), "g.txt", replace=True)
+        self.assertFalse(get_blob.called)
+        create_only, replace = upload.call_args_list
+        self.assertEqual(create_only.kwargs["if_generation_match"], 0)
+        self.assertNotIn("if_generation_match", replace.kwargs)
 
     def test_save_file_overwrites_when_replace(self):
         self.storage.save_file(io.BytesIO(b"original"), "f.txt")
         name = self.storage.save_file(io.BytesIO(b"new"), "f.txt", replace=True)
         self.assertEqual(name, "f.txt")
+        self.assertEqual(self.storage.get_bucket().get_blob("f.txt").data, b"new")
+
+    def test_from_settings_upload_bands(self):
+        s = GoogleCloudStorage.from_settings(
+            {
+                "storage.gcloud.bucket_name": "my-bucket",
+                "storage.gcloud.resumable_threshold": "1024",
+                "storage.gcloud.chunk_size": "524288",
+                "storage.gcloud.composite_threshold": "4096",
+                "storage.gcloud.composite_part_size": "2048",
+                "storage.gcloud.upload_concurrency": "2",
+            },
+            prefix="storage.",
+        )
+        self.assertEqual(s.resumable_threshold, 1024)
+        self.assertEqual(s.chunk_size, 524288)
+        self.assertEqual(s.composite_threshold, 4096)
+        self.assertEqual(s.composite_part_size, 2048)
+        self.assertEqual(s.upload_concurrency, 2)
+
+    def test_delivery_headers_use_signed_urls(self):
+        s = GoogleCloudStorage.from_settings(
+            {"storage.gcloud.bucket_name": "my-bucket", "storage.gcloud.signed_url_expires": "60"},
+            prefix="storage.",
+        )
+        self.assertEqual(s.signed_url_expires, 60)
+        with mock.patch("kinto_attachment.storage.gcloud.Blob") as blob:
+            blob.return_value.generate_signed_url.return_value = "https://signed"
+            with mock.patch.object(s, "get_bucket"):
+                self.assertEqual(s.delivery_headers("f.txt"), {"Location": "https://signed"})
+        _, kwargs = blob.return_value.generate_signed_url.call_args
+        self.assertEqual(kwargs["method"], "GET")
+        self.assertEqual(kwargs["expiration"], datetime.timedelta(seconds=60))
+
+    def test_chunk_size_must_be_a_multiple_of_256_kib(self):
+        with self.assertRaises(ConfigurationError):
+            make_storage(chunk_size=1000)
+
+    def test_small_files_are_sent_in_a_single_request(self):
+        storage = make_storage(resumable_threshold=4)
+        name = storage.save_file(io.BytesIO(b"abcd"), "f.txt")
+        self.assertIsNone(storage.get_bucket().get_blob(name).chunk_size)
+
+    def test_medium_files_are_sent_in_chunks(self):
+        storage = make_storage(resumable_threshold=4, chunk_size=256 * 1024)
+        name = storage.save_file(io.BytesIO(b"abcde"), "f.txt")
+        blob = storage.get_bucket().get_blob(name)
+        self.assertEqual(blob.chunk_size, 256 * 1024)
+        self.assertEqual(blob.data, b"abcde")
+
+    def test_large_files_are_uploaded_in_parts_and_composed(self):
+        storage = make_storage(composite_threshold=10, composite_part_size=4)
+        compose_blobs = _FakeGCSBlob.compose
+        with mock.patch.object(_FakeGCSBlob, "compose", autospec=True) as compose:
+            compose.side_effect = compose_blobs
+            name = storage.save_file(io.BytesIO(b"0123456789"), "big.bin")
+        (blob, parts), kwargs = compose.call_args
+        self.assertEqual([part.data for part in parts], [b"0123", b"4567", b"89"])
+        self.assertEqual(kwargs, {"if_generation_match": 0})
+        self.assertEqual(blob.data, b"0123456789")
+        self.assertEqual(blob.content_type, "application/octet-stream")
+        blob.acl.save_predefined.assert_called_with("publicRead")
+        # Parts are removed.
+        self.assertEqual(storage.get_bucket().list_blobs(), [blob])
+        self.assertEqual(name, "big.bin")
+
+    def test_composite_upload_has_at_most_32_parts(self):
+        storage = make_storage(composite_threshold=1, composite_part_size=1)
+        with mock.patch.object(_FakeGCSBlob, "compose") as compose:
+            storage.save_file(io.BytesIO(b"x" * 100), "big.bin")
+        (parts,), _ = compose.call_args
+        self.assertEqual(len(parts), 25)
+
+    def test_composite_upload_keeps_existing_content_addresses(self):
+        storage = make_storage(composite_threshold=1, composite_part_size=2)
+        storage.save_file(io.BytesIO(b"original"), "f.txt")
+        storage.save_file(io.BytesIO(b"new"), "f.txt", content_addressed=True)
+        self.assertEqual(storage.get_bucket().get_blob("f.txt").data, b"original")
+        self.assertEqual(len(storage.get_bucket().list_blobs()), 1)
+
+    def test_composite_upload_overwrites_fixed_names(self):
+        storage = make_storage(composite_threshold=1, composite_part_size=2)
+        storage.save_file(io.BytesIO(b"original"), "f.txt")
+        storage.save_file(io.BytesIO(b"new"), "f.txt")
+        self.assertEqual(storage.get_bucket().get_blob("f.txt").data, b"new")
+        self.assertEqual(len(storage.get_bucket().list_blobs()), 1)
+
+    def test_composite_upload_without_acl_when_uniform_access(self):
+        storage = make_storage(acl=None, uniform_bucket_level_access=True, composite_threshold=1)
+        name = storage.save_file(io.BytesIO(b"abc"), "f.txt", replace=True)
+        self.assertFalse(storage.get_bucket().get_blob(name).acl.save_predefined.called)
+
+    def test_failed_composite_upload_removes_parts(self):
+        storage = make_storage(composite_threshold=1, composite_part_size=2)
+        with mock.patch.object(_FakeGCSBlob, "compose", side_effect=IOError):
+            with self.assertRaises(IOError):
+                storage.save_file(io.BytesIO(b"abcdef"), "f.txt")
+        self.assertEqual(storage.get_bucket().list_blobs(), [])
+
+    def upload_directly(self, data, storage=None):
+        """Store *data* as the object uploaded directly for ``upload-id``."""
+        storage = storage or self.storage
+        blob = _FakeGCSBlob(storage._staged_name("upload-id"), storage.get_bucket())
+        blob.upload_from_file(io.BytesIO(data))
+
+    def stage_chunks(self, *chunks):
+        """Stage the *chunks* of ``upload-id``, and return their names."""
+        names = []
+        offset = 0
+        for data in chunks:
+            names.append(self.storage.stage("upload-id", offset, io.BytesIO(data)))
+            offset += len(data)
+        return names
+
+    def test_staged_chunks_are_assembled_in_order(self):
+        names = self.stage_chunks(b"abc", b"def")
+        with self.storage.open_staged("upload-id", names) as f:
+            self.assertEqual(f.read(), b"abcdef")
+
+    def test_staged_chunks_are_stored_under_staging_prefix(self):
+        [name] = self.stage_chunks(b"abc")
+        self.assertRegex(name, r"^0{20}-\w{32}$")
+        self.assertTrue(self.storage.exists("uploads-staging/upload-id/" + name))
+
+    def test_staged_chunks_are_never_overwritten(self):
+        first = self.storage.stage("upload-id", 0, io.BytesIO(b"abc"))
+        second = self.storage.stage("upload-id", 0, io.BytesIO(b"ABC"))
+        self.assertNotEqual(first, second)
+        with mock.patch.object(_FakeGCSBlob, "upload_from_file", autospec=True) as upload:
+            self.storage.stage("upload-id", 3, io.BytesIO(b"def"))
+        self.assertEqual(upload.call_args.kwargs["if_generation_match"], 0)
+
+    def test_staged_content_can_be_discarded(self):
+        self.stage_chunks(b"abc", b"def")
+        self.storage.discard_staged("upload-id")
+        self.assertEqual(self.storage.get_bucket().list_blobs(prefix="uploads-staging/"), [])
+
+    def test_staged_chunks_can_be_discarded(self):
+        first, second = self.stage_chunks(b"abc", b"def")
+        self.storage.discard_staged("upload-id", [second])
+        self.storage.discard_staged("upload-id", [second])  # No error if missing.
+        staged = self.storage.get_bucket().list_blobs(prefix="uploads-staging/")
+        self.assertEqual([blob.name for blob in staged], ["uploads-staging/upload-id/" + first])
+
+    def test_signed_upload_url_binds_size_and_checksum(self):
+        with mock.patch.object(_FakeGCSBlob, "generate_signed_url", return_value="url") as m:
+            url, headers = self.storage.signed_upload_url(
+                "upload-id", size=3, md5="md5==", content_type="image/png", expires_in=60
+            )
+        self.assertEqual(url, "url")
+        self.assertEqual(headers["Content-MD5"], "md5==")
+        self.assertEqual(headers["x-goog-content-length-range"], "3,3")
+        kwargs = m.call_args.kwargs
+        self.assertEqual(kwargs["method"], "PUT")
+        self.assertEqual(kwargs["version"], "v4")
+        self.assertEqual(kwargs["expiration"], datetime.timedelta(seconds=60))
+
+    def test_check_staged_raises_if_missing(self):
+        with self.assertRaises(ValueError):
+            self.storage.check_staged("upload-id", size=3, md5="")
+
+    def test_check_staged_compares_metadata_and_reads_the_hash(self):
+        self.upload_directly(b"abc")
+        md5 = _FakeGCSBlob.md5_hash.fget(self.storage.get_bucket().list_blobs()[0])
+        filehash = self.storage.check_staged("upload-id", size=3, md5=md5)
+        self.assertEqual(filehash, hashlib.sha256(b"abc").hexdigest())
+        with self.assertRaises(ValueError):
+            self.storage.check_staged("upload-id", size=4, md5=md5)
+
+    def test_assemble_staged_composes_chunks_in_order(self):
+        names = self.stage_chunks(b"abc", b"def")
+        filehash, size = self.storage.assemble_staged("upload-id", names)
+        self.assertEqual((filehash, size), (hashlib.sha256(b"abcdef").hexdigest(), 6))
+        name = self.storage.commit_staged("upload-id", "f.txt")
+        self.assertEqual(self.storage.get_bucket().get_blob(name).data, b"abcdef")
+
+    def test_assemble_staged_only_composes_the_given_chunks(self):
+        names = self.stage_chunks(b"abc", b"def")
+        self.storage.stage("upload-id", 3, io.BytesIO(b"DEF"))
+        self.storage.assemble_staged("upload-id", names)
+        name = self.storage.commit_staged("upload-id", "f.txt")
+        self.assertEqual(self.storage.get_bucket().get_blob(name).data, b"abcdef")
+
+    def test_assemble_staged_composes_many_chunks_in_several_steps(self):
+        names = self.stage_chunks(*(b"%d," % i for i in range(70)))
+        compose = _FakeGCSBlob.compose
+        with mock.patch.object(_FakeGCSBlob, "compose", autospec=True, side_effect=compose) as m:
+            self.storage.assemble_staged("upload-id", names)
+        # 70 chunks: 3 intermediate objects, composed into the file.
+        self.assertEqual(m.call_count, 4)
+        self.assertTrue(all(len(c.args[1]) <= 32 for c in m.call_args_list))
+        name = self.storage.commit_staged("upload-id", "f.txt")
+        expected = b"".join(b"%d," % i for i in range(70))
+        self.assertEqual(self.storage.get_bucket().get_blob(name).data, expected)
+        composite = self.storage.get_bucket().list_blobs(prefix="uploads-staging/composite/")
+        self.assertEqual(composite, [])
+
+    def test_assemble_staged_hashes_the_stored_bytes(self):
+        names = self.stage_chunks(b"abc")
+        with mock.patch.object(_FakeGCSBlob, "download_to_file", autospec=True) as download:
+            self.storage.assemble_staged("upload-id", names)
+        self.assertEqual(download.call_args.args[0].name, "uploads-staging/upload-id/" + "0" * 20)
+
+    def test_commit_staged_sets_metadata(self):
+        self.upload_directly(b"abc")
+        name = self.storage.commit_staged(
+            "upload-id", "doc.pdf", folder="a", headers={"Content-Type": "application/pdf"}
+        )
+        self.assertEqual(name, "a/doc.pdf")
+        blob = self.storage.get_bucket().get_blob(name)
+        self.assertEqual(blob.data, b"abc")
+        self.assertEqual(blob.content_type, "application/pdf")
+        blob.acl.save_predefined.assert_called_with("publicRead")
+
+    def test_commit_staged_skips_existing_content_addresses(self):
+        self.storage.save_file(io.BytesIO(b"original"), "f.txt")
+        self.upload_directly(b"new")
+        self.storage.commit_staged("upload-id", "f.txt", content_addressed=True)
+        self.assertEqual(self.storage.get_bucket().get_blob("f.txt").data, b"original")
+
+    def test_commit_staged_overwrites_fixed_names(self):
+        self.storage.save_file(io.BytesIO(b"original"), "f.txt")
+        self.upload_directly(b"new")
+        self.storage.commit_staged("upload-id", "f.txt")
+        self.assertEqual(self.storage.get_bucket().get_blob("f.txt").data, b"new")
+
+    def test_commit_staged_overwrites_when_replace(self):
+        self.storage.save_file(io.BytesIO(b"original"), "f.txt")
+        self.upload_directly(b"new")
+        self.storage.commit_staged("upload-id", "f.txt", replace=True)
+        self.assertEqual(self.storage.get_bucket().get_blob("f.txt").data, b"new")
+
+    def test_commit_staged_without_acl_when_uniform_access(self):
+        storage = make_storage(acl=None, uniform_bucket_level_access=True)
+        self.upload_directly(b"abc", storage)
+        name = storage.commit_staged("upload-id", "doc.pdf")
+        self.assertFalse(storage.get_bucket().get_blob(name).acl.save_predefined.called)
 
     def test_save_file_strips_directory_from_filename(self):
         name = self.storage.save_file(io.BytesIO(b"x"), "../escape.txt")
@@ -165,6 +576,65 @@ class TestGoogleCloudStorage(unittest.TestCase):
         # Both are the same fake (single-bucket client), but the code path is exercised.
         self.assertIs(default, other)
 
+    def test_bucket_handles_are_cached_by_name(self):
+        client = self.storage.get_connection()
+        with mock.patch.object(client, "get_bucket", wraps=client.get_bucket) as get_bucket:
+            self.storage.get_bucket("other-bucket")
+            self.storage.get_bucket("other-bucket")
+            self.storage.get_bucket()
+        self.assertEqual(
+            get_bucket.call_args_list, [mock.call("other-bucket"), mock.call("test-bucket")]
+        )
+
+    def test_bucket_handles_expire_after_ttl(self):
+        storage = make_storage(bucket_cache_ttl="60")
+        client = storage.get_connection()
+        with mock.patch.object(client, "get_bucket", wraps=client.get_bucket) as get_bucket:
+            with mock.patch("kinto_attachment.storage.gcloud.time.monotonic") as monotonic:
+                monotonic.return_value = 100
+                storage.get_bucket("other-bucket")
+                monotonic.return_value = 159
+                storage.get_bucket("other-bucket")
+                self.assertEqual(get_bucket.call_count, 1)
+                monotonic.return_value = 161
+                storage.get_bucket("other-bucket")
+        self.assertEqual(get_bucket.call_count, 2)
+
+    def test_missing_buckets_are_not_cached_by_default(self):
+        from google.cloud.exceptions import NotFound
+
+        mock_client = mock.Mock()
+        mock_client.get_bucket.side_effect = NotFound("bucket")
+        self.storage._client = mock_client
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                self.storage.get_bucket("missing")
+        self.assertEqual(mock_client.get_bucket.call_count, 2)
+
+    def test_missing_buckets_are_cached_with_ttl(self):
+        from google.cloud.exceptions import NotFound
+
+        storage = make_storage(missing_bucket_cache_ttl="10")
+        storage._client = mock.Mock()
+        storage._client.get_bucket.side_effect = NotFound("bucket")
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                storage.get_bucket("missing")
+        self.assertEqual(storage._client.get_bucket.call_count, 1)
+        self.assertFalse(storage.exists("", bucket_name="missing"))
+
+    def test_bucket_cache_hits_and_misses_are_counted(self):
+        self.storage.metrics = mock.Mock()
+        self.storage.get_bucket()
+        self.storage.get_bucket()
+        self.assertEqual(
+            self.storage.metrics.count.call_args_list,
+            [
+                mock.call("attachments.bucket_cache.misses"),
+                mock.call("attachments.bucket_cache.hits"),
+            ],
+        )
+
     def test_raises_when_bucket_missing_and_auto_create_disabled(self):
         from google.cloud.exceptions import NotFound
 
@@ -1,14 +1,18 @@
 import datetime
+import errno
 import io
 import os
 import shutil
 import tempfile
 import unittest
+import uuid
 from unittest import mock
 
+from pyramid import testing
 from pyramid.exceptions import ConfigurationError
 
-from kinto_attachment.storage.local import LocalFileStorage
+from kinto_attachment.compression import Variant
+from kinto_attachment.storage.local import LocalFileStorage, copy_file, includeme
 from tests.storage import MockFS
 
 
@@ -28,6 +32,36 @@ class TestLocalFileStorage(unittest.TestCase):
         self.assertEqual(s.base_path, self.tmpdir)
         self.assertEqual(s.base_url, "http://cdn.com/")
 
+    def test_from_settings_key_layout(self):
+        s = LocalFileStorage.from_settings(
+            {"storage.base_path": self.tmpdir, "storage.key_layout": "hash:2"}, prefix="storage."
+        )
+        self.assertEqual(s.key_levels, 2)
+
+    def test_from_settings_delivery(self):
+        s = LocalFileStorage.from_settings(
+            {
+                "storage.base_path": self.tmpdir,
+                "storage.accel_redirect": "/protected",
+                "storage.sendfile": "true",
+            },
+            prefix="storage.",
+        )
+        self.assertEqual(s.accel_redirect, "/protected/")
+        self.assertTrue(s.sendfile)
+
+    def test_delivery_headers_quote_accel_redirect_paths(self):
+        self.storage.accel_redirect = "/protected/"
+        self.assertEqual(
+            self.storage.delivery_headers("a/my file.jpg"),
+            {"X-Accel-Redirect": "/protected/a/my%20file.jpg"},
+        )
+
+    def test_delivery_headers_redirect_to_the_url_by_default(self):
+        self.assertEqual(
+            self.storage.delivery_headers("foo.jpg"), {"Location": "http://example.com/foo.jpg"}
+        )
+
     def test_from_settings_base_url_defaults_to_empty(self):
         s = LocalFileStorage.from_settings({"storage.base_path": self.tmpdir}, prefix="storage.")
         self.assertEqual(s.base_url, "")
@@ -49,6 +83,12 @@ class TestLocalFileStorage(unittest.TestCase):
         self.storage.save_file(io.BytesIO(b"data"), "photo.jpg")
         self.assertTrue(self.storage.exists("photo.jpg"))
 
+    def test_save_file_overwrites_when_replace(self):
+        self.storage.save_file(io.BytesIO(b"original"), "f.txt")
+        name = self.storage.save_file(io.BytesIO(b"new"), "f.txt", replace=True)
+        self.assertEqual(name, "f.txt")
+        self.assertEqual(self.storage.read("f.txt"), b"new")
+
     def test_delete_removes_file(self):
         self.storage.save_file(io.BytesIO(b"data"), "photo.jpg")
         self.storage.delete("photo.jpg")
@@ -61,11 +101,35 @@ class TestLocalFileStorage(unittest.TestCase):
     def test_delete_returns_false_when_file_missing(self):
         self.assertFalse(self.storage.delete("ghost.jpg"))
 
+    def test_delete_many_removes_files_in_parallel(self):
+        names = ["photo-%d.jpg" % i for i in range(5)]
+        for name in names:
+            self.storage.save_file(io.BytesIO(b"data"), name)
+        with mock.patch("kinto_attachment.storage.local.ThreadPoolExecutor") as executor:
+            executor.return_value.__enter__.return_value.map.side_effect = map
+            self.storage.delete_many(names + ["ghost.jpg"])
+        executor.assert_called_with(max_workers=6)
+        self.assertFalse(any(self.storage.exists(name) for name in names))
+
+    def test_delete_many_can_be_sequential(self):
+        storage = LocalFileStorage(base_path=self.tmpdir, delete_concurrency="1")
+        storage.save_file(io.BytesIO(b"data"), "a.jpg")
+        storage.save_file(io.BytesIO(b"data"), "b.jpg")
+        with mock.patch("kinto_attachment.storage.local.ThreadPoolExecutor") as executor:
+            storage.delete_many(["a.jpg", "b.jpg"])
+        executor.assert_not_called()
+        self.assertFalse(storage.exists("a.jpg"))
+
     def test_save_accepts_fieldStorage_object(self):
         name = self.storage.save(MockFS("image.jpg", b"binary"))
         self.assertEqual(name, "image.jpg")
         self.assertTrue(self.storage.exists("image.jpg"))
 
+    def test_save_can_override_filename(self):
+        name = self.storage.save(MockFS("image.jpg", b"binary"), filename="abc.jpg")
+        self.assertEqual(name, "abc.jpg")
+        self.assertTrue(self.storage.exists("abc.jpg"))
+
     def test_save_file_returns_filename(self):
         name = self.storage.save_file(io.BytesIO(b"data"), "test.txt")
         self.assertEqual(name, "test.txt")
@@ -75,11 +139,36 @@ class TestLocalFileStorage(unittest.TestCase):
         with open(self.storage.path("hello.txt"), "rb") as f:
             self.assertEqual(f.read(), b"hello")
 
+    def test_probe_checks_that_base_path_is_writable(self):
+        self.storage.probe()
+        storage = LocalFileStorage(base_path=os.path.join(self.tmpdir, "missing"))
+        with self.assertRaises(IOError):
+            storage.probe()
+
     def test_save_file_with_folder(self):
         name = self.storage.save_file(io.BytesIO(b"data"), "doc.pdf", folder="a/b")
         self.assertEqual(name, os.path.join("a", "b", "doc.pdf"))
         self.assertTrue(os.path.exists(os.path.join(self.tmpdir, "a", "b", "doc.pdf")))
 
+    def test_save_file_with_hash_key_layout(self):
+        storage = LocalFileStorage(base_path=self.tmpdir, key_layout="hash:2")
+        name = storage.save_file(io.BytesIO(b"data"), "doc.pdf", folder="a")
+        self.assertEqual(name, os.path.join("a", "36", "97", "doc.pdf"))
+        self.assertTrue(storage.exists(name))
+
+    def test_hash_key_layout_keeps_flat_files_readable(self):
+        name = self.storage.save_file(io.BytesIO(b"old"), "old.pdf")
+        storage = LocalFileStorage(base_path=self.tmpdir, key_layout="hash:1")
+        self.assertTrue(storage.exists(name))
+        storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+
+    def test_hash_key_layout_resolves_name_collision(self):
+        storage = LocalFileStorage(base_path=self.tmpdir, key_layout="hash:1")
+        storage.save_file(io.BytesIO(b"a"), "doc.pdf")
+        name = storage.save_file(io.BytesIO(b"b"), "doc.pdf")
+        self.assertEqual(name, os.path.join("36", "doc-1.pdf"))
+
     def test_save_file_creates_missing_directories(self):
         self.storage.save_file(io.BytesIO(b"x"), "f.txt", folder="deep/nested/dir")
         self.assertTrue(os.path.isdir(os.path.join(self.tmpdir, "deep", "nested", "dir")))
@@ -123,8 +212,252 @@ class TestLocalFileStorage(unittest.TestCase):
             self.storage.save_file(io.BytesIO(b"x"), "x.txt")
         self.assertTrue(self.storage.exists("x-2.txt"))
 
+    def test_save_file_uses_random_suffix_after_a_few_collisions(self):
+        names = [self.storage.save_file(io.BytesIO(b"x"), "x.txt") for _ in range(5)]
+        self.assertEqual(names[:3], ["x.txt", "x-1.txt", "x-2.txt"])
+        self.assertRegex(names[3], r"^x-[0-9a-f]{8}\.txt$")
+        self.assertEqual(len(set(names)), 5)
+
+    def test_save_file_leaves_no_temporary_file(self):
+        self.storage.save_file(io.BytesIO(b"x"), "x.txt", folder="a")
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, "a")), ["x.txt"])
+
+    def test_save_file_does_not_create_partial_files(self):
+        content = mock.Mock(wraps=io.BytesIO(b"x"))
+        content.read.side_effect = IOError("Connection lost")
+        with self.assertRaises(IOError):
+            self.storage.save_file(content, "x.txt")
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_save_file_does_not_overwrite_concurrent_save(self):
+        # Another worker takes the name between the check and the write.
+        original_link = os.link
+
+        def link(src, dst):
+            if dst.endswith("race.txt"):
+                with open(dst, "wb") as f:
+                    f.write(b"other")
+            return original_link(src, dst)
+
+        with mock.patch("kinto_attachment.storage.local.os.link", side_effect=link):
+            name = self.storage.save_file(io.BytesIO(b"mine"), "race.txt")
+        self.assertEqual(name, "race-1.txt")
+        with open(self.storage.path("race.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"other")
+
+    def test_save_file_without_hard_link_support(self):
+        error = OSError(errno.EPERM, "Operation not permitted")
+        with mock.patch("kinto_attachment.storage.local.os.link", side_effect=error):
+            self.storage.save_file(io.BytesIO(b"first"), "file.txt")
+            name = self.storage.save_file(io.BytesIO(b"second"), "file.txt")
+        self.assertEqual(name, "file-1.txt")
+        with open(self.storage.path("file-1.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"second")
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["file-1.txt", "file.txt"])
+
+    def test_save_file_raises_other_link_errors(self):
+        error = OSError(errno.ENOSPC, "No space left on device")
+        with mock.patch("kinto_attachment.storage.local.os.link", side_effect=error):
+            with self.assertRaises(OSError):
+                self.storage.save_file(io.BytesIO(b"x"), "x.txt")
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_save_file_honors_umask(self):
+        umask = os.umask(0o022)
+        self.addCleanup(os.umask, umask)
+        name = self.storage.save_file(io.BytesIO(b"x"), "x.txt")
+        self.assertEqual(os.stat(self.storage.path(name)).st_mode & 0o777, 0o644)
+
+    def test_save_file_links_named_files_instead_of_copying(self):
+        source = os.path.join(self.tmpdir, "spooled")
+        with open(source, "wb") as f:
+            f.write(b"data")
+        with open(source, "rb") as f:
+            name = self.storage.save_file(f, "file.txt")
+        self.assertEqual(os.stat(self.storage.path(name)).st_ino, os.stat(source).st_ino)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["file.txt", "spooled"])
+
+    def test_save_file_copies_named_files_from_other_file_systems(self):
+        source = os.path.join(self.tmpdir, "spooled")
+        with open(source, "wb") as f:
+            f.write(b"data")
+        original_link = os.link
+
+        def link(src, dst):
+            if src == source:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            return original_link(src, dst)
+
+        with mock.patch("kinto_attachment.storage.local.os.link", side_effect=link):
+            with open(source, "rb") as f:
+                name = self.storage.save_file(f, "file.txt")
+        self.assertNotEqual(os.stat(self.storage.path(name)).st_ino, os.stat(source).st_ino)
+        with open(self.storage.path(name), "rb") as f:
+            self.assertEqual(f.read(), b"data")
+
+    def variant(self, data=b"compressed"):
+        return Variant("gzip", io.BytesIO(data), "hash", len(data))
+
+    def test_variant_is_stored_next_to_the_file(self):
+        name = self.storage.save_file(io.BytesIO(b"raw"), "data.json", variant=self.variant())
+        self.assertEqual(self.storage.variant_name(name, "gzip"), "data.json.gz")
+        self.assertEqual(self.storage.read("data.json"), b"raw")
+        self.assertEqual(self.storage.read("data.json.gz"), b"compressed")
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["data.json", "data.json.gz"])
+
+    def test_variant_does_not_overwrite_other_files(self):
+        self.storage.save_file(io.BytesIO(b"other"), "report.json.gz")
+        name = self.storage.save_file(io.BytesIO(b"raw"), "report.json", variant=self.variant())
+        # The name is only taken if it is free for both files.
+        self.assertEqual(name, "report-1.json")
+        self.assertEqual(self.storage.read("report.json.gz"), b"other")
+        self.assertEqual(self.storage.read("report-1.json.gz"), b"compressed")
+        self.assertFalse(self.storage.exists("report.json"))
+
+    def test_variant_does_not_overwrite_other_files_without_hard_link_support(self):
+        self.storage.save_file(io.BytesIO(b"other"), "report.json.gz")
+        error = OSError(errno.EPERM, "Operation not permitted")
+        with mock.patch("kinto_attachment.storage.local.os.link", side_effect=error):
+            name = self.storage.save_file(
+                io.BytesIO(b"raw"), "report.json", variant=self.variant()
+            )
+        self.assertEqual(name, "report-1.json")
+        self.assertEqual(self.storage.read("report-1.json"), b"raw")
+        self.assertEqual(self.storage.read("report.json.gz"), b"other")
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir)),
+            ["report-1.json", "report-1.json.gz", "report.json.gz"],
+        )
+
+    def test_delete_keeps_files_named_like_variants(self):
+        self.storage.save_file(io.BytesIO(b"raw"), "x.csv")
+        self.storage.save_file(io.BytesIO(b"other"), "x.csv.gz")
+        self.storage.delete("x.csv")
+        self.assertTrue(self.storage.exists("x.csv.gz"))
+
+    def stage_chunks(self, *chunks):
+        """Stage the *chunks* of ``upload-id``, and return their names."""
+        self.storage.staging_path = os.path.join(self.tmpdir, "staging")
+        names = []
+        offset = 0
+        for data in chunks:
+            names.append(self.storage.stage("upload-id", offset, io.BytesIO(data)))
+            offset += len(data)
+        return names
+
+    def test_staged_chunks_are_assembled(self):
+        names = self.stage_chunks(b"abc", b"def")
+        with self.storage.open_staged("upload-id", names) as f:
+            self.assertEqual(f.read(), b"abcdef")
+
+    def test_single_staged_chunk_is_opened_directly(self):
+        [name] = self.stage_chunks(b"abc")
+        with self.storage.open_staged("upload-id", [name]) as f:
+            self.assertEqual(f.name, os.path.join(self.storage.staging_path, "upload-id", name))
+
+    def test_assembled_chunks_are_linked_when_saved(self):
+        names = self.stage_chunks(b"abc", b"def")
+        with self.storage.open_staged("upload-id", names) as f:
+            name = self.storage.save_file(f, "file.txt")
+            self.assertEqual(os.stat(self.storage.path(name)).st_ino, os.fstat(f.fileno()).st_ino)
+        with open(self.storage.path(name), "rb") as f:
+            self.assertEqual(f.read(), b"abcdef")
+
+    def test_staged_files_are_saved_with_the_umask_mode(self):
+        umask = os.umask(0o022)
+        self.addCleanup(os.umask, umask)
+        for chunks in ([b"abc"], [b"abc", b"def"]):
+            names = self.stage_chunks(*chunks)
+            with self.storage.open_staged("upload-id", names) as f:
+                name = self.storage.save_file(f, "file.txt")
+            self.assertEqual(os.stat(self.storage.path(name)).st_mode & 0o777, 0o644)
+
+    def test_staged_chunks_are_never_overwritten(self):
+        first, second = self.stage_chunks(b"abc", b"")
+        self.assertNotEqual(first, second)
+        with mock.patch(
+            "kinto_attachment.storage.local.uuid.uuid4", return_value=uuid.UUID(int=0)
+        ):
+            self.storage.stage("upload-id", 3, io.BytesIO(b"def"))
+            with self.assertRaises(FileExistsError):
+                self.storage.stage("upload-id", 3, io.BytesIO(b"DEF"))
+
+    def test_staged_content_can_be_discarded(self):
+        self.stage_chunks(b"abc")
+        self.storage.discard_staged("upload-id")
+        self.storage.discard_staged("upload-id")  # No error if missing.
+        self.assertEqual(os.listdir(self.storage.staging_path), [])
+
+    def test_staged_chunks_can_be_discarded(self):
+        first, second = self.stage_chunks(b"abc", b"def")
+        self.storage.discard_staged("upload-id", [second])
+        self.storage.discard_staged("upload-id", [second])  # No error if missing.
+        folder = os.path.join(self.storage.staging_path, "upload-id")
+        self.assertEqual(os.listdir(folder), [first])
+
     def test_save_file_strips_directory_from_filename(self):
         # An attacker-controlled filename with path traversal should be sanitised.
         name = self.storage.save_file(io.BytesIO(b"x"), "../escape.txt")
         self.assertNotIn("..", name)
         self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "..", "escape.txt")))
+
+
+class TestCopyFile(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.TemporaryFile()
+        self.src.write(b"x" * 100000)
+        self.dest = tempfile.TemporaryFile()
+        self.addCleanup(self.src.close)
+        self.addCleanup(self.dest.close)
+
+    def copied(self):
+        self.dest.seek(0)
+        return self.dest.read()
+
+    def test_files_are_copied_in_the_kernel(self):
+        with mock.patch("os.copy_file_range", wraps=os.copy_file_range) as mocked:
+            copy_file(self.src, self.dest)
+        self.assertTrue(mocked.called)
+        self.assertEqual(self.copied(), b"x" * 100000)
+
+    def test_copy_falls_back_to_user_space(self):
+        error = OSError(errno.EXDEV, "Invalid cross-device link")
+        with mock.patch("os.copy_file_range", side_effect=error):
+            copy_file(self.src, self.dest)
+        self.assertEqual(self.copied(), b"x" * 100000)
+
+    def test_copy_stops_at_end_of_file(self):
+        with mock.patch("os.copy_file_range", return_value=0):
+            copy_file(self.src, self.dest)
+        self.assertEqual(self.copied(), b"x" * 100000)
+
+    def test_in_memory_files_are_copied(self):
+        copy_file(io.BytesIO(b"data"), self.dest)
+        self.assertEqual(self.copied(), b"data")
+
+
+class TestIncludeme(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_spool_path_is_created(self):
+        spool_path = os.path.join(self.tmpdir, "spool")
+        config = testing.setUp(
+            settings={"storage.base_path": self.tmpdir, "storage.spool_path": spool_path}
+        )
+        includeme(config)
+        self.assertTrue(os.path.isdir(spool_path))
+
+    def test_spool_path_does_not_change_the_temporary_directory(self):
+        tempdir = tempfile.gettempdir()
+        spool_path = os.path.join(self.tmpdir, "spool")
+        config = testing.setUp(
+            settings={"storage.base_path": self.tmpdir, "storage.spool_path": spool_path}
+        )
+        includeme(config)
+        self.assertEqual(tempfile.gettempdir(), tempdir)
+
+    def test_spool_path_is_the_default_staging_location(self):
+        storage = LocalFileStorage(base_path=self.tmpdir, spool_path="/var/spool")
+        self.assertEqual(storage.staging_path, "/var/spool/kinto-attachment-uploads")
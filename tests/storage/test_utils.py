@@ -2,7 +2,13 @@ import unittest
 
 from pyramid.exceptions import ConfigurationError
 
-from kinto_attachment.storage import random_filename, read_settings, secure_filename
+from kinto_attachment.storage import (
+    FileStorage,
+    parse_key_layout,
+    random_filename,
+    read_settings,
+    secure_filename,
+)
 
 
 class TestSecureFilename(unittest.TestCase):
@@ -67,3 +73,32 @@ class TestReadSettings(unittest.TestCase):
     def test_required_present_does_not_raise(self):
         result = read_settings({"p.key": "v"}, [("key", True, None)], prefix="p.")
         self.assertEqual(result["key"], "v")
+
+
+class TestKeyLayout(unittest.TestCase):
+    def test_flat_layout_has_no_levels(self):
+        self.assertEqual(parse_key_layout(None), 0)
+        self.assertEqual(parse_key_layout("flat"), 0)
+
+    def test_hash_layout_levels(self):
+        self.assertEqual(parse_key_layout("hash:2"), 2)
+
+    def test_invalid_layouts_raise(self):
+        for value in ("tree", "hash", "hash:a", "hash:0", "hash:5"):
+            with self.assertRaises(ConfigurationError):
+                parse_key_layout(value)
+
+    def test_flat_keys_are_file_names(self):
+        self.assertEqual(FileStorage().key_for("doc.pdf"), "doc.pdf")
+
+    def test_hash_keys_are_prefixed_with_digest_pairs(self):
+        storage = FileStorage()
+        storage.key_levels = 2
+        # md5("doc.pdf") = "3697..."
+        self.assertEqual(storage.key_for("doc.pdf"), "36/97/doc.pdf")
+
+    def test_hash_keys_are_stable(self):
+        storage = FileStorage()
+        storage.key_levels = 1
+        self.assertEqual(storage.key_for("a.txt"), storage.key_for("a.txt"))
+        self.assertNotEqual(storage.key_for("a.txt"), storage.key_for("b.txt"))
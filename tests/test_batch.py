@@ -0,0 +1,244 @@
+import json
+import sys
+import unittest
+import uuid
+from unittest import mock
+
+from kinto.core.errors import ERRORS
+
+from kinto_attachment import records, utils
+from kinto_attachment.utils import sha256
+
+from . import BaseWebTestGCloud, BaseWebTestLocal, get_user_headers
+
+
+class BatchUploadTest(object):
+    def setUp(self):
+        super().setUp()
+        self.batch_uri = "/buckets/fennec/collections/fonts/attachments"
+        self.record_ids = [str(uuid.uuid4()) for _ in range(3)]
+
+    def batch_upload(self, files=None, params=None, status=200):
+        if files is None:
+            files = [
+                (rid, "font-%s.jpg" % i, b"--font-%d--" % i)
+                for i, rid in enumerate(self.record_ids)
+            ]
+        headers = {**self.headers}
+        content_type, body = self.app.encode_multipart(params or [], files)
+        headers["Content-Type"] = content_type
+        resp = self.app.post(self.batch_uri, body, headers=headers, status=status)
+        if resp.status_code == 200:
+            for result in resp.json["responses"]:
+                if result["status"] < 300:
+                    self._add_to_cleanup(result["body"])
+        return resp
+
+    def get_record(self, record_id):
+        uri = self.get_record_uri("fennec", "fonts", record_id)
+        return self.app.get(uri, headers=self.headers).json["data"]
+
+    def test_files_are_attached_to_each_record(self):
+        responses = self.batch_upload().json["responses"]
+        self.assertEqual([r["id"] for r in responses], self.record_ids)
+        for i, result in enumerate(responses):
+            self.assertEqual(result["status"], 201)
+            self.assertEqual(result["body"]["hash"], sha256(b"--font-%d--" % i))
+            record = self.get_record(result["id"])
+            self.assertEqual(record["attachment"], result["body"])
+
+    def test_record_data_and_permissions_can_be_posted(self):
+        rid = self.record_ids[0]
+        params = [
+            (rid + ".data", json.dumps({"family": "sans"})),
+            (rid + ".permissions", json.dumps({"read": ["system.Everyone"]})),
+        ]
+        self.batch_upload(params=params)
+        record = self.get_record(rid)
+        self.assertEqual(record["family"], "sans")
+        uri = self.get_record_uri("fennec", "fonts", rid)
+        resp = self.app.get(uri, headers=self.headers)
+        self.assertIn("system.Everyone", resp.json["permissions"]["read"])
+
+    def test_existing_attachments_are_replaced(self):
+        first = self.batch_upload().json["responses"]
+        second = self.batch_upload().json["responses"]
+        self.assertEqual(second[0]["status"], 200)
+        old_location = first[0]["body"]["location"].replace(self.base_url, "")
+        self.assertFalse(self.backend.exists(old_location))
+        self.assertEqual(self.get_record(self.record_ids[0])["attachment"], second[0]["body"])
+
+    def test_invalid_files_are_reported_per_record(self):
+        ok, bad, _ = self.record_ids
+        files = [(ok, "font.jpg", b"--ok--"), (bad, "virus.exe", b"--bad--")]
+        responses = self.batch_upload(files=files).json["responses"]
+        self.assertEqual(responses[0]["status"], 201)
+        self.assertEqual(responses[1]["status"], 400)
+        self.assertEqual(responses[1]["body"]["message"], "body: File extension is not allowed.")
+        uri = self.get_record_uri("fennec", "fonts", bad)
+        self.app.get(uri, headers=self.headers, status=404)
+
+    def test_records_are_validated_once(self):
+        with mock.patch(
+            "kinto_attachment.utils._validate_record", wraps=utils._validate_record
+        ) as validate:
+            self.batch_upload()
+        self.assertEqual(validate.call_count, len(self.record_ids))
+
+    def test_records_changed_meanwhile_are_reported_per_record(self):
+        first = self.batch_upload().json["responses"]
+        changed_id = self.record_ids[1]
+
+        def update_unmodified(storage, resource_name, parent_id, object_id, *args):
+            if object_id == changed_id:
+                return None
+            return records.update_unmodified(storage, resource_name, parent_id, object_id, *args)
+
+        delete_many = self.backend.delete_many
+        with mock.patch("kinto_attachment.utils.update_unmodified", update_unmodified):
+            with mock.patch.object(self.backend, "delete_many", wraps=delete_many) as deleted:
+                responses = self.batch_upload().json["responses"]
+        self.assertEqual([r["status"] for r in responses], [200, 412, 200])
+        self.assertEqual(responses[1]["body"]["errno"], ERRORS.MODIFIED_MEANWHILE.value)
+        # The record keeps its previous attachment and file.
+        self.assertEqual(self.get_record(changed_id)["attachment"], first[1]["body"])
+        previous = first[1]["body"]["location"].replace(self.base_url, "")
+        self.assertTrue(self.backend.exists(previous))
+        uri = self.get_record_uri("fennec", "fonts", changed_id)
+        links = self.app.app.registry.attachment_links.list("record_uri", [uri])
+        self.assertEqual([link["location"] for link in links], [previous])
+        # The file stored for it is removed, with the ones replaced in the other records.
+        deleted_files = [name for (names,), _ in deleted.call_args_list for name in names]
+        self.assertEqual(len(deleted_files), 3)
+        self.assertNotIn(previous, deleted_files)
+        for location in deleted_files:
+            self.assertFalse(self.backend.exists(location))
+
+    def test_invalid_record_ids_are_reported(self):
+        files = [("_bad", "font.jpg", b"--font--")]
+        responses = self.batch_upload(files=files).json["responses"]
+        self.assertEqual(responses[0]["status"], 400)
+
+    def test_invalid_json_fields_are_reported(self):
+        rid = self.record_ids[0]
+        params = [(rid + ".data", "{'bad")]
+        responses = self.batch_upload(params=params).json["responses"]
+        self.assertEqual(responses[0]["status"], 400)
+        self.assertIn("data is not valid JSON", responses[0]["body"]["message"])
+        self.assertEqual(responses[1]["status"], 201)
+
+    def test_permission_is_checked_for_each_record(self):
+        self.batch_upload(files=[(self.record_ids[0], "font.jpg", b"--font--")])
+        uri = "/buckets/fennec/collections/fonts"
+        self.app.patch_json(
+            uri,
+            {"permissions": {"record:create": ["system.Authenticated"]}},
+            headers=self.headers,
+        )
+        self.headers.update(get_user_headers("jean-louis"))
+        responses = self.batch_upload().json["responses"]
+        self.assertEqual(responses[0]["status"], 403)
+        self.assertEqual(responses[1]["status"], 201)
+
+    def test_unknown_fields_are_rejected(self):
+        resp = self.batch_upload(params=[("foo", "bar")], status=400)
+        self.assertIn("'foo' should be a file", resp.json["message"])
+
+    def test_fields_without_file_are_rejected(self):
+        resp = self.batch_upload(params=[("abc.data", "{}")], status=400)
+        self.assertIn("no file posted for record 'abc'", resp.json["message"])
+
+    def test_several_files_for_a_record_are_rejected(self):
+        rid = self.record_ids[0]
+        files = [(rid, "font.jpg", b"--one--"), (rid, "font.jpg", b"--two--")]
+        resp = self.batch_upload(files=files, status=400)
+        self.assertIn("several files posted for record %r" % rid, resp.json["message"])
+
+    def test_repeated_fields_are_rejected(self):
+        rid = self.record_ids[0]
+        params = [(rid + ".data", "{}"), (rid + ".data", "{}")]
+        resp = self.batch_upload(params=params, status=400)
+        self.assertIn("%r posted several times" % (rid + ".data"), resp.json["message"])
+
+    def test_files_are_required(self):
+        content_type, body = self.app.encode_multipart([], [])
+        headers = {**self.headers, "Content-Type": content_type}
+        resp = self.app.post(self.batch_uri, body, headers=headers, status=400)
+        self.assertEqual(resp.json["message"], "Attachment missing.")
+        self.assertEqual(resp.json["errno"], ERRORS.INVALID_POSTED_DATA.value)
+
+    def test_multipart_is_required(self):
+        self.app.post_json(self.batch_uri, {}, headers=self.headers, status=400)
+
+    def test_malformed_multipart_is_rejected(self):
+        with mock.patch("kinto_attachment.utils.parse_post", side_effect=ValueError("Invalid")):
+            self.batch_upload(status=400)
+
+    def test_collection_must_exist(self):
+        self.batch_uri = "/buckets/fennec/collections/unknown/attachments"
+        self.batch_upload(status=404)
+
+    def test_collection_existence_is_not_revealed_without_permission(self):
+        self.headers.update(get_user_headers("jean-louis"))
+        resp = self.batch_upload(status=403)
+        self.assertEqual(resp.json["errno"], ERRORS.FORBIDDEN.value)
+        self.batch_uri = "/buckets/fennec/collections/unknown/attachments"
+        self.batch_upload(status=403)
+
+    def test_collection_permission_is_checked_before_parsing(self):
+        self.headers.update(get_user_headers("jean-louis"))
+        with mock.patch("kinto_attachment.batch._parse_parts") as parse:
+            self.batch_upload(status=403)
+        parse.assert_not_called()
+
+    def test_body_size_is_checked_against_the_number_of_files(self):
+        self.update_settings(max_size_bytes="20", max_size_overhead_bytes="100")
+        self.batch_upload(files=[(self.record_ids[0], "font.jpg", b"--font--")])
+        self.update_settings(batch_max_files="1")
+        with mock.patch("kinto_attachment.batch._parse_parts") as parse:
+            resp = self.batch_upload(status=413)
+        parse.assert_not_called()
+        self.assertEqual(resp.json["errno"], ERRORS.REQUEST_TOO_LARGE.value)
+
+    def test_number_of_files_is_limited(self):
+        self.update_settings(batch_max_files="2")
+        resp = self.batch_upload(status=400)
+        self.assertEqual(resp.json["message"], "body: at most 2 files can be posted at once.")
+
+
+class LocalBatchUploadTest(BatchUploadTest, BaseWebTestLocal, unittest.TestCase):
+    def test_record_validation_errors_are_reported_per_record(self):
+        params = [(self.record_ids[1] + ".data", json.dumps({"family": 42}))]
+        with mock.patch("kinto_attachment.utils.save_file", wraps=utils.save_file) as save:
+            responses = self.batch_upload(params=params).json["responses"]
+        self.assertEqual(responses[1]["status"], 400)
+        self.assertIn("42 is not of type 'string'", responses[1]["body"]["message"])
+        self.assertEqual([r["status"] for r in responses], [201, 400, 201])
+        # The file of the invalid record was not stored.
+        self.assertEqual(save.call_count, 2)
+        uri = self.get_record_uri("fennec", "fonts", self.record_ids[1])
+        self.app.get(uri, headers=self.headers, status=404)
+
+    def test_patches_are_computed_from_the_previous_versions(self):
+        code = "import sys; sys.stdout.buffer.write(b'patch:' + sys.stdin.buffer.read()[8:13])"
+        command = [sys.executable, "-c", code]
+        self.update_settings(deltas="bsdiff")
+        files = [(self.record_ids[0], "data.txt", b"first version" * 10)]
+        first = self.batch_upload(files=files).json["responses"][0]["body"]
+        files = [(self.record_ids[0], "data.txt", b"second version" * 10)]
+        with mock.patch("kinto_attachment.deltas._command", return_value=command):
+            second = self.batch_upload(files=files).json["responses"][0]["body"]
+        self.assertEqual(second["delta"]["from_hash"], first["hash"])
+        self.assertEqual(second["delta"]["hash"], sha256(b"patch:first"))
+        self.assertEqual(self.get_record(self.record_ids[0])["attachment"], second)
+
+    def test_keep_old_files_setting_is_honored(self):
+        self.update_settings(keep_old_files="true")
+        first = self.batch_upload().json["responses"]
+        self.batch_upload()
+        old_location = first[0]["body"]["location"].replace(self.base_url, "")
+        self.assertTrue(self.backend.exists(old_location))
+
+
+class GCloudBatchUploadTest(BatchUploadTest, BaseWebTestGCloud, unittest.TestCase):
+    pass
@@ -0,0 +1,100 @@
+import gzip
+import io
+import sys
+import unittest
+from unittest import mock
+
+from pyramid.exceptions import ConfigurationError
+
+from kinto_attachment import compression
+
+
+class FakeCompressor:
+    """Stand-in for the ``brotli`` and ``zstandard`` compressors, which reverse bytes."""
+
+    def __init__(self):
+        self.data = b""
+
+    def process(self, chunk):
+        self.data += chunk
+        return b""
+
+    compress = process
+
+    def finish(self):
+        return self.data[::-1]
+
+    flush = finish
+
+
+class CheckEncodingTest(unittest.TestCase):
+    def test_unknown_encodings_are_rejected(self):
+        with self.assertRaises(ConfigurationError):
+            compression.check_encoding("lzma")
+
+    def test_missing_libraries_are_reported(self):
+        with mock.patch.dict(sys.modules, {"brotli": None}):
+            with self.assertRaises(ConfigurationError):
+                compression.check_encoding("br")
+
+    def test_gzip_is_always_available(self):
+        compression.check_encoding("gzip")
+
+
+class IsCompressibleTest(unittest.TestCase):
+    def test_text_formats_are_compressible(self):
+        for mimetype in ("text/csv", "application/json", "application/geo+json; charset=utf-8"):
+            self.assertTrue(compression.is_compressible(mimetype))
+
+    def test_compressed_formats_are_not(self):
+        for mimetype in ("image/jpeg", "application/zip", None):
+            self.assertFalse(compression.is_compressible(mimetype))
+
+
+class CompressTest(unittest.TestCase):
+    content = b'{"key": "value"}' * 1000
+
+    def test_gzip_variant_has_hash_and_size_of_compressed_bytes(self):
+        variant = compression.compress(io.BytesIO(self.content), len(self.content), "gzip")
+        data = variant.file.read()
+        self.assertEqual(gzip.decompress(data), self.content)
+        self.assertEqual(variant.size, len(data))
+        self.assertEqual(variant.encoding, "gzip")
+
+    def test_gzip_variants_are_reproducible(self):
+        first = compression.compress(io.BytesIO(self.content), len(self.content), "gzip")
+        second = compression.compress(io.BytesIO(self.content), len(self.content), "gzip")
+        self.assertEqual(first.hash, second.hash)
+
+    def test_source_file_is_rewound(self):
+        source = io.BytesIO(self.content)
+        compression.compress(source, len(self.content), "gzip")
+        self.assertEqual(source.tell(), 0)
+
+    def test_large_files_are_compressed_into_a_temporary_file(self):
+        with mock.patch.object(compression, "INLINE_MAX_SIZE", 10):
+            variant = compression.compress(io.BytesIO(self.content), len(self.content), "gzip")
+        self.assertNotIsInstance(variant.file, io.BytesIO)
+        self.assertEqual(gzip.decompress(variant.file.read()), self.content)
+
+    def test_temporary_file_is_closed_on_failure(self):
+        output = mock.MagicMock()
+        with mock.patch.object(compression, "INLINE_MAX_SIZE", 10):
+            with mock.patch("tempfile.TemporaryFile", return_value=output):
+                with mock.patch.object(compression, "_compress", side_effect=IOError):
+                    with self.assertRaises(IOError):
+                        compression.compress(io.BytesIO(self.content), len(self.content), "gzip")
+        output.close.assert_called_with()
+
+    def test_brotli_variants(self):
+        brotli = mock.Mock(Compressor=FakeCompressor)
+        with mock.patch.dict(sys.modules, {"brotli": brotli}):
+            variant = compression.compress(io.BytesIO(b"abc"), 3, "br")
+        self.assertEqual(variant.file.read(), b"cba")
+
+    def test_zstd_variants(self):
+        zstandard = mock.Mock()
+        zstandard.ZstdCompressor.return_value.compressobj = FakeCompressor
+        with mock.patch.dict(sys.modules, {"zstandard": zstandard}):
+            variant = compression.compress(io.BytesIO(b"abc"), 3, "zstd")
+        self.assertEqual(variant.file.read(), b"cba")
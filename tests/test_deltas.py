@@ -0,0 +1,259 @@
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from pyramid.exceptions import ConfigurationError
+
+from kinto_attachment import deltas, diffing
+
+
+def encode(old, new):
+    """:returns: the input of the diff script for the *old* and *new* versions."""
+    return diffing.LENGTH_HEADER.pack(len(old)) + old + new
+
+
+def stdin_file(old, new=b""):
+    f = tempfile.TemporaryFile()
+    f.write(encode(old, new))
+    f.seek(0)
+    return f
+
+
+class FakeZstandard:
+    """Stand-in for the ``zstandard`` module, which records the dictionary in use."""
+
+    DICT_TYPE_RAWCONTENT = 1
+
+    def ZstdCompressionDict(self, data, dict_type):
+        return (data, dict_type)
+
+    def ZstdCompressor(self, level, dict_data):
+        return mock.Mock(compress=lambda data: b"zstd:" + dict_data[0][:4] + data[:4])
+
+
+class CheckAlgorithmTest(unittest.TestCase):
+    def test_unknown_algorithms_are_rejected(self):
+        with self.assertRaises(ConfigurationError):
+            deltas.check_algorithm("xdelta")
+
+    def test_missing_libraries_are_reported(self):
+        for algorithm, module in (("zstd", "zstandard"), ("bsdiff", "bsdiff4")):
+            with mock.patch.dict(sys.modules, {module: None}):
+                with self.assertRaises(ConfigurationError):
+                    deltas.check_algorithm(algorithm)
+
+    def test_installed_libraries_are_accepted(self):
+        with mock.patch.dict(sys.modules, {"zstandard": FakeZstandard()}):
+            deltas.check_algorithm("zstd")
+
+
+class CheckPythonTest(unittest.TestCase):
+    def test_current_interpreter_is_used_by_default(self):
+        deltas.check_python({})
+
+    def test_uwsgi_binary_is_rejected(self):
+        with mock.patch.object(sys, "executable", "/usr/bin/uwsgi"):
+            with self.assertRaises(ConfigurationError) as cm:
+                deltas.check_python({})
+        self.assertIn("attachment.delta_python", str(cm.exception))
+
+    def test_configured_interpreter_must_exist(self):
+        with self.assertRaises(ConfigurationError):
+            deltas.check_python({"attachment.delta_python": "/nowhere/bin/python3"})
+        deltas.check_python({"attachment.delta_python": sys.executable})
+
+
+class DiffTest(unittest.TestCase):
+    def test_zstd_patches_use_the_previous_version_as_dictionary(self):
+        with mock.patch.dict(sys.modules, {"zstandard": FakeZstandard()}):
+            self.assertEqual(diffing.diff("zstd", b"old-file", b"new-file"), b"zstd:old-new-")
+
+    def test_bsdiff_patches_use_bsdiff4(self):
+        bsdiff4 = mock.Mock(diff=mock.Mock(return_value=b"patch"))
+        with mock.patch.dict(sys.modules, {"bsdiff4": bsdiff4}):
+            self.assertEqual(diffing.diff("bsdiff", b"old", b"new"), b"patch")
+        bsdiff4.diff.assert_called_with(b"old", b"new")
+
+    def test_script_reads_both_versions_and_writes_the_patch(self):
+        stdout = io.BytesIO()
+        with mock.patch.dict(sys.modules, {"zstandard": FakeZstandard()}):
+            diffing.main(["zstd"], io.BytesIO(encode(b"old-file", b"new")), stdout)
+        self.assertEqual(stdout.getvalue(), b"zstd:old-new")
+
+
+class RunDiffTest(unittest.TestCase):
+    def command(self, code):
+        return mock.patch.object(deltas, "_command", return_value=[sys.executable, "-c", code])
+
+    def run_diff(self, algorithm, timeout, **kwargs):
+        with stdin_file(b"old", b"new") as stdin:
+            return deltas.run_diff(algorithm, stdin, timeout, **kwargs)
+
+    def test_patch_is_read_from_the_process_output(self):
+        code = "import sys; sys.stdout.buffer.write(sys.stdin.buffer.read()[8:])"
+        with self.command(code):
+            self.assertEqual(self.run_diff("zstd", 10), b"oldnew")
+
+    def test_slow_processes_are_killed(self):
+        started = time.monotonic()
+        with self.command("import time; time.sleep(60)"):
+            with self.assertRaises(subprocess.TimeoutExpired):
+                self.run_diff("zstd", 0.5)
+        self.assertLess(time.monotonic() - started, 30)
+
+    def test_script_is_run_in_a_separate_interpreter(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, "bsdiff4.py"), "w") as f:
+                f.write("def diff(old, new):\n    return b'fake:' + old + new\n")
+            with mock.patch.dict(os.environ, {"PYTHONPATH": folder}):
+                self.assertEqual(self.run_diff("bsdiff", 30), b"fake:oldnew")
+
+    def test_script_is_run_with_the_given_interpreter(self):
+        with mock.patch("subprocess.run") as run:
+            self.run_diff("zstd", 30, python="/opt/python3")
+        (command,), _ = run.call_args
+        self.assertEqual(command[0], "/opt/python3")
+
+    def test_script_failures_are_raised(self):
+        with self.command("raise SystemExit('no diff')"):
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                self.run_diff("zstd", 30)
+        self.assertIn(b"no diff", cm.exception.stderr)
+
+
+class AttachDeltaTest(unittest.TestCase):
+    new = b"new content" * 100
+
+    def setUp(self):
+        self.request = mock.MagicMock()
+        self.request.registry.settings = {"attachment.delta_timeout_seconds": "0.5"}
+        self.request.registry.attachment_policies = {}
+        self.content = mock.Mock(file=io.BytesIO(self.new))
+        self.attachment = {"hash": "b" * 64, "size": len(self.new)}
+        patcher = mock.patch.object(deltas.utils, "get_policy")
+        patcher.start().return_value.deltas = "bsdiff"
+        self.addCleanup(patcher.stop)
+
+    def attach(self, run_diff):
+        with mock.patch.object(deltas, "run_diff", run_diff):
+            with mock.patch.object(deltas.utils, "link_file") as self.link_file:
+                with stdin_file(b"old") as stdin:
+                    deltas.attach_delta(
+                        self.request, self.attachment, ("a" * 64, stdin), self.content, None
+                    )
+
+    def test_patch_is_stored_and_described(self):
+        self.request.attachment.save_file.return_value = "aaaa-bbbb.bsdiff"
+        self.request.attachment.url.return_value = "http://files/aaaa-bbbb.bsdiff"
+        inputs = []
+        self.attach(
+            lambda algorithm, stdin, timeout, python: inputs.append(stdin.read()) or b"patch"
+        )
+        self.assertEqual(inputs, [encode(b"old", self.new)])
+        self.assertEqual(self.attachment["delta"]["size"], 5)
+        self.assertEqual(self.attachment["delta"]["from_hash"], "a" * 64)
+        self.assertEqual(self.attachment["delta"]["location"], "http://files/aaaa-bbbb.bsdiff")
+        args, kwargs = self.request.attachment.save_file.call_args
+        self.assertEqual(args[1], "a" * 16 + "-" + "b" * 16 + ".bsdiff")
+        self.assertEqual(self.content.file.tell(), 0)
+        self.link_file.assert_called_with(
+            self.request, "aaaa-bbbb.bsdiff", content_hash=self.attachment["delta"]["hash"]
+        )
+
+    def test_large_patches_are_not_stored(self):
+        self.attach(lambda algorithm, stdin, timeout, python: self.new)
+        self.assertNotIn("delta", self.attachment)
+        self.assertFalse(self.request.attachment.save_file.called)
+
+    def test_slow_patches_are_given_up(self):
+        run_diff = mock.Mock(side_effect=subprocess.TimeoutExpired("diff", 0.5))
+        with self.assertLogs("kinto_attachment.deltas", level="WARNING"):
+            self.attach(run_diff)
+        self.assertNotIn("delta", self.attachment)
+
+    def test_failed_patches_are_skipped(self):
+        error = subprocess.CalledProcessError(1, "diff", stderr=b"No module named 'bsdiff4'")
+        with self.assertLogs("kinto_attachment.deltas", level="WARNING") as cm:
+            self.attach(mock.Mock(side_effect=error))
+        self.assertIn("bsdiff4", cm.output[0])
+        self.assertNotIn("delta", self.attachment)
+
+    def test_identical_versions_are_skipped(self):
+        self.attachment["hash"] = "a" * 64
+        run_diff = mock.Mock()
+        self.attach(run_diff)
+        self.assertFalse(run_diff.called)
+        self.assertNotIn("delta", self.attachment)
+
+
+class PreviousVersionTest(unittest.TestCase):
+    def setUp(self):
+        self.request = mock.MagicMock()
+        self.request.registry.settings = {}
+        self.request.attachment.base_url = "http://files/"
+        self.request.attachment.download.side_effect = lambda name, f: f.write(b"old")
+        self.request.context.current_object = {
+            "attachment": {"hash": "a" * 64, "size": 3, "location": "http://files/old.bin"}
+        }
+        self.content = deltas.cgi.FieldStorage()
+        self.content.file = io.BytesIO(b"new")
+        patcher = mock.patch.object(deltas.utils, "get_policy")
+        patcher.start().return_value.deltas = "bsdiff"
+        self.addCleanup(patcher.stop)
+
+    def previous_version(self, content=None):
+        with deltas.previous_version(self.request, "attachment", content or self.content) as p:
+            if p is None:
+                return None
+            from_hash, stdin = p
+            stdin.seek(0)
+            return from_hash, stdin.read()
+
+    def test_previous_version_is_copied_from_the_storage(self):
+        self.assertEqual(self.previous_version(), ("a" * 64, encode(b"old", b"")))
+        self.request.attachment.download.assert_called_with("old.bin", mock.ANY)
+        self.assertEqual(self.content.file.tell(), 0)
+
+    def test_slot_is_held_until_the_end_of_the_block(self):
+        with mock.patch.object(deltas, "_slots", threading.BoundedSemaphore(1)) as slots:
+            with deltas.previous_version(self.request, "attachment", self.content):
+                self.assertFalse(slots.acquire(blocking=False))
+            self.assertTrue(slots.acquire(blocking=False))
+
+    def test_nothing_is_read_when_no_slot_is_free(self):
+        with mock.patch.object(deltas, "_slots", threading.BoundedSemaphore(1)) as slots:
+            slots.acquire()
+            self.assertIsNone(self.previous_version())
+        self.assertFalse(self.request.attachment.download.called)
+
+    def test_files_above_the_size_limit_are_not_read(self):
+        self.request.registry.settings["attachment.delta_max_size_bytes"] = "2"
+        self.assertIsNone(self.previous_version())
+        self.request.registry.settings["attachment.delta_max_size_bytes"] = "3"
+        self.content.file = io.BytesIO(b"larger")
+        self.assertIsNone(self.previous_version())
+        self.assertFalse(self.request.attachment.download.called)
+
+    def test_files_stored_elsewhere_are_skipped(self):
+        self.request.attachment.base_url = "http://cdn/"
+        self.assertIsNone(self.previous_version())
+
+    def test_compressed_versions_are_skipped(self):
+        self.request.context.current_object["attachment"]["compressed"] = {"size": 10}
+        self.assertIsNone(self.previous_version())
+
+    def test_read_failures_are_logged(self):
+        self.request.attachment.download.side_effect = OSError("gone")
+        with self.assertLogs("kinto_attachment.deltas", level="WARNING"):
+            self.assertIsNone(self.previous_version())
+        self.assertTrue(deltas._slots.acquire(blocking=False))
+        deltas._slots.release()
+
+    def test_direct_uploads_are_skipped(self):
+        self.assertIsNone(self.previous_version({"key": "x"}))
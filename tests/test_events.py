@@ -40,3 +40,11 @@ class ResourceChangedTest(BaseWebTest, unittest.TestCase):
         self.assertEqual(payload["record_id"], self.record_id)
         self.assertEqual(payload["collection_id"], "fonts")
         self.assertEqual(payload["bucket_id"], "fennec")
+
+    def test_impacted_objects_contain_old_and_new_records(self):
+        first = self.upload().json
+        second = self.upload().json
+        impacted = listener.received[-1].impacted_objects[0]
+        self.assertEqual(impacted["old"]["attachment"], first)
+        self.assertEqual(impacted["new"]["attachment"], second)
+        self.assertNotIn("__permissions__", impacted["old"])
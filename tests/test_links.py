@@ -0,0 +1,192 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from kinto.core.storage import memory, postgresql
+from kinto.core.utils import sqlalchemy as sa
+
+from kinto_attachment.links import ObjectLinkStore, PostgreSQLLinkStore, load_link_store
+
+from . import get_postgresql_storage
+
+
+COLLECTION_URI = "/buckets/fennec/collections/fonts"
+RECORD_URI = COLLECTION_URI + "/records/abc"
+
+
+def make_link(record_uri=RECORD_URI, location="fennec/fonts/font.jpg", **extra):
+    parts = record_uri.split("/")
+    return {
+        "location": location,
+        "bucket_uri": "/".join(parts[:3]),
+        "collection_uri": "/".join(parts[:5]),
+        "record_uri": record_uri,
+        **extra,
+    }
+
+
+class LoadLinkStoreTest(unittest.TestCase):
+    def test_links_are_stored_as_objects_by_default(self):
+        registry = SimpleNamespace(storage=mock.MagicMock(spec=postgresql.Storage))
+        self.assertIsInstance(load_link_store(registry, {}), ObjectLinkStore)
+
+    def test_link_table_is_used_on_postgresql(self):
+        storage = mock.MagicMock(spec=postgresql.Storage, client=mock.sentinel.client)
+        registry = SimpleNamespace(storage=storage)
+        store = load_link_store(registry, {"attachment.link_table": "true"})
+        self.assertIsInstance(store, PostgreSQLLinkStore)
+        self.assertEqual(store.client, registry.storage.client)
+
+    def test_objects_are_locked_on_postgresql(self):
+        client = mock.MagicMock()
+        storage = mock.MagicMock(spec=postgresql.Storage, client=client)
+        ObjectLinkStore(storage).lock("abc")
+        conn = client.connect.return_value.__enter__.return_value
+        (statement, placeholders), _ = conn.execute.call_args
+        self.assertIn("pg_advisory_xact_lock", str(statement))
+        self.assertEqual(placeholders, {"key": "abc"})
+
+    def test_objects_are_not_locked_on_other_backends(self):
+        storage = mock.MagicMock(spec=memory.Storage)
+        ObjectLinkStore(storage).lock("abc")
+        self.assertEqual(storage.mock_calls, [])
+
+    def test_link_table_falls_back_to_objects_on_other_backends(self):
+        registry = SimpleNamespace(storage=memory.Storage())
+        with self.assertLogs("kinto_attachment.links", level="WARNING"):
+            store = load_link_store(registry, {"attachment.link_table": "true"})
+        self.assertIsInstance(store, ObjectLinkStore)
+
+
+class LinkStoreTest(object):
+    def test_links_are_listed_by_record_collection_or_bucket(self):
+        link = self.store.create(make_link(content_hash="abc"))
+        self.store.create(make_link(RECORD_URI.replace("fennec", "other"), "other.jpg"))
+        for field in ("record_uri", "collection_uri", "bucket_uri"):
+            (listed,) = self.store.list(field, [link[field]])
+            self.assertEqual(listed["id"], link["id"])
+            self.assertEqual(listed["location"], link["location"])
+            self.assertEqual(listed["record_uri"], link["record_uri"])
+            self.assertEqual(listed["content_hash"], "abc")
+
+    def test_links_of_several_records_are_listed_at_once(self):
+        uris = [RECORD_URI + str(i) for i in range(3)]
+        for uri in uris:
+            self.store.create(make_link(uri, uri + ".jpg"))
+        self.assertEqual(len(self.store.list("record_uri", uris[:2])), 2)
+        self.assertEqual(len(self.store.list("collection_uri", [COLLECTION_URI], limit=2)), 2)
+        self.assertEqual(self.store.list("record_uri", []), [])
+
+    def test_links_are_deleted(self):
+        self.store.create(make_link())
+        links = self.store.list("record_uri", [RECORD_URI])
+        self.store.delete(links)
+        self.store.delete([])
+        self.assertEqual(self.store.list("record_uri", [RECORD_URI]), [])
+
+    def test_links_are_counted_by_location(self):
+        self.store.create(make_link())
+        self.store.create(make_link(RECORD_URI + "2"))
+        self.assertEqual(self.store.count("fennec/fonts/font.jpg"), 2)
+        self.assertEqual(self.store.count("unknown.jpg"), 0)
+
+    def test_lock_can_be_taken_again_in_the_same_transaction(self):
+        self.store.lock("abc")
+        self.store.lock("abc")
+
+
+class ObjectLinkStoreTest(LinkStoreTest, unittest.TestCase):
+    def setUp(self):
+        self.store = ObjectLinkStore(memory.Storage())
+
+
+class PostgreSQLLinkStoreTest(LinkStoreTest, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.storage = get_postgresql_storage()
+
+    def setUp(self):
+        self.store = PostgreSQLLinkStore(self.storage.client)
+        self.addCleanup(self.flush)
+
+    def flush(self):
+        with self.storage.client.connect(force_commit=True) as conn:
+            conn.execute(sa.text("DELETE FROM attachment_links;"))
+
+
+class PostgreSQLLinkStoreQueriesTest(unittest.TestCase):
+    """Check the SQL sent by the store, without a database."""
+
+    def setUp(self):
+        self.client = mock.MagicMock()
+        self.conn = self.client.connect.return_value.__enter__.return_value
+        self.store = PostgreSQLLinkStore(self.client)
+
+    def executed(self):
+        (statement, placeholders), _ = self.conn.execute.call_args
+        return str(statement), placeholders
+
+    def test_create_inserts_ids_in_columns(self):
+        self.conn.execute.return_value.fetchone.return_value = SimpleNamespace(id=42)
+        link = self.store.create(make_link())
+        sql, placeholders = self.executed()
+        self.assertIn("INSERT INTO attachment_links", sql)
+        self.assertEqual(placeholders["bucket_id"], "fennec")
+        self.assertEqual(placeholders["collection_id"], "fonts")
+        self.assertEqual(placeholders["record_id"], "abc")
+        self.assertIsNone(placeholders["content_hash"])
+        self.assertEqual(link["id"], 42)
+
+    def test_list_rebuilds_links_from_columns(self):
+        row = SimpleNamespace(
+            id=1,
+            bucket_id="fennec",
+            collection_id="fonts",
+            record_id="abc",
+            location="font.jpg",
+            content_hash=None,
+        )
+        self.conn.execute.return_value.fetchall.return_value = [row]
+        (link,) = self.store.list("collection_uri", ["/buckets/fennec/collections/fonts"], 10)
+        sql, placeholders = self.executed()
+        self.assertIn("(bucket_id = :bucket_id_0 AND collection_id = :collection_id_0)", sql)
+        self.assertIn("LIMIT :limit", sql)
+        self.assertEqual(placeholders["limit"], 10)
+        self.assertEqual(link, {**make_link(location="font.jpg"), "id": 1})
+
+    def test_list_keeps_content_hash_of_shared_files(self):
+        row = SimpleNamespace(
+            id=1,
+            bucket_id="fennec",
+            collection_id="fonts",
+            record_id="abc",
+            location="abc.jpg",
+            content_hash="abc",
+        )
+        self.conn.execute.return_value.fetchall.return_value = [row]
+        (link,) = self.store.list("record_uri", [RECORD_URI])
+        self.assertEqual(link["content_hash"], "abc")
+        self.assertNotIn("LIMIT", self.executed()[0])
+
+    def test_list_without_uris_does_not_query(self):
+        self.assertEqual(self.store.list("record_uri", []), [])
+        self.assertFalse(self.conn.execute.called)
+
+    def test_delete_filters_on_ids(self):
+        self.store.delete([{"id": 1}, {"id": 2}])
+        _, placeholders = self.executed()
+        self.assertEqual(placeholders, {"ids": (1, 2)})
+
+    def test_delete_without_links_does_not_query(self):
+        self.store.delete([])
+        self.assertFalse(self.conn.execute.called)
+
+    def test_count_filters_on_location(self):
+        self.conn.execute.return_value.fetchone.return_value = SimpleNamespace(total=3)
+        self.assertEqual(self.store.count("font.jpg"), 3)
+
+    def test_lock_is_held_until_the_end_of_the_transaction(self):
+        self.store.lock("abc")
+        sql, placeholders = self.executed()
+        self.assertIn("pg_advisory_xact_lock(hashtext(:key))", sql)
+        self.assertEqual(placeholders, {"key": "abc"})
@@ -0,0 +1,240 @@
+import gzip
+import time
+import unittest
+from unittest import mock
+
+from google.cloud.exceptions import NotFound
+from kinto.core.events import ACTIONS, ResourceChanged
+from pyramid.scripting import prepare
+
+from kinto_attachment import outbox
+from kinto_attachment.utils import sha256
+
+from . import BaseWebTestGCloud, BaseWebTestLocal
+
+
+class DeletionOutboxTest(object):
+    def setUp(self):
+        super().setUp()
+        self.update_settings(deletion_outbox="true")
+        self.registry = self.app.app.registry
+
+    def uploaded_location(self, **kwargs):
+        attachment = self.upload(**kwargs).json
+        return attachment["location"].replace(self.base_url, "")
+
+    def pending(self):
+        return self.registry.storage.list_all(
+            outbox._OUTBOX_RESOURCE_NAME, outbox._OUTBOX_PARENT_ID
+        )
+
+    def test_replaced_files_are_queued(self):
+        location = self.uploaded_location()
+        self.upload()
+        self.assertTrue(self.backend.exists(location))
+        self.assertEqual([e["location"] for e in self.pending()], [location])
+
+    def test_deleted_attachments_are_queued(self):
+        location = self.uploaded_location()
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        self.assertTrue(self.backend.exists(location))
+        self.assertEqual([e["location"] for e in self.pending()], [location])
+
+    def test_drain_deletes_queued_files(self):
+        location = self.uploaded_location()
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        self.assertEqual(outbox.drain_deletions(self.registry), 1)
+        self.assertFalse(self.backend.exists(location))
+        self.assertEqual(self.pending(), [])
+
+    def test_drain_processes_batches(self):
+        self.upload()
+        self.upload()
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        self.assertEqual(outbox.drain_deletions(self.registry, batch_size=1), 1)
+        self.assertEqual(len(self.pending()), 1)
+
+    def test_failed_deletions_are_retried_later(self):
+        self.upload()
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        with mock.patch.object(self.backend, "delete", side_effect=IOError):
+            outbox.drain_deletions(self.registry, retry_delay=60)
+        (entry,) = self.pending()
+        self.assertEqual(entry["attempts"], 1)
+        self.assertGreater(entry["next_attempt"], time.time())
+        # Not due yet.
+        self.assertEqual(outbox.drain_deletions(self.registry), 0)
+
+    def test_deletions_are_given_up_after_max_attempts(self):
+        self.upload()
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        with mock.patch.object(self.backend, "delete", side_effect=IOError):
+            outbox.drain_deletions(self.registry, max_attempts=1)
+        self.assertEqual(self.pending(), [])
+
+    def test_files_referenced_again_are_kept(self):
+        self.update_settings(randomize="false", deduplicate="true")
+        location = self.uploaded_location()
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        self.upload()
+        outbox.drain_deletions(self.registry)
+        self.assertTrue(self.backend.exists(location))
+        self.assertEqual(self.pending(), [])
+
+    def test_shared_files_are_deleted_under_the_lock_of_their_hash(self):
+        self.update_settings(deduplicate="true")
+        attachment = self.upload().json
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        (entry,) = self.pending()
+        self.assertEqual(entry["content_hash"], attachment["hash"])
+        with mock.patch.object(self.registry.attachment_links, "lock") as lock:
+            outbox.drain_deletions(self.registry)
+        lock.assert_called_with(attachment["hash"])
+
+    def test_files_uploaded_again_under_the_same_name_are_replaced(self):
+        self.update_settings(randomize="false")
+        self.uploaded_location(files=[(self.file_field, "data.txt", b"first")])
+        location = self.uploaded_location(files=[(self.file_field, "data.txt", b"second")])
+        outbox.drain_deletions(self.registry)
+        self.assertEqual(self.backend.read(location), b"second")
+        self.assertEqual(self.pending(), [])
+
+
+class LocalDeletionOutboxTest(DeletionOutboxTest, BaseWebTestLocal, unittest.TestCase):
+    def test_files_are_deleted_synchronously_by_default(self):
+        self.update_settings(deletion_outbox="false")
+        location = self.uploaded_location()
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        self.assertFalse(self.backend.exists(location))
+        self.assertEqual(self.pending(), [])
+
+    def test_worker_drains_the_queue_and_exits(self):
+        location = self.uploaded_location()
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        closer = mock.MagicMock()
+        env = {**prepare(registry=self.registry), "closer": closer}
+        with mock.patch("kinto_attachment.outbox.bootstrap", return_value=env) as bootstrap:
+            with mock.patch("kinto_attachment.outbox.transaction") as transaction:
+                self.assertEqual(outbox.main(["--ini", "kinto.ini", "--once"]), 0)
+        bootstrap.assert_called_with("kinto.ini")
+        self.assertEqual(transaction.commit.call_count, 2)
+        closer.assert_called_with()
+        self.assertFalse(self.backend.exists(location))
+
+    def test_worker_waits_when_queue_is_empty(self):
+        env = {**prepare(registry=self.registry), "closer": mock.MagicMock()}
+        with mock.patch("kinto_attachment.outbox.bootstrap", return_value=env):
+            with mock.patch("kinto_attachment.outbox.transaction"):
+                with mock.patch("kinto_attachment.outbox.time.sleep") as sleep:
+                    sleep.side_effect = KeyboardInterrupt
+                    with self.assertRaises(KeyboardInterrupt):
+                        outbox.main(["--interval", "5"])
+        sleep.assert_called_with(5)
+        env["closer"].assert_called_with()
+
+
+class GCloudDeletionOutboxTest(DeletionOutboxTest, BaseWebTestGCloud, unittest.TestCase):
+    def test_files_already_deleted_are_not_retried(self):
+        self.upload()
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        bucket = self.backend.get_bucket()
+        with mock.patch.object(bucket, "delete_blob", side_effect=NotFound("gone")):
+            with mock.patch.object(outbox.logger, "warning") as warning:
+                self.assertEqual(outbox.drain_deletions(self.registry), 1)
+        self.assertFalse(warning.called)
+        self.assertEqual(self.pending(), [])
+
+
+class CompressionOffloadTest(object):
+    content = b'{"key": "value"}' * 100
+
+    def setUp(self):
+        super().setUp()
+        self.update_settings(compress="gzip", compress_offload_min_size_bytes="1000")
+        self.registry = self.app.app.registry
+        env = prepare(registry=self.registry)
+        self.addCleanup(env["closer"])
+        self.request = env["request"]
+
+    def upload_json(self, content=None):
+        files = [(self.file_field, "data.json", content or self.content)]
+        return self.upload(files=files).json
+
+    def pending(self):
+        return self.registry.storage.list_all(
+            outbox._COMPRESSIONS_RESOURCE_NAME, outbox._COMPRESSIONS_PARENT_ID
+        )
+
+    def get_attachment(self):
+        return self.app.get(self.record_uri, headers=self.headers).json["data"]["attachment"]
+
+    def test_large_files_are_stored_uncompressed_and_queued(self):
+        attachment = self.upload_json()
+        self.assertNotIn("compressed", attachment)
+        self.assertEqual(attachment["hash"], sha256(self.content))
+        (entry,) = self.pending()
+        self.assertEqual(entry["location"], attachment["location"].replace(self.base_url, ""))
+        self.assertEqual(entry["encoding"], "gzip")
+
+    def test_small_files_are_compressed_during_the_request(self):
+        attachment = self.upload_json(b'{"key": "value"}' * 10)
+        self.assertEqual(attachment["compressed"]["content_encoding"], "gzip")
+        self.assertEqual(self.pending(), [])
+
+    def test_drain_attaches_the_compressed_variant(self):
+        uncompressed = self.upload_json()
+        self.assertEqual(outbox.drain_compressions(self.request), 1)
+        attachment = self.get_attachment()
+        self.assertEqual(attachment["compressed"]["content_encoding"], "gzip")
+        self.assertEqual(attachment["hash"], sha256(self.content))
+        self.assertEqual(attachment["size"], 1600)
+        self.assertNotEqual(attachment["location"], uncompressed["location"])
+        self.assertEqual(gzip.decompress(self.stored_variant(attachment)), self.content)
+        # The uncompressed file is replaced.
+        self.assertFalse(self.backend.exists(uncompressed["location"].replace(self.base_url, "")))
+        self.assertEqual(self.pending(), [])
+
+    def test_drain_notifies_the_record_update(self):
+        self.upload_json()
+        outbox.drain_compressions(self.request)
+        (event,) = self.request.get_resource_events()
+        self.assertIsInstance(event, ResourceChanged)
+        self.assertEqual(event.payload["action"], ACTIONS.UPDATE.value)
+        self.assertEqual(event.payload["record_id"], self.record_id)
+
+    def test_replaced_attachments_are_not_compressed(self):
+        self.upload_json()
+        attachment = self.upload().json
+        outbox.drain_compressions(self.request)
+        self.assertEqual(self.get_attachment(), attachment)
+        self.assertEqual(self.pending(), [])
+
+    def test_variant_is_dropped_if_record_changed_meanwhile(self):
+        uncompressed = self.upload_json()
+        with mock.patch("kinto_attachment.utils.update_unmodified", return_value=None):
+            outbox.drain_compressions(self.request)
+        self.assertEqual(self.get_attachment(), uncompressed)
+        links = self.registry.attachment_links.list("record_uri", [self.record_uri])
+        location = uncompressed["location"].replace(self.base_url, "")
+        self.assertEqual([link["location"] for link in links], [location])
+
+    def test_failed_compressions_are_retried_later(self):
+        self.upload_json()
+        with mock.patch.object(self.backend, "download", side_effect=IOError):
+            outbox.drain_compressions(self.request, retry_delay=60)
+        (entry,) = self.pending()
+        self.assertEqual(entry["attempts"], 1)
+        self.assertGreater(entry["next_attempt"], time.time())
+        self.assertNotIn("compressed", self.get_attachment())
+
+
+class LocalCompressionOffloadTest(CompressionOffloadTest, BaseWebTestLocal, unittest.TestCase):
+    def stored_variant(self, attachment):
+        path = self.backend.path(attachment["compressed"]["location"].replace(self.base_url, ""))
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class GCloudCompressionOffloadTest(CompressionOffloadTest, BaseWebTestGCloud, unittest.TestCase):
+    def stored_variant(self, attachment):
+        return self.backend.read(attachment["compressed"]["location"].replace(self.base_url, ""))
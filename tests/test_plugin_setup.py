@@ -1,18 +1,28 @@
+import sys
 import unittest
 from unittest import mock
 
 import pytest
 from kinto import main as kinto_main
+from kinto.core.metrics import IMetricsService
 from kinto.core.migrations import IMigratable
+from kinto.core.utils import sqlalchemy as sa
 from pyramid import testing
 from pyramid.exceptions import ConfigurationError
 
-from kinto_attachment import __version__, includeme
+from kinto_attachment import (
+    __version__,
+    includeme,
+    post_fork,
+    register_post_fork,
+    warmup_storage,
+)
+from kinto_attachment.links import ObjectLinkStore
 from kinto_attachment.migrations import KintoAttachmentMigration
-from kinto_attachment.storage import IFileStorage
+from kinto_attachment.storage import FileStorage, IFileStorage
 from kinto_attachment.storage.gcloud import GoogleCloudStorage
 
-from . import BaseWebTestLocal
+from . import BaseWebTestLocal, get_postgresql_storage
 
 
 class HelloViewTest(BaseWebTestLocal, unittest.TestCase):
@@ -43,6 +53,7 @@ class IncludeMeTest(unittest.TestCase):
                 "attachment.resources.fennec.keep_old_files": "true",
                 "attachment.resources.fingerprinting.fonts.randomize": "true",
                 "attachment.resources.fennec.filename_pattern": "{datetime}-{rid}-{filename}",
+                "attachment.resources.fennec.deduplicate": "true",
             }
         )
         assert isinstance(config.registry.attachment_resources, dict)
@@ -52,6 +63,10 @@ class IncludeMeTest(unittest.TestCase):
             config.registry.attachment_resources["/buckets/fennec"]["filename_pattern"]
             == "{datetime}-{rid}-{filename}"
         )
+        assert config.registry.attachment_resources["/buckets/fennec"]["deduplicate"] is True
+        policy = config.registry.attachment_policies[("fingerprinting", "fonts")]
+        assert policy.randomize is True
+        assert policy.keep_old_files is False
 
     def test_includeme_raises_error_for_malformed_resource_settings(self):
         with pytest.raises(ConfigurationError) as excinfo:
@@ -68,6 +83,102 @@ class IncludeMeTest(unittest.TestCase):
             "Read `attachment.resources.fennec.base_path`"
         )
 
+    def test_includeme_understands_compress_settings(self):
+        config = self.includeme(
+            settings={
+                "attachment.base_path": "/tmp",
+                "attachment.compress": "gzip",
+                "attachment.resources.fennec.compress": "",
+            }
+        )
+        assert config.registry.attachment_policies[(None, None)].compress == "gzip"
+        assert config.registry.attachment_policies[("fennec", None)].compress is None
+
+    def test_includeme_raises_error_for_unknown_compression(self):
+        for setting in ("attachment.compress", "attachment.resources.fennec.compress"):
+            with pytest.raises(ConfigurationError):
+                self.includeme(settings={"attachment.base_path": "/tmp", setting: "lzma"})
+
+    def test_includeme_only_accepts_gzip_compression_with_gcloud(self):
+        gcloud = {
+            "attachment.gcloud.credentials": "/path/to/credentials.json",
+            "attachment.gcloud.bucket_name": "foo",
+        }
+        config = self.includeme(settings={**gcloud, "attachment.compress": "gzip"})
+        assert config.registry.attachment_policies[(None, None)].compress == "gzip"
+        with mock.patch.dict(sys.modules, {"brotli": mock.Mock(), "zstandard": mock.Mock()}):
+            for setting in ("attachment.compress", "attachment.resources.fennec.compress"):
+                for value in ("br", "zstd"):
+                    with pytest.raises(ConfigurationError) as excinfo:
+                        self.includeme(settings={**gcloud, setting: value})
+                    assert "not supported by Google Cloud Storage" in str(excinfo.value)
+
+    def test_includeme_understands_deltas_settings(self):
+        with mock.patch.dict(sys.modules, {"bsdiff4": mock.MagicMock()}):
+            config = self.includeme(
+                settings={
+                    "attachment.base_path": "/tmp",
+                    "attachment.deltas": "bsdiff",
+                    "attachment.resources.fennec.deltas": "",
+                }
+            )
+        assert config.registry.attachment_policies[(None, None)].deltas == "bsdiff"
+        assert config.registry.attachment_policies[("fennec", None)].deltas is None
+
+    def test_includeme_requires_a_python_interpreter_for_deltas(self):
+        python = sys.executable
+        with mock.patch.dict(sys.modules, {"bsdiff4": mock.MagicMock()}):
+            with mock.patch.object(sys, "executable", "/usr/bin/uwsgi"):
+                with pytest.raises(ConfigurationError):
+                    self.includeme(
+                        settings={
+                            "attachment.base_path": "/tmp",
+                            "attachment.resources.fennec.deltas": "bsdiff",
+                        }
+                    )
+                self.includeme(
+                    settings={
+                        "attachment.base_path": "/tmp",
+                        "attachment.resources.fennec.deltas": "bsdiff",
+                        "attachment.delta_python": python,
+                    }
+                )
+
+    def test_includeme_raises_error_for_unavailable_deltas(self):
+        with mock.patch.dict(sys.modules, {"bsdiff4": None}):
+            for setting in ("attachment.deltas", "attachment.resources.fennec.deltas"):
+                for value in ("xdelta", "bsdiff"):
+                    with pytest.raises(ConfigurationError):
+                        self.includeme(settings={"attachment.base_path": "/tmp", setting: value})
+
+    def test_includeme_refuses_deletion_outbox_in_memory(self):
+        with pytest.raises(ConfigurationError) as excinfo:
+            self.includeme(
+                settings={"attachment.base_path": "/tmp", "attachment.deletion_outbox": "true"}
+            )
+        assert "requires a persistent storage backend" in str(excinfo.value)
+
+    def test_includeme_refuses_compression_offload_in_memory(self):
+        with pytest.raises(ConfigurationError) as excinfo:
+            self.includeme(
+                settings={
+                    "attachment.base_path": "/tmp",
+                    "attachment.compress_offload_min_size_bytes": "1048576",
+                }
+            )
+        assert "`attachment.compress_offload_min_size_bytes` requires a persistent" in str(
+            excinfo.value
+        )
+
+    def test_includeme_raises_error_for_unknown_heartbeat_mode(self):
+        with pytest.raises(ConfigurationError) as excinfo:
+            self.includeme(
+                settings={"attachment.base_path": "/tmp", "attachment.heartbeat_mode": "read"}
+            )
+        assert str(excinfo.value) == (
+            "`attachment.heartbeat_mode` should be one of write, probe, not `read`"
+        )
+
     def test_base_url_is_added_a_trailing_slash(self):
         config = self.includeme(
             settings={
@@ -86,6 +197,57 @@ class IncludeMeTest(unittest.TestCase):
         )
         assert isinstance(config.registry.queryUtility(IFileStorage), GoogleCloudStorage)
 
+    def test_storage_is_not_warmed_up_by_default(self):
+        config = self.includeme(settings={"attachment.base_path": "/tmp"})
+        with mock.patch.object(FileStorage, "warmup") as warmup:
+            config.make_wsgi_app()
+        self.assertFalse(warmup.called)
+
+    def test_storage_is_warmed_up_at_startup_and_after_fork(self):
+        config = self.includeme(
+            settings={"attachment.base_path": "/tmp", "attachment.warmup": "true"}
+        )
+        with mock.patch.object(FileStorage, "warmup") as warmup:
+            with mock.patch("kinto_attachment.register_post_fork") as register_post_fork:
+                config.make_wsgi_app()
+            self.assertEqual(warmup.call_count, 1)
+            (callback,), _ = register_post_fork.call_args
+            callback()
+            self.assertEqual(warmup.call_count, 2)
+
+    def test_storage_warmup_is_timed(self):
+        config = self.includeme(settings={"attachment.base_path": "/tmp"})
+        metrics = mock.MagicMock()
+        config.registry.registerUtility(metrics, IMetricsService)
+        warmup_storage(config.registry)
+        metrics.timer.assert_called_with("attachments.warmup.seconds")
+
+    def test_storage_uses_the_metrics_service(self):
+        config = self.includeme(settings={"attachment.base_path": "/tmp"})
+        config.make_wsgi_app()
+        storage_impl = config.registry.getUtility(IFileStorage)
+        self.assertIs(storage_impl.metrics, config.registry.metrics)
+
+    def test_storage_warmup_failures_are_logged(self):
+        config = self.includeme(settings={"attachment.base_path": "/tmp"})
+        with mock.patch.object(FileStorage, "warmup", side_effect=IOError):
+            with self.assertLogs("kinto_attachment", level="WARNING"):
+                warmup_storage(config.registry)
+
+    def test_post_fork_callbacks_use_uwsgi_when_available(self):
+        uwsgidecorators = mock.Mock()
+        with mock.patch.dict(sys.modules, {"uwsgidecorators": uwsgidecorators}):
+            register_post_fork(mock.sentinel.callback)
+        uwsgidecorators.postfork.assert_called_with(mock.sentinel.callback)
+
+    def test_post_fork_callbacks_are_run_by_the_gunicorn_hook(self):
+        callback = mock.Mock()
+        with mock.patch("kinto_attachment._post_fork_callbacks", []):
+            register_post_fork(callback)
+            self.assertFalse(callback.called)
+            post_fork(mock.sentinel.server, mock.sentinel.worker)
+        callback.assert_called_with()
+
     def test_error_if_no_backend_is_configured(self):
         with pytest.raises(ConfigurationError):
             self.includeme(settings={})
@@ -101,6 +263,122 @@ class MigrationTest(BaseWebTestLocal, unittest.TestCase):
     def test_migration_call(self):
         # Useless since using memory backend, just for code coverage.
         migration = KintoAttachmentMigration()
-        assert migration.schema_version == 2
+        assert migration.schema_version == 5
         migration.client = mock.MagicMock()
         migration.migrate_schema(start_version=1, dry_run=True)
+
+    def test_migration_from_version_2_creates_indexes(self):
+        migration = KintoAttachmentMigration()
+        migration.client = mock.MagicMock()
+        migration.migrate_schema(start_version=2)
+        conn = migration.client.connect.return_value.__enter__.return_value
+        ((statement,), _) = conn.execute.call_args_list[0]
+        sql = str(statement)
+        assert conn.execute.call_count == 3
+        assert "ON objects ((data->'record_uri'))" in sql
+        assert "ON objects ((data->'collection_uri'))" in sql
+        assert "ON objects ((data->'bucket_uri'))" in sql
+        assert "VALUES ('kinto_attachment_schema_version', '3')" in sql
+
+    def test_migration_from_version_3_creates_link_table(self):
+        migration = KintoAttachmentMigration()
+        migration.client = mock.MagicMock()
+        migration.migrate_schema(start_version=3)
+        conn = migration.client.connect.return_value.__enter__.return_value
+        ((statement,), _) = conn.execute.call_args_list[0]
+        assert conn.execute.call_count == 2
+        assert "CREATE TABLE IF NOT EXISTS attachment_links" in str(statement)
+
+    def test_migration_from_version_4_only_indexes_locations(self):
+        migration = KintoAttachmentMigration()
+        migration.client = mock.MagicMock()
+        migration.migrate_schema(start_version=4)
+        conn = migration.client.connect.return_value.__enter__.return_value
+        ((statement,), _) = conn.execute.call_args
+        assert conn.execute.call_count == 1
+        assert "ON objects ((data->'location'))" in str(statement)
+        assert "VALUES ('kinto_attachment_schema_version', '5')" in str(statement)
+
+    def get_executed_sql(self, migration, dry_run=False, link_table_version=None):
+        versions = {
+            "kinto_attachment_schema_version": "5",
+            "kinto_attachment_link_table_schema_version": link_table_version,
+        }
+
+        def execute(statement, params=None):
+            version = versions.get((params or {}).get("key"))
+            result = mock.Mock()
+            result.fetchone.return_value = mock.Mock(version=version) if version else None
+            return result
+
+        client = mock.MagicMock()
+        conn = client.connect.return_value.__enter__.return_value
+        conn.execute.side_effect = execute
+        migration.initialize_schema(client, dry_run=dry_run)
+        return [str(args[0]) for args, _ in conn.execute.call_args_list]
+
+    def test_links_are_moved_to_the_table_if_enabled(self):
+        executed = self.get_executed_sql(KintoAttachmentMigration(link_table=True))
+        assert "INSERT INTO attachment_links" in executed[-2]
+        assert "DELETE FROM objects" in executed[-2]
+        assert "VALUES ('kinto_attachment_link_table_schema_version', '2')" in executed[-1]
+
+    def test_links_are_moved_only_once(self):
+        migration = KintoAttachmentMigration(link_table=True)
+        executed = self.get_executed_sql(migration, link_table_version="2")
+        assert not any("INSERT INTO attachment_links" in sql for sql in executed)
+
+    def test_links_are_not_moved_if_disabled(self):
+        executed = self.get_executed_sql(KintoAttachmentMigration())
+        assert not any("link_table" in sql for sql in executed)
+
+    def test_links_are_not_moved_on_dry_run(self):
+        executed = self.get_executed_sql(KintoAttachmentMigration(link_table=True), dry_run=True)
+        assert not any("INSERT INTO attachment_links" in sql for sql in executed)
+
+
+class PostgreSQLLinkIndexesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.storage = get_postgresql_storage()
+
+    def setUp(self):
+        for i in range(100):
+            link = {
+                "location": "file-%d.jpg" % i,
+                "bucket_uri": "/buckets/b%d" % i,
+                "collection_uri": "/buckets/b%d/collections/c" % i,
+                "record_uri": "/buckets/b%d/collections/c/records/r" % i,
+            }
+            self.storage.create("attachments", "__attachments__", link)
+        self.addCleanup(self.storage.flush)
+
+    def explain(self, query):
+        with self.storage.client.connect(readonly=True) as conn:
+            conn.execute(sa.text("SET LOCAL enable_seqscan = off;"))
+            rows = conn.execute(sa.text("EXPLAIN " + query.statement), query.params).fetchall()
+        return "\n".join(row[0] for row in rows)
+
+    def captured_query(self, call):
+        # Plan the exact queries issued by the link store.
+        store = ObjectLinkStore(self.storage)
+        captured = []
+        execute = sa.orm.Session.execute
+
+        def capture(session, statement, params=None, *args, **kwargs):
+            if "FROM objects" in str(statement) and not captured:
+                captured.append(mock.Mock(statement=str(statement), params=params))
+            return execute(session, statement, params, *args, **kwargs)
+
+        with mock.patch.object(sa.orm.Session, "execute", capture):
+            call(store)
+        return captured[0]
+
+    def test_link_lookups_use_indexes(self):
+        for field in ("record_uri", "collection_uri", "bucket_uri"):
+            query = self.captured_query(lambda store: store.list(field, ["/buckets/b1"]))
+            self.assertIn("idx_objects_attachments_%s" % field, self.explain(query))
+
+    def test_reference_counts_use_index(self):
+        query = self.captured_query(lambda store: store.count("file-1.jpg"))
+        self.assertIn("idx_objects_attachments_location", self.explain(query))
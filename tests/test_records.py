@@ -0,0 +1,88 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from kinto.core.storage import memory, postgresql
+
+from kinto_attachment.records import update_unmodified
+
+from . import get_postgresql_storage
+
+
+PARENT_ID = "/buckets/fennec/collections/fonts"
+
+
+class UpdateUnmodifiedTest(object):
+    def setUp(self):
+        self.record = self.storage.create("record", PARENT_ID, {"family": "sans"})
+        self.addCleanup(self.storage.delete_all, "record", PARENT_ID, with_deleted=True)
+
+    def update(self, last_modified):
+        obj = {**self.record, "family": "serif"}
+        obj.pop("last_modified")
+        return update_unmodified(
+            self.storage, "record", PARENT_ID, self.record["id"], obj, last_modified
+        )
+
+    def test_unmodified_records_are_updated(self):
+        stored = self.update(self.record["last_modified"])
+        self.assertEqual(stored["family"], "serif")
+        self.assertGreater(stored["last_modified"], self.record["last_modified"])
+        current = self.storage.get("record", PARENT_ID, self.record["id"])
+        self.assertEqual(current, stored)
+
+
+class ConditionalUpdateTest(UpdateUnmodifiedTest):
+    def test_modified_records_are_left_unchanged(self):
+        self.assertIsNone(self.update(self.record["last_modified"] - 1))
+        current = self.storage.get("record", PARENT_ID, self.record["id"])
+        self.assertEqual(current["family"], "sans")
+
+    def test_deleted_records_are_not_recreated(self):
+        self.storage.delete("record", PARENT_ID, self.record["id"])
+        self.assertIsNone(self.update(self.record["last_modified"]))
+        self.assertEqual(self.storage.list_all("record", PARENT_ID), [])
+
+
+class MemoryUpdateUnmodifiedTest(UpdateUnmodifiedTest, unittest.TestCase):
+    def setUp(self):
+        self.storage = memory.Storage()
+        super().setUp()
+
+    def test_record_is_not_read_again(self):
+        # Best-effort: the version was checked when the record was fetched.
+        with mock.patch.object(self.storage, "get") as get:
+            self.update(self.record["last_modified"])
+        self.assertFalse(get.called)
+
+
+class PostgreSQLUpdateUnmodifiedTest(ConditionalUpdateTest, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.storage = get_postgresql_storage()
+
+
+class PostgreSQLUpdateUnmodifiedQueriesTest(unittest.TestCase):
+    """Check the SQL sent to PostgreSQL, without a database."""
+
+    def setUp(self):
+        self.storage = mock.MagicMock(spec=postgresql.Storage, client=mock.MagicMock())
+        self.conn = self.storage.client.connect.return_value.__enter__.return_value
+        self.result = self.conn.execute.return_value
+
+    def update(self):
+        obj = {"id": "abc", "family": "serif"}
+        return update_unmodified(self.storage, "record", PARENT_ID, "abc", obj, 42)
+
+    def test_update_is_conditioned_on_the_timestamp(self):
+        self.result.fetchone.return_value = SimpleNamespace(last_modified=43)
+        self.assertEqual(self.update(), {"id": "abc", "family": "serif", "last_modified": 43})
+        (statement, placeholders), _ = self.conn.execute.call_args
+        self.assertIn("AND last_modified = from_epoch(:last_modified)", str(statement))
+        self.assertEqual(placeholders["last_modified"], 42)
+        self.assertEqual(placeholders["data"], '{"family": "serif"}')
+        self.assertFalse(self.storage.get.called)
+
+    def test_nothing_is_returned_if_no_row_matches(self):
+        self.result.fetchone.return_value = None
+        self.assertIsNone(self.update())
@@ -0,0 +1,363 @@
+import base64
+import hashlib
+import io
+import time
+import unittest
+from unittest import mock
+
+from kinto.core.errors import ERRORS
+
+from kinto_attachment.utils import sha256
+
+from . import BaseWebTestGCloud, BaseWebTestLocal, get_user_headers
+from .storage import _FakeGCSBlob
+
+
+class ResumableUploadTest(object):
+    def setUp(self):
+        super().setUp()
+        self.uploads_uri = self.endpoint_uri + "/uploads"
+
+    def create_upload(self, body=None, status=201):
+        body = body if body is not None else {"filename": "font.jpg", "size": 12}
+        return self.app.post_json(self.uploads_uri, body, headers=self.headers, status=status)
+
+    def put_chunk(self, upload_uri, data, start, total="*", status=200):
+        headers = {
+            **self.headers,
+            "Content-Type": "application/octet-stream",
+            "Content-Range": "bytes {}-{}/{}".format(start, start + len(data) - 1, total),
+        }
+        return self.app.put(upload_uri, data, headers=headers, status=status)
+
+    def start_upload(self, **kwargs):
+        session = self.create_upload(**kwargs).json
+        return session, "{}/{}".format(self.uploads_uri, session["id"])
+
+    def finalize(self, upload_uri, body=None, status=201):
+        resp = self.app.post_json(upload_uri, body or {}, headers=self.headers, status=status)
+        if 200 <= resp.status_code < 300:
+            self._add_to_cleanup(resp.json)
+        return resp
+
+    def test_session_is_created(self):
+        session = self.create_upload().json
+        self.assertEqual(session["offset"], 0)
+        self.assertEqual(session["size"], 12)
+        self.assertEqual(session["filename"], "font.jpg")
+        self.assertGreater(session["expires"], time.time())
+
+    def test_offset_is_committed_after_each_chunk(self):
+        _, upload_uri = self.start_upload()
+        resp = self.put_chunk(upload_uri, b"abcdef", 0)
+        self.assertEqual(resp.json["offset"], 6)
+        resp = self.app.get(upload_uri, headers=self.headers)
+        self.assertEqual(resp.json["offset"], 6)
+
+    def test_upload_is_finalized_into_attachment(self):
+        _, upload_uri = self.start_upload()
+        self.put_chunk(upload_uri, b"abcdef", 0, total=12)
+        self.put_chunk(upload_uri, b"ghijkl", 6, total=12)
+        attachment = self.finalize(upload_uri, {"data": {"family": "sans"}}).json
+        self.assertEqual(attachment["hash"], sha256(b"abcdefghijkl"))
+        self.assertEqual(attachment["size"], 12)
+        self.assertEqual(attachment["filename"], "font.jpg")
+
+        resp = self.app.get(self.record_uri, headers=self.headers)
+        self.assertEqual(resp.json["data"]["attachment"], attachment)
+        self.assertEqual(resp.json["data"]["family"], "sans")
+
+    def test_session_is_removed_once_finalized(self):
+        _, upload_uri = self.start_upload(body={"filename": "font.jpg"})
+        self.put_chunk(upload_uri, b"abc", 0)
+        resp = self.app.post(upload_uri, headers=self.headers, status=201)
+        self._add_to_cleanup(resp.json)
+        self.app.get(upload_uri, headers=self.headers, status=404)
+
+    def test_chunk_must_start_at_committed_offset(self):
+        _, upload_uri = self.start_upload()
+        self.put_chunk(upload_uri, b"abcdef", 0)
+        resp = self.put_chunk(upload_uri, b"ghijkl", 3, status=416)
+        self.assertIn("offset 6", resp.json["message"])
+
+    def test_chunk_committed_meanwhile_is_not_overwritten(self):
+        session, upload_uri = self.start_upload()
+        self.put_chunk(upload_uri, b"abcdef", 0)
+
+        # Another request read the session before the first chunk was committed.
+        storage = self.app.app.registry.storage
+        stored = storage.get("uploads", "__attachment_uploads__", session["id"])
+        with mock.patch.object(storage, "get", return_value={**stored, "offset": 0}):
+            resp = self.put_chunk(upload_uri, b"ABCDEF", 0, status=409)
+        self.assertIn("offset 0", resp.json["message"])
+
+        self.put_chunk(upload_uri, b"ghijkl", 6)
+        attachment = self.finalize(upload_uri).json
+        self.assertEqual(attachment["hash"], sha256(b"abcdefghijkl"))
+
+    def test_content_range_is_required(self):
+        _, upload_uri = self.start_upload()
+        headers = {**self.headers, "Content-Type": "application/octet-stream"}
+        self.app.put(upload_uri, b"abc", headers=headers, status=400)
+
+    def test_content_length_must_match_content_range(self):
+        _, upload_uri = self.start_upload()
+        headers = {
+            **self.headers,
+            "Content-Type": "application/octet-stream",
+            "Content-Range": "bytes 0-9/*",
+        }
+        self.app.put(upload_uri, b"abc", headers=headers, status=400)
+
+    def test_chunk_cannot_exceed_declared_size(self):
+        _, upload_uri = self.start_upload()
+        self.put_chunk(upload_uri, b"x" * 13, 0, status=400)
+
+    def test_incomplete_upload_cannot_be_finalized(self):
+        _, upload_uri = self.start_upload()
+        self.put_chunk(upload_uri, b"abcdef", 0)
+        resp = self.finalize(upload_uri, status=400)
+        self.assertIn("incomplete (6 of 12 bytes)", resp.json["message"])
+
+    def test_empty_upload_cannot_be_finalized(self):
+        _, upload_uri = self.start_upload()
+        self.finalize(upload_uri, status=400)
+
+    def test_finalize_rejects_unknown_fields(self):
+        _, upload_uri = self.start_upload(body={"filename": "font.jpg"})
+        self.put_chunk(upload_uri, b"abc", 0)
+        resp = self.finalize(upload_uri, {"foo": 1}, status=400)
+        self.assertIn("'foo' not in ('data', 'permissions')", resp.json["message"])
+
+    def test_finalize_validates_extension(self):
+        _, upload_uri = self.start_upload(body={"filename": "virus.exe"})
+        self.put_chunk(upload_uri, b"abc", 0)
+        resp = self.finalize(upload_uri, status=400)
+        self.assertEqual(resp.json["message"], "body: File extension is not allowed.")
+
+    def test_upload_can_be_aborted(self):
+        _, upload_uri = self.start_upload()
+        self.put_chunk(upload_uri, b"abcdef", 0)
+        self.app.delete(upload_uri, headers=self.headers, status=204)
+        self.app.get(upload_uri, headers=self.headers, status=404)
+
+    def test_unknown_session_returns_404(self):
+        self.app.get(self.uploads_uri + "/unknown", headers=self.headers, status=404)
+
+    def test_session_is_bound_to_its_record(self):
+        session, _ = self.start_upload()
+        other_uri = self.get_record_uri("fennec", "fonts", "other") + "/attachment/uploads/"
+        self.app.get(other_uri + session["id"], headers=self.headers, status=404)
+
+    def test_expired_session_returns_404(self):
+        _, upload_uri = self.start_upload()
+        self.put_chunk(upload_uri, b"abcdef", 0)
+        with mock.patch("kinto_attachment.uploads.time.time", return_value=time.time() + 10**6):
+            self.app.get(upload_uri, headers=self.headers, status=404)
+
+    def test_expired_sessions_are_purged_on_creation(self):
+        session, _ = self.start_upload()
+        with mock.patch("kinto_attachment.uploads.time.time", return_value=time.time() + 10**6):
+            with mock.patch.object(self.backend, "discard_staged") as mocked:
+                self.create_upload()
+        mocked.assert_called_with(session["id"])
+
+    def test_filename_is_required(self):
+        resp = self.create_upload(body={"size": 1}, status=400)
+        self.assertEqual(resp.json["errno"], ERRORS.MISSING_PARAMETERS.value)
+
+    def test_size_must_be_a_positive_integer(self):
+        self.create_upload(body={"filename": "font.jpg", "size": -1}, status=400)
+
+    def test_body_must_be_valid_json(self):
+        headers = {**self.headers, "Content-Type": "application/json"}
+        self.app.post(self.uploads_uri, "{'bad", headers=headers, status=400)
+
+    def test_body_must_be_an_object(self):
+        self.create_upload(body=[], status=400)
+
+    def test_session_creation_requires_permission(self):
+        self.headers.update(get_user_headers("jean-louis"))
+        self.create_upload(status=403)
+
+    def test_sessions_are_not_readable_with_read_permission(self):
+        _, upload_uri = self.start_upload()
+        self.app.patch_json(
+            "/buckets/fennec/collections/fonts",
+            {"permissions": {"read": ["system.Authenticated"]}},
+            headers=self.headers,
+        )
+        self.headers.update(get_user_headers("jean-louis"))
+        self.app.get(upload_uri, headers=self.headers, status=403)
+
+
+class LocalResumableUploadTest(ResumableUploadTest, BaseWebTestLocal, unittest.TestCase):
+    pass
+
+
+class GCloudResumableUploadTest(ResumableUploadTest, BaseWebTestGCloud, unittest.TestCase):
+    def upload_chunks(self):
+        _, upload_uri = self.start_upload()
+        self.put_chunk(upload_uri, b"abcdef", 0, total=12)
+        self.put_chunk(upload_uri, b"ghijkl", 6, total=12)
+        return upload_uri
+
+    def test_chunks_are_composed_and_hashed_from_the_stored_object(self):
+        upload_uri = self.upload_chunks()
+        with mock.patch.object(self.backend, "open_staged") as open_staged:
+            attachment = self.finalize(upload_uri).json
+        self.assertFalse(open_staged.called)
+        self.assertEqual(attachment["hash"], sha256(b"abcdefghijkl"))
+        self.assertEqual(attachment["size"], 12)
+        stored = self.backend.read(attachment["location"].replace(self.base_url, ""))
+        self.assertEqual(stored, b"abcdefghijkl")
+        self.assertEqual(self.backend.get_bucket().list_blobs(prefix="uploads-staging/"), [])
+
+    def test_hash_is_the_one_of_the_composed_object(self):
+        upload_uri = self.upload_chunks()
+        # Changed behind the back of the session.
+        staged = self.backend.get_bucket().list_blobs(prefix="uploads-staging/")[-1]
+        staged.data = b"GHIJKL"
+        attachment = self.finalize(upload_uri).json
+        self.assertEqual(attachment["hash"], sha256(b"abcdefGHIJKL"))
+
+    def test_composed_chunks_are_deduplicated(self):
+        self.update_settings(deduplicate="true")
+        attachment = self.finalize(self.upload_chunks()).json
+        self.assertIn(sha256(b"abcdefghijkl"), attachment["location"])
+
+    def test_chunks_are_read_to_be_compressed(self):
+        self.update_settings(compress="gzip")
+        upload_uri = self.upload_chunks()
+        with mock.patch.object(self.backend, "open_staged", wraps=self.backend.open_staged) as m:
+            attachment = self.finalize(upload_uri).json
+        self.assertTrue(m.called)
+        self.assertEqual(attachment["hash"], sha256(b"abcdefghijkl"))
+
+
+class ResumableUploadSizeLimitTest(BaseWebTestLocal, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.update_settings(max_size_bytes="10")
+        self.uploads_uri = self.endpoint_uri + "/uploads"
+
+    def test_declared_size_is_checked_on_creation(self):
+        body = {"filename": "font.jpg", "size": 11}
+        resp = self.app.post_json(self.uploads_uri, body, headers=self.headers, status=413)
+        self.assertEqual(resp.json["errno"], ERRORS.REQUEST_TOO_LARGE.value)
+
+    def test_chunks_are_checked_against_limit(self):
+        body = {"filename": "font.jpg"}
+        session = self.app.post_json(self.uploads_uri, body, headers=self.headers).json
+        headers = {
+            **self.headers,
+            "Content-Type": "application/octet-stream",
+            "Content-Range": "bytes 0-10/*",
+        }
+        upload_uri = "{}/{}".format(self.uploads_uri, session["id"])
+        self.app.put(upload_uri, b"x" * 11, headers=headers, status=413)
+
+
+class DirectUploadTest(BaseWebTestGCloud, unittest.TestCase):
+    content = b"--direct-upload--"
+
+    def setUp(self):
+        super().setUp()
+        self.uploads_uri = self.endpoint_uri + "/uploads"
+
+    def create_direct_upload(self, content=None, status=201, **extra):
+        content = content if content is not None else self.content
+        body = {
+            "filename": "font.jpg",
+            "mimetype": "image/jpeg",
+            "direct": True,
+            "size": len(content),
+            "hash": sha256(content),
+            "md5": base64.b64encode(hashlib.md5(content).digest()).decode(),
+            **extra,
+        }
+        return self.app.post_json(self.uploads_uri, body, headers=self.headers, status=status)
+
+    def upload_to_signed_url(self, session, content=None):
+        # Simulate the client sending the file to GCS.
+        content = content if content is not None else self.content
+        name = "uploads-staging/{}/{:020d}".format(session["id"], 0)
+        _FakeGCSBlob(name, self.backend.get_bucket()).upload_from_file(io.BytesIO(content))
+        return name
+
+    def test_signed_url_is_returned(self):
+        session = self.create_direct_upload().json
+        self.assertTrue(session["direct"])
+        self.assertIn(session["id"], session["upload_url"])
+        self.assertEqual(
+            session["upload_headers"]["x-goog-content-length-range"],
+            "{0},{0}".format(len(self.content)),
+        )
+
+    def test_finalize_moves_object_into_place(self):
+        session = self.create_direct_upload().json
+        staged_name = self.upload_to_signed_url(session)
+        upload_uri = "{}/{}".format(self.uploads_uri, session["id"])
+        attachment = self.app.post_json(upload_uri, {}, headers=self.headers, status=201).json
+        self.assertEqual(attachment["hash"], sha256(self.content))
+        self.assertEqual(attachment["size"], len(self.content))
+        self.assertTrue(self.backend.exists(attachment["location"].replace(self.base_url, "")))
+        self.assertFalse(self.backend.exists(staged_name))
+
+        resp = self.app.get(self.record_uri, headers=self.headers)
+        self.assertEqual(resp.json["data"]["attachment"], attachment)
+
+    def test_finalize_fails_if_uploaded_file_does_not_match_the_declared_hash(self):
+        self.update_settings(deduplicate="true")
+        victim = b"--victim-file--"
+        # Evil bytes, declared with the hash of the victim file.
+        session = self.create_direct_upload(hash=sha256(victim)).json
+        self.upload_to_signed_url(session)
+        upload_uri = "{}/{}".format(self.uploads_uri, session["id"])
+        resp = self.app.post_json(upload_uri, {}, headers=self.headers, status=400)
+        self.assertIn("does not match the declared hash", resp.json["message"])
+        self.app.get(self.record_uri, headers=self.headers, status=404)
+
+    def test_direct_uploads_are_not_deduplicated(self):
+        self.update_settings(deduplicate="true")
+        session = self.create_direct_upload().json
+        self.upload_to_signed_url(session)
+        upload_uri = "{}/{}".format(self.uploads_uri, session["id"])
+        attachment = self.app.post_json(upload_uri, {}, headers=self.headers, status=201).json
+        self.assertNotIn(sha256(self.content), attachment["location"])
+
+    def test_finalize_fails_if_file_was_not_uploaded(self):
+        session = self.create_direct_upload().json
+        upload_uri = "{}/{}".format(self.uploads_uri, session["id"])
+        resp = self.app.post_json(upload_uri, {}, headers=self.headers, status=400)
+        self.assertIn("File was not uploaded", resp.json["message"])
+
+    def test_finalize_fails_if_uploaded_file_does_not_match(self):
+        session = self.create_direct_upload().json
+        self.upload_to_signed_url(session, content=b"--something-else--")
+        upload_uri = "{}/{}".format(self.uploads_uri, session["id"])
+        resp = self.app.post_json(upload_uri, {}, headers=self.headers, status=400)
+        self.assertIn("does not match", resp.json["message"])
+
+    def test_chunks_cannot_be_sent_to_direct_uploads(self):
+        session = self.create_direct_upload().json
+        headers = {**self.headers, "Content-Range": "bytes 0-2/*"}
+        upload_uri = "{}/{}".format(self.uploads_uri, session["id"])
+        self.app.put(upload_uri, b"abc", headers=headers, status=400)
+
+    def test_size_hash_and_md5_are_required(self):
+        self.create_direct_upload(size=None, status=400)
+        self.create_direct_upload(hash="abc", status=400)
+        self.create_direct_upload(md5="abc", status=400)
+
+    def test_direct_upload_requires_permission(self):
+        self.headers.update(get_user_headers("jean-louis"))
+        self.create_direct_upload(status=403)
+
+
+class DirectUploadLocalTest(BaseWebTestLocal, unittest.TestCase):
+    def test_direct_uploads_are_not_supported(self):
+        body = {"filename": "font.jpg", "direct": True, "size": 1}
+        uploads_uri = self.endpoint_uri + "/uploads"
+        resp = self.app.post_json(uploads_uri, body, headers=self.headers, status=400)
+        self.assertIn("not supported", resp.json["message"])
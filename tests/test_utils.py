@@ -1,6 +1,18 @@
+import io
 import unittest
+from unittest import mock
 
-from kinto_attachment.utils import _extension_allowed, resolve_extensions
+from kinto_attachment.utils import (
+    FileTooLarge,
+    LimitedBodyReader,
+    RequestBodyTooLarge,
+    _extension_allowed,
+    compile_policies,
+    get_policy,
+    hash_and_size,
+    resolve_extensions,
+    sha256,
+)
 
 
 class TestResolveExtensions(unittest.TestCase):
@@ -32,6 +44,111 @@ class TestExtensionAllowed(unittest.TestCase):
         self.assertTrue(_extension_allowed("virus.exe", set()))
 
 
+class TestHashAndSize(unittest.TestCase):
+    def test_returns_hash_and_size(self):
+        content = b"x" * 1000
+        self.assertEqual(hash_and_size(io.BytesIO(content)), (sha256(content), 1000))
+
+    def test_reads_in_chunks(self):
+        content = b"abcdefghij" * 10
+        result = hash_and_size(io.BytesIO(content), chunk_size=7)
+        self.assertEqual(result, (sha256(content), 100))
+
+    def test_file_is_rewound(self):
+        f = io.BytesIO(b"data")
+        f.read()
+        hash_and_size(f)
+        self.assertEqual(f.tell(), 0)
+
+    def test_raises_as_soon_as_limit_is_crossed(self):
+        f = io.BytesIO(b"x" * 100)
+        with self.assertRaises(FileTooLarge) as cm:
+            hash_and_size(f, max_size=10, chunk_size=16)
+        self.assertEqual(cm.exception.size, 16)
+        self.assertEqual(cm.exception.max_size, 10)
+        self.assertEqual(f.tell(), 16)
+
+    def test_zero_max_size_means_no_limit(self):
+        self.assertEqual(hash_and_size(io.BytesIO(b"x" * 100), max_size=0)[1], 100)
+
+
+class TestLimitedBodyReader(unittest.TestCase):
+    def test_reads_are_passed_through_under_limit(self):
+        reader = LimitedBodyReader(io.BytesIO(b"abc\ndef"), limit=10)
+        self.assertEqual(reader.readline(), b"abc\n")
+        self.assertEqual(reader.read(), b"def")
+        self.assertEqual(reader.tell(), 7)
+
+    def test_raises_when_limit_is_crossed(self):
+        reader = LimitedBodyReader(io.BytesIO(b"abc\ndef"), limit=5)
+        reader.readline()
+        with self.assertRaises(RequestBodyTooLarge):
+            reader.read()
+
+    def test_seek_resets_consumed_bytes(self):
+        reader = LimitedBodyReader(io.BytesIO(b"abcdef"), limit=6)
+        reader.read()
+        reader.seek(0)
+        self.assertEqual(reader.read(), b"abcdef")
+
+
+class TestPolicies(unittest.TestCase):
+    def setUp(self):
+        settings = {
+            "attachment.randomize": "false",
+            "attachment.max_size_bytes": "10",
+            "attachment.extensions": "images+pdf",
+            "attachment.mimetypes": ".ftl:application/vnd.fluent",
+        }
+        resources = {
+            "/buckets/blog/collections/articles": {"keep_old_files": True},
+            "/buckets/blog": {"max_size_bytes": 0, "randomize": True},
+        }
+        self.policies = compile_policies(settings, resources)
+
+    def policy(self, **matchdict):
+        request = mock.Mock(matchdict=matchdict)
+        request.registry.attachment_policies = self.policies
+        return get_policy(request)
+
+    def test_global_settings_are_parsed(self):
+        policy = self.policy()
+        self.assertFalse(policy.randomize)
+        self.assertEqual(policy.max_size_bytes, 10)
+        self.assertIn("pdf", policy.extensions)
+        self.assertIsInstance(policy.extensions, frozenset)
+        self.assertEqual(policy.mimetypes[".ftl"], "application/vnd.fluent")
+        self.assertEqual(policy.mimetypes[".pem"], "application/x-pem-file")
+
+    def test_defaults_are_used_without_settings(self):
+        policy = compile_policies({}, {})[(None, None)]
+        self.assertTrue(policy.randomize)
+        self.assertEqual(policy.max_size_bytes, 0)
+        self.assertIsNone(policy.filename_pattern)
+        self.assertIn("json", policy.extensions)
+
+    def test_unknown_resources_fallback_to_global(self):
+        self.assertIs(self.policy(bucket_id="other", collection_id="c"), self.policies[None, None])
+
+    def test_collections_fallback_to_their_bucket(self):
+        policy = self.policy(bucket_id="blog", collection_id="comments")
+        self.assertEqual(policy.max_size_bytes, 0)
+        self.assertFalse(policy.keep_old_files)
+
+    def test_collections_inherit_bucket_overrides(self):
+        policy = self.policy(bucket_id="blog", collection_id="articles")
+        self.assertTrue(policy.keep_old_files)
+        self.assertTrue(policy.randomize)
+        self.assertEqual(policy.max_size_bytes, 0)
+        self.assertIn("pdf", policy.extensions)
+
+    def test_policies_are_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.policy().randomize = True
+        with self.assertRaises(TypeError):
+            self.policy().mimetypes[".ftl"] = "text/plain"
+
+
 class _Registry(object):
     settings = {"attachment.folder": ""}
     attachment_resources = {}
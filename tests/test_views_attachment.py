@@ -1,11 +1,20 @@
+import gzip
+import io
 import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import uuid
 from unittest import mock
 from urllib.parse import urlparse
 
 from kinto.core.errors import ERRORS
+from kinto.core.resource.model import Model
 
+from kinto_attachment import utils
 from kinto_attachment.storage import IFileStorage
 from kinto_attachment.utils import sha256
 
@@ -38,6 +47,7 @@ class UploadTest(object):
 
     def test_has_no_subfolder_if_setting_is_undefined(self):
         self.app.app.registry.settings.pop("attachment.folder")
+        self.update_settings()
         response = self.upload()
         record = self.get_record(response)
         url = urlparse(record["location"])
@@ -75,6 +85,16 @@ class LocalUploadTest(UploadTest, BaseWebTestLocal, unittest.TestCase):
         with open(file_path, "rb") as f:
             self.assertEqual(f.read(), b"--binary--")
 
+    def test_uploaded_files_are_spooled_in_spool_path(self):
+        spool_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_path)
+        self.backend.spool_path = spool_path
+        temporary_file = tempfile.TemporaryFile
+        with mock.patch("tempfile.TemporaryFile", side_effect=temporary_file) as spooled:
+            attachment = self.upload(files=[(self.file_field, "image.jpg", b"x" * 10000)]).json
+        self.assertEqual(attachment["size"], 10000)
+        self.assertEqual(spooled.call_args.kwargs["dir"], spool_path)
+
 
 class GCloudUploadTest(UploadTest, BaseWebTestGCloud, unittest.TestCase):
     pass
@@ -126,6 +146,33 @@ class DeleteTest(object):
         self.app.delete("/buckets/fennec/collections/fonts", headers=self.headers)
         self.assertFalse(self.exists(fullurl))
 
+    def test_collection_attachments_are_removed_in_batches(self):
+        self.update_settings(delete_batch_size="2")
+        locations = [self.attachment["location"]]
+        for _ in range(4):
+            self.endpoint_uri = self.get_record_uri("fennec", "fonts", str(uuid.uuid4()))
+            self.endpoint_uri += "/attachment"
+            locations.append(self.upload().json["location"])
+        with mock.patch.object(
+            self.backend, "delete_many", wraps=self.backend.delete_many
+        ) as mocked:
+            self.app.delete("/buckets/fennec/collections/fonts", headers=self.headers)
+        self.assertEqual([len(c.args[0]) for c in mocked.call_args_list], [2, 2, 1])
+        self.assertFalse(any(self.exists(location) for location in locations))
+        links = self.app.app.registry.storage.list_all("attachments", "__attachments__")
+        self.assertEqual(links, [])
+
+    def test_collection_is_deleted_if_some_files_are_already_gone(self):
+        missing = self.attachment["location"]
+        self.endpoint_uri = self.get_record_uri("fennec", "fonts", str(uuid.uuid4()))
+        self.endpoint_uri += "/attachment"
+        other = self.upload().json["location"]
+        self.backend.delete(missing.replace(self.base_url, ""))
+        self.app.delete("/buckets/fennec/collections/fonts", headers=self.headers, status=200)
+        self.assertFalse(self.exists(other))
+        links = self.app.app.registry.storage.list_all("attachments", "__attachments__")
+        self.assertEqual(links, [])
+
     def test_attachments_links_are_removed_forever(self):
         storage = self.app.app.registry.storage
         links = storage.list_all("attachments", "__attachments__")
@@ -148,9 +195,286 @@ class GCloudDeleteTest(DeleteTest, BaseWebTestGCloud, unittest.TestCase):
     pass
 
 
+class DeduplicateTest(object):
+    def setUp(self):
+        super().setUp()
+        self.update_settings(deduplicate="true")
+        self.other_record_uri = self.get_record_uri("fennec", "fonts", str(uuid.uuid4()))
+
+    def exists(self, fullurl):
+        location = fullurl.replace(self.base_url, "")
+        return self.backend.exists(location)
+
+    def upload_to_other_record(self, **kwargs):
+        endpoint_uri = self.endpoint_uri
+        self.endpoint_uri = self.other_record_uri + "/attachment"
+        try:
+            return self.upload(**kwargs)
+        finally:
+            self.endpoint_uri = endpoint_uri
+
+    def test_location_is_derived_from_content_hash(self):
+        attachment = self.upload().json
+        self.assertTrue(attachment["location"].endswith(attachment["hash"] + ".jpg"))
+        self.assertIn("fennec/fonts/", attachment["location"])
+
+    def test_identical_uploads_share_the_same_file(self):
+        first = self.upload().json
+        with mock.patch.object(self.backend, "save", wraps=self.backend.save) as mocked:
+            second = self.upload_to_other_record().json
+        self.assertEqual(first["location"], second["location"])
+        self.assertFalse(mocked.called)
+
+    def test_identical_uploads_share_the_same_file_with_hash_key_layout(self):
+        with mock.patch.object(self.backend, "key_levels", 2):
+            first = self.upload().json
+            with mock.patch.object(self.backend, "save", wraps=self.backend.save) as mocked:
+                second = self.upload_to_other_record().json
+        self.assertEqual(first["location"], second["location"])
+        self.assertRegex(first["location"], r"fennec/fonts/\w\w/\w\w/%s\.jpg$" % first["hash"])
+        self.assertFalse(mocked.called)
+
+    def test_different_uploads_are_stored_separately(self):
+        first = self.upload().json
+        second = self.upload_to_other_record(files=[(self.file_field, "a.jpg", b"--other--")])
+        self.assertNotEqual(first["location"], second.json["location"])
+
+    def test_links_carry_the_content_hash(self):
+        attachment = self.upload().json
+        links = self.app.app.registry.storage.list_all("attachments", "__attachments__")
+        self.assertEqual(links[0]["content_hash"], attachment["hash"])
+
+    def test_file_is_kept_while_referenced(self):
+        attachment = self.upload().json
+        self.upload_to_other_record()
+        self.app.delete(self.record_uri, headers=self.headers)
+        self.assertTrue(self.exists(attachment["location"]))
+        self.app.delete(self.other_record_uri, headers=self.headers)
+        self.assertFalse(self.exists(attachment["location"]))
+
+    def test_file_is_kept_when_other_attachment_is_replaced(self):
+        attachment = self.upload().json
+        self.upload_to_other_record()
+        self.upload_to_other_record(files=[(self.file_field, "a.jpg", b"--other--")])
+        self.assertTrue(self.exists(attachment["location"]))
+
+    def test_shared_file_is_removed_when_collection_is_deleted(self):
+        attachment = self.upload().json
+        self.upload_to_other_record()
+        self.app.delete("/buckets/fennec/collections/fonts", headers=self.headers)
+        self.assertFalse(self.exists(attachment["location"]))
+
+    def test_shared_files_are_reused_under_the_lock_of_their_hash(self):
+        attachment = self.upload().json
+        links = self.app.app.registry.attachment_links
+        manager = mock.Mock()
+        with mock.patch.object(links, "lock", manager.lock):
+            with mock.patch.object(self.backend, "exists", manager.exists):
+                self.upload_to_other_record()
+        self.assertEqual([name for name, _, _ in manager.mock_calls][:2], ["lock", "exists"])
+        manager.lock.assert_called_with(attachment["hash"])
+
+    def test_shared_files_are_counted_under_the_lock_of_their_hash(self):
+        attachment = self.upload().json
+        links = self.app.app.registry.attachment_links
+        manager = mock.Mock()
+        manager.count.return_value = 0
+        with mock.patch.object(links, "lock", manager.lock):
+            with mock.patch.object(links, "count", manager.count):
+                self.app.delete(self.record_uri, headers=self.headers)
+        self.assertEqual([name for name, _, _ in manager.mock_calls], ["lock", "count"])
+        manager.lock.assert_called_with(attachment["hash"])
+
+    def test_heartbeat_files_are_not_deduplicated(self):
+        with mock.patch.object(self.backend, "save", wraps=self.backend.save) as mocked:
+            self.app.get("/__heartbeat__")
+        self.assertNotIn("filename", mocked.call_args.kwargs)
+
+
+class LocalDeduplicateTest(DeduplicateTest, BaseWebTestLocal, unittest.TestCase):
+    pass
+
+
+class GCloudDeduplicateTest(DeduplicateTest, BaseWebTestGCloud, unittest.TestCase):
+    pass
+
+
+class CompressTest(object):
+    content = b'{"key": "value"}' * 100
+
+    def setUp(self):
+        super().setUp()
+        self.update_settings(compress="gzip")
+
+    def upload_json(self, content=None):
+        files = [(self.file_field, "data.json", content or self.content)]
+        return self.upload(files=files).json
+
+    def other_endpoint_uri(self):
+        return self.get_record_uri("fennec", "fonts", str(uuid.uuid4())) + "/attachment"
+
+    def test_attachment_describes_uncompressed_and_compressed_content(self):
+        attachment = self.upload_json()
+        self.assertEqual(attachment["hash"], sha256(self.content))
+        self.assertEqual(attachment["size"], 1600)
+        self.assertEqual(attachment["mimetype"], "application/json")
+        compressed = attachment["compressed"]
+        self.assertEqual(compressed["content_encoding"], "gzip")
+        self.assertLess(compressed["size"], 1600)
+        self.assertEqual(gzip.decompress(self.stored_variant(attachment)), self.content)
+        self.assertNotIn("original", attachment)
+
+    def test_incompressible_types_are_stored_raw(self):
+        attachment = self.upload().json
+        self.assertNotIn("compressed", attachment)
+
+    def test_files_are_stored_raw_if_compression_does_not_help(self):
+        attachment = self.upload_json(b"{}")
+        self.assertEqual(attachment["size"], 2)
+        self.assertNotIn("compressed", attachment)
+
+    def test_deduplicated_files_are_addressed_by_encoding(self):
+        self.update_settings(deduplicate="true", compress="")
+        raw = self.upload_json()
+        self.update_settings(compress="gzip")
+        self.endpoint_uri = self.other_endpoint_uri()
+        compressed = self.upload_json()
+        self.assertNotEqual(raw["location"], compressed["location"])
+        self.assertTrue(compressed["location"].endswith(sha256(self.content) + "-gzip.json"))
+        self.assertEqual(gzip.decompress(self.stored_variant(compressed)), self.content)
+
+        # And the other way around.
+        self.update_settings(compress="")
+        self.endpoint_uri = self.other_endpoint_uri()
+        again = self.upload_json()
+        self.assertEqual(again["location"], raw["location"])
+        self.assertNotIn("compressed", again)
+        stored = self.backend.read(again["location"].replace(self.base_url, ""))
+        self.assertEqual(stored, self.content)
+
+
+class LocalCompressTest(CompressTest, BaseWebTestLocal, unittest.TestCase):
+    def stored_variant(self, attachment):
+        path = self.backend.path(attachment["location"].replace(self.base_url, ""))
+        # The file itself is kept for clients without gzip support.
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        compressed = attachment["compressed"]
+        self.assertEqual(compressed["location"], attachment["location"] + ".gz")
+        with open(path + ".gz", "rb") as f:
+            content = f.read()
+        self.assertEqual(sha256(content), compressed["hash"])
+        return content
+
+    def test_compressed_variant_is_deleted_with_the_file(self):
+        attachment = self.upload_json()
+        path = self.backend.path(attachment["location"].replace(self.base_url, ""))
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + ".gz"))
+
+    def test_compressed_variant_is_linked_to_the_record(self):
+        attachment = self.upload_json()
+        links = self.app.app.registry.attachment_links.list("record_uri", [self.record_uri])
+        locations = sorted(link["location"] for link in links)
+        location = attachment["location"].replace(self.base_url, "")
+        self.assertEqual(locations, [location, location + ".gz"])
+
+    def test_shared_compressed_variant_is_kept_while_referenced(self):
+        self.update_settings(compress="gzip", deduplicate="true")
+        attachment = self.upload_json()
+        self.endpoint_uri = self.other_endpoint_uri()
+        self.upload_json()
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        path = self.backend.path(attachment["location"].replace(self.base_url, ""))
+        self.assertTrue(os.path.exists(path + ".gz"))
+
+
+class GCloudCompressTest(CompressTest, BaseWebTestGCloud, unittest.TestCase):
+    def stored_variant(self, attachment):
+        # Stored in place, and decompressed for clients without gzip support.
+        compressed = attachment["compressed"]
+        self.assertEqual(compressed["location"], attachment["location"])
+        blob = self.backend.get_bucket().get_blob(
+            attachment["location"].replace(self.base_url, "")
+        )
+        self.assertEqual(blob.content_encoding, "gzip")
+        self.assertEqual(blob.content_type, "application/json")
+        self.assertEqual(sha256(blob.data), compressed["hash"])
+        return blob.data
+
+
+class DeltaTest(object):
+    first = b"first version" * 10
+    second = b"second version" * 10
+
+    def setUp(self):
+        super().setUp()
+        # Stand-in for the diff script: writes the first bytes of the previous version.
+        code = "import sys; sys.stdout.buffer.write(b'patch:' + sys.stdin.buffer.read()[8:13])"
+        patcher = mock.patch(
+            "kinto_attachment.deltas._command", return_value=[sys.executable, "-c", code]
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.update_settings(deltas="bsdiff")
+
+    def upload_version(self, content, filename="data.txt"):
+        return self.upload(files=[(self.file_field, filename, content)]).json
+
+    def test_first_upload_has_no_delta(self):
+        self.assertNotIn("delta", self.upload_version(self.first))
+
+    def test_replacement_has_a_delta_from_the_previous_version(self):
+        first = self.upload_version(self.first)
+        second = self.upload_version(self.second)
+        delta = second["delta"]
+        self.assertEqual(delta["algorithm"], "bsdiff")
+        self.assertEqual(delta["from_hash"], first["hash"])
+        self.assertEqual(delta["hash"], sha256(b"patch:first"))
+        self.assertEqual(delta["size"], 11)
+        self.assertTrue(delta["location"].endswith(".bsdiff"))
+        self.assertEqual(self.read_stored(delta["location"]), b"patch:first")
+        record = self.app.get(self.record_uri, headers=self.headers).json["data"]
+        self.assertEqual(record[self.file_field]["delta"], delta)
+
+    def test_delta_is_deleted_with_the_record(self):
+        self.upload_version(self.first)
+        location = self.upload_version(self.second)["delta"]["location"]
+        self.app.delete(self.record_uri, headers=self.headers)
+        self.assertFalse(self.backend.exists(location.replace(self.base_url, "")))
+
+    def test_recomputed_patches_replace_the_kept_ones(self):
+        self.update_settings(deltas="bsdiff", keep_old_files="true")
+        self.upload_version(self.first)
+        location = self.upload_version(self.second)["delta"]["location"]
+        self.upload_version(self.first)
+        self.assertEqual(self.upload_version(self.second)["delta"]["location"], location)
+
+    def test_compressed_versions_are_skipped(self):
+        self.update_settings(deltas="bsdiff", compress="gzip")
+        self.upload_version(b'{"a": 1}' * 100, "data.json")
+        self.assertNotIn("delta", self.upload_version(self.second))
+
+    def test_deltas_are_disabled_by_default(self):
+        self.update_settings(deltas="")
+        self.upload_version(self.first)
+        self.assertNotIn("delta", self.upload_version(self.second))
+
+
+class LocalDeltaTest(DeltaTest, BaseWebTestLocal, unittest.TestCase):
+    def read_stored(self, location):
+        with open(self.backend.path(location.replace(self.base_url, "")), "rb") as f:
+            return f.read()
+
+
+class GCloudDeltaTest(DeltaTest, BaseWebTestGCloud, unittest.TestCase):
+    def read_stored(self, location):
+        return self.backend.read(location.replace(self.base_url, ""))
+
+
 class AttachmentViewTest(object):
     def test_only_post_and_options_is_accepted(self):
-        self.app.get(self.endpoint_uri, headers=self.headers, status=405)
         self.app.put(self.endpoint_uri, headers=self.headers, status=405)
         self.app.patch(self.endpoint_uri, headers=self.headers, status=405)
         headers = self.headers.copy()
@@ -377,6 +701,14 @@ class PerResourceConfigAttachementViewTest(BaseWebTestGCloud, unittest.TestCase)
         self.assertEqual(r.json["filename"], "image.jpg")
         self.assertIn(r.json["filename"], r.json["location"])
 
+    def test_files_are_compressed_in_fennec_experiments_collection(self):
+        self.create_collection("fennec", "experiments")
+        record_uri = self.get_record_uri("fennec", "experiments", str(uuid.uuid4()))
+        self.endpoint_uri = record_uri + "/attachment"
+        r = self.upload(files=[(self.file_field, "data.json", b"[1, 1, 1, 1, 1, 1, 1, 1]" * 10)])
+
+        self.assertEqual(r.json["compressed"]["content_encoding"], "gzip")
+
 
 class OverridenMimetypesTest(BaseWebTestGCloud, unittest.TestCase):
     def test_file_mimetype_comes_from_config(self):
@@ -389,6 +721,164 @@ class SingleAttachmentViewTest(AttachmentViewTest, BaseWebTestLocal, unittest.Te
     pass
 
 
+class DownloadTest(object):
+    def setUp(self):
+        super().setUp()
+        self.attachment = self.upload().json
+        self.relative = self.attachment["location"].replace(self.base_url, "")
+
+    def test_download_redirects_to_the_file_location(self):
+        resp = self.app.get(self.endpoint_uri, headers=self.headers, status=307)
+        self.assertEqual(resp.headers["Location"], self.attachment["location"])
+        self.assertEqual(resp.headers["ETag"], '"%s"' % self.attachment["hash"])
+        self.assertEqual(resp.body, b"")
+
+    def test_head_has_the_same_headers(self):
+        resp = self.app.head(self.endpoint_uri, headers=self.headers, status=307)
+        self.assertEqual(resp.headers["Location"], self.attachment["location"])
+        self.assertEqual(resp.headers["ETag"], '"%s"' % self.attachment["hash"])
+
+    def test_matching_etag_returns_304(self):
+        headers = {**self.headers, "If-None-Match": '"%s"' % self.attachment["hash"]}
+        resp = self.app.get(self.endpoint_uri, headers=headers, status=304)
+        self.assertNotIn("Location", resp.headers)
+        self.assertEqual(resp.headers["ETag"], '"%s"' % self.attachment["hash"])
+
+    def test_other_etags_are_delivered(self):
+        headers = {**self.headers, "If-None-Match": '"abc"'}
+        self.app.get(self.endpoint_uri, headers=headers, status=307)
+
+    def test_etag_is_weak_if_the_file_is_served_compressed(self):
+        self.assertNotIn("Vary", self.app.get(self.endpoint_uri, headers=self.headers).headers)
+        self.update_settings(compress="gzip")
+        attachment = self.upload(files=[(self.file_field, "data.json", b"[1, 1]" * 100)]).json
+        self.assertIn("compressed", attachment)
+        resp = self.app.get(self.endpoint_uri, headers=self.headers, status=307)
+        # The same for the uncompressed and compressed contents.
+        self.assertEqual(resp.headers["ETag"], 'W/"%s"' % attachment["hash"])
+        self.assertEqual(resp.headers["Vary"], "Accept-Encoding")
+        headers = {**self.headers, "If-None-Match": resp.headers["ETag"]}
+        resp = self.app.get(self.endpoint_uri, headers=headers, status=304)
+        self.assertEqual(resp.headers["Vary"], "Accept-Encoding")
+
+    def test_files_stored_under_a_previous_base_url_are_redirected_to(self):
+        with mock.patch.object(self.backend, "base_url", "https://new.cdn/"):
+            resp = self.app.get(self.endpoint_uri, headers=self.headers, status=307)
+        self.assertEqual(resp.headers["Location"], self.attachment["location"])
+
+    def test_records_without_attachment_return_404(self):
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+        resp = self.app.get(self.endpoint_uri, headers=self.headers, status=404)
+        self.assertEqual(resp.json["errno"], ERRORS.MISSING_RESOURCE.value)
+
+    def test_unknown_records_return_404(self):
+        endpoint = self.get_record_uri("fennec", "fonts", str(uuid.uuid4())) + "/attachment"
+        self.app.get(endpoint, headers=self.headers, status=404)
+
+    def test_download_requires_read_permission(self):
+        self.app.get(self.endpoint_uri, headers=get_user_headers("jean-louis"), status=403)
+        self.app.get(self.endpoint_uri, status=401)
+
+    def test_download_is_allowed_with_inherited_read_permission(self):
+        perm = {"permissions": {"read": ["system.Everyone"]}}
+        self.app.patch_json("/buckets/fennec", perm, headers=self.headers)
+        self.app.get(self.endpoint_uri, status=307)
+
+
+class LocalDownloadTest(DownloadTest, BaseWebTestLocal, unittest.TestCase):
+    def test_files_are_delivered_by_nginx_with_accel_redirect(self):
+        with mock.patch.object(self.backend, "accel_redirect", "/protected/"):
+            resp = self.app.get(self.endpoint_uri, headers=self.headers, status=200)
+        self.assertEqual(resp.headers["X-Accel-Redirect"], "/protected/" + self.relative)
+        self.assertEqual(resp.headers["Content-Type"], "image/jpeg")
+        self.assertEqual(resp.headers["Accept-Ranges"], "bytes")
+        self.assertEqual(resp.body, b"")
+
+    def test_files_are_delivered_with_sendfile(self):
+        with mock.patch.object(self.backend, "sendfile", True):
+            resp = self.app.get(self.endpoint_uri, headers=self.headers, status=200)
+        self.assertEqual(resp.headers["X-Sendfile"], self.backend.path(self.relative))
+
+
+class GCloudDownloadTest(DownloadTest, BaseWebTestGCloud, unittest.TestCase):
+    def test_downloads_are_redirected_to_signed_urls(self):
+        with mock.patch.object(self.backend, "signed_url_expires", 60):
+            resp = self.app.get(self.endpoint_uri, headers=self.headers, status=307)
+        self.assertEqual(
+            resp.headers["Location"], "https://storage.googleapis.com/signed/" + self.relative
+        )
+
+
+class RecordUpdateTest(BaseWebTestLocal, unittest.TestCase):
+    def record_reads(self, method, *args, **kwargs):
+        get_object = Model.get_object
+        with mock.patch.object(Model, "get_object", autospec=True, side_effect=get_object) as m:
+            method(*args, **kwargs)
+        return [c for c in m.call_args_list if c.args[0].resource_name == "record"]
+
+    def test_record_is_read_once_on_creation(self):
+        self.assertEqual(len(self.record_reads(self.upload, status=201)), 1)
+
+    def test_record_is_read_once_on_update(self):
+        self.upload()
+        self.assertEqual(len(self.record_reads(self.upload, status=200)), 1)
+
+    def test_record_is_not_read_again_by_the_update(self):
+        self.upload()
+        storage = self.app.app.registry.storage
+        with mock.patch.object(storage, "get", wraps=storage.get) as get:
+            self.upload()
+        reads = [c for c in get.call_args_list if "record" in (c.args[:1] or c.kwargs.values())]
+        self.assertEqual(len(reads), 1)
+
+    def test_record_is_read_once_on_delete(self):
+        self.upload()
+        reads = self.record_reads(self.app.delete, self.endpoint_uri, headers=self.headers)
+        self.assertEqual(len(reads), 1)
+
+    def test_record_created_meanwhile_returns_412(self):
+        def create_record(*args, **kwargs):
+            self.app.app.registry.storage.create(
+                "record", "/buckets/fennec/collections/fonts", {"id": self.record_id}
+            )
+
+        with mock.patch("kinto_attachment.utils.delete_attachment", side_effect=create_record):
+            resp = self.upload(status=412)
+        self.assertEqual(resp.json["errno"], ERRORS.MODIFIED_MEANWHILE.value)
+
+    def test_record_changed_meanwhile_returns_412(self):
+        self.upload()
+        # Changed or deleted since fetched (see ``tests/test_records.py``).
+        with mock.patch("kinto_attachment.utils.update_unmodified", return_value=None):
+            resp = self.upload(status=412)
+        self.assertEqual(resp.json["errno"], ERRORS.MODIFIED_MEANWHILE.value)
+
+    def test_invalid_record_id_returns_400(self):
+        self.endpoint_uri = self.get_record_uri("fennec", "fonts", "a.b") + "/attachment"
+        self.upload(status=400)
+
+    def test_unknown_collection_returns_404(self):
+        self.endpoint_uri = self.get_record_uri("fennec", "unknown", "abc") + "/attachment"
+        self.upload(status=404)
+
+    def test_invalid_schema_reference_returns_400(self):
+        schema = {"type": "object", "properties": {"family": {"$ref": "#/definitions/unknown"}}}
+        self.app.put_json(
+            "/buckets/fennec/collections/fonts", {"data": {"schema": schema}}, headers=self.headers
+        )
+        resp = self.upload(params=[("data", '{"family": "sans"}')], status=400)
+        self.assertEqual(resp.json["details"][0]["name"], "schema")
+
+    def test_schema_is_not_validated_if_only_attachment_changes(self):
+        self.upload()
+        schema = {"type": "object", "required": ["family"]}
+        self.app.put_json(
+            "/buckets/fennec/collections/fonts", {"data": {"schema": schema}}, headers=self.headers
+        )
+        self.upload(status=200)
+        self.upload(params=[("data", '{"author": "frank"}')], status=400)
+
+
 class DefaultBucketTest(BaseWebTestLocal, unittest.TestCase):
     def setUp(self):
         super(DefaultBucketTest, self).setUp()
@@ -451,6 +941,18 @@ class KeepOldFilesTest(BaseWebTestLocal, unittest.TestCase):
 
         self.assertTrue(self.backend.exists(location))
 
+    def test_links_are_removed_in_batches_when_collection_is_deleted(self):
+        self.update_settings(delete_batch_size="1")
+        location = self.upload(status=201).json["location"]
+        self.endpoint_uri = self.get_record_uri("fennec", "fonts", "abc") + "/attachment"
+        self.upload(status=201)
+
+        self.app.delete("/buckets/fennec/collections/fonts", headers=self.headers)
+
+        links = self.app.app.registry.storage.list_all("attachments", "__attachments__")
+        self.assertEqual(links, [])
+        self.assertTrue(self.backend.exists(location))
+
 
 class HeartbeartTest(BaseWebTestGCloud, unittest.TestCase):
     def test_attachments_is_added_to_heartbeat_view(self):
@@ -474,6 +976,76 @@ class HeartbeartTest(BaseWebTestGCloud, unittest.TestCase):
             resp = self.app.get("/__heartbeat__")
         self.assertTrue(resp.json["attachments"])
 
+    def test_heartbeat_result_is_cached_with_ttl(self):
+        self.update_settings(heartbeat_ttl="60")
+        with mock.patch.object(self.backend, "save", wraps=self.backend.save) as mocked:
+            self.app.get("/__heartbeat__")
+            self.app.get("/__heartbeat__")
+        self.assertEqual(mocked.call_count, 1)
+
+    def test_heartbeat_failure_is_cached_with_ttl(self):
+        self.update_settings(heartbeat_ttl="60")
+        with mock.patch.object(self.backend, "save", side_effect=ValueError):
+            self.app.get("/__heartbeat__", status=503)
+        resp = self.app.get("/__heartbeat__", status=503)
+        self.assertFalse(resp.json["attachments"])
+
+    def test_heartbeat_is_checked_again_when_ttl_expires(self):
+        self.update_settings(heartbeat_ttl="60")
+        with mock.patch.object(self.backend, "save", wraps=self.backend.save) as mocked:
+            with mock.patch("kinto_attachment.views.time.monotonic") as monotonic:
+                monotonic.return_value = 1000
+                self.app.get("/__heartbeat__")
+                monotonic.return_value = 1061
+                self.app.get("/__heartbeat__")
+        self.assertEqual(mocked.call_count, 2)
+
+    def test_concurrent_heartbeats_share_the_same_check(self):
+        from kinto_attachment import views
+
+        registry = self.app.app.registry
+        self.update_settings(heartbeat_ttl="60")
+        request = mock.Mock(registry=registry)
+
+        def slow_check(request):
+            time.sleep(0.05)
+            return True
+
+        with mock.patch("kinto_attachment.views.check_storage", side_effect=slow_check) as check:
+            threads = [
+                threading.Thread(target=views.attachments_ping, args=(request,)) for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(check.call_count, 1)
+
+    def test_probe_mode_does_not_write(self):
+        self.update_settings(heartbeat_mode="probe")
+        with mock.patch.object(self.backend, "save") as save:
+            with mock.patch.object(self.backend, "probe", wraps=self.backend.probe) as probe:
+                resp = self.app.get("/__heartbeat__")
+        self.assertTrue(resp.json["attachments"])
+        self.assertFalse(save.called)
+        self.assertTrue(probe.called)
+
+    def test_probe_mode_reports_failures(self):
+        self.update_settings(heartbeat_mode="probe")
+        with mock.patch.object(self.backend, "probe", side_effect=RuntimeError):
+            resp = self.app.get("/__heartbeat__", status=503)
+        self.assertFalse(resp.json["attachments"])
+
+    def test_probe_mode_writes_periodically(self):
+        self.update_settings(heartbeat_mode="probe", heartbeat_write_interval="300")
+        with mock.patch.object(self.backend, "save", wraps=self.backend.save) as save:
+            with mock.patch("kinto_attachment.views.time.monotonic") as monotonic:
+                for now in (1000, 1100, 1299, 1300):
+                    monotonic.return_value = now
+                    self.app.get("/__heartbeat__")
+        # First ping, and 300 seconds later.
+        self.assertEqual(save.call_count, 2)
+
 
 class MetricsTest(BaseWebTestGCloud, unittest.TestCase):
     def test_attachments_methods_are_monitored(self):
@@ -483,6 +1055,60 @@ class MetricsTest(BaseWebTestGCloud, unittest.TestCase):
 
         self.assertIn("backend_googlecloudstorage_seconds", resp.text)
 
+    def test_cascade_deletions_are_counted(self):
+        self.upload(status=201)
+        self.app.delete("/buckets/fennec/collections/fonts", headers=self.headers)
+
+        resp = self.app.get("/__metrics__")
+
+        self.assertIn("kinto_attachments_deleted_links_total", resp.text)
+        self.assertIn("kinto_attachments_deleted_files_total", resp.text)
+        self.assertIn(
+            'kinto_attachments_cascade_deleted_links_total{bucket_id="fennec",'
+            'collection_id="fonts",resource_name="collection"}',
+            resp.text,
+        )
+
+    def test_pipeline_phases_are_timed_per_collection(self):
+        self.upload(status=201)
+        self.app.delete(self.endpoint_uri, headers=self.headers, status=204)
+
+        resp = self.app.get("/__metrics__")
+
+        for phase in (
+            "parse",
+            "hash",
+            "backend",
+            "link",
+            "record",
+            "list_links",
+            "unlink",
+            "delete_files",
+        ):
+            self.assertIn(
+                'kinto_attachments_phase_seconds_count{bucket_id="fennec",'
+                'collection_id="fonts",phase="%s"}' % phase,
+                resp.text,
+            )
+
+    def test_uploaded_and_deleted_bytes_are_counted(self):
+        self.upload(status=201)
+        self.app.delete(self.record_uri, headers=self.headers)
+
+        resp = self.app.get("/__metrics__")
+
+        labels = '{bucket_id="fennec",collection_id="fonts"}'
+        for metric in ("uploaded_bytes_total", "deleted_bytes_total", "deleted_size_bytes_sum"):
+            self.assertIn("kinto_attachments_%s%s" % (metric, labels), resp.text)
+
+    def test_metrics_labels_of_parent_objects(self):
+        request = mock.MagicMock(matchdict={})
+        self.assertEqual(
+            utils.metric_labels(request, "/buckets/fennec"),
+            [("bucket_id", "fennec"), ("collection_id", "")],
+        )
+        self.assertEqual(utils.metric_labels(request), [("bucket_id", ""), ("collection_id", "")])
+
 
 def _make_app_with_settings(**extra_settings):
     import webtest
@@ -565,3 +1191,49 @@ class FileSizeLimitPerResourceTest(BaseWebTestLocal, unittest.TestCase):
             files=[(self.file_field, b"image.jpg", b"x" * 100)],
             status=201,
         )
+
+
+class RequestBodySizeLimitTest(BaseWebTestLocal, unittest.TestCase):
+    def make_app(self):
+        return _make_app_with_settings(
+            **{
+                "kinto.attachment.max_size_bytes": "10",
+                "kinto.attachment.max_size_overhead_bytes": "1000",
+                "kinto.attachment.resources.fennec.fonts.max_size_bytes": "100",
+            }
+        )
+
+    def test_upload_refused_from_content_length(self):
+        resp = self.upload(files=[(self.file_field, b"image.jpg", b"x" * 2000)], status=413)
+        self.assertEqual(resp.json["errno"], ERRORS.REQUEST_TOO_LARGE.value)
+        self.assertIn("(100 bytes)", resp.json["message"])
+
+    def test_existing_attachment_is_kept_when_refused(self):
+        attachment = self.upload(status=201).json
+        self.upload(files=[(self.file_field, b"image.jpg", b"x" * 2000)], status=413)
+        location = attachment["location"].replace(self.base_url, "")
+        self.assertTrue(self.backend.exists(location))
+
+    def test_body_reading_is_aborted_if_content_length_is_missing(self):
+        content_type, body = self.app.encode_multipart([], [("attachment", "a.jpg", b"x" * 2000)])
+        req = self.app.RequestClass.blank(
+            self.endpoint_uri,
+            method="POST",
+            headers={**self.headers, "Content-Type": content_type},
+        )
+        req.environ["wsgi.input"] = io.BytesIO(body)
+        req.environ["wsgi.input_terminated"] = True
+        req.environ.pop("CONTENT_LENGTH", None)
+        resp = self.app.do_request(req, status=413)
+        self.assertEqual(resp.json["errno"], ERRORS.REQUEST_TOO_LARGE.value)
+
+    def test_upload_under_body_limit_is_checked_against_file_size(self):
+        resp = self.upload(files=[(self.file_field, b"image.jpg", b"x" * 200)], status=400)
+        self.assertIn("exceeds the limit (100 bytes)", resp.json["message"])
+
+    def test_limit_is_resolved_from_bucket_and_collection(self):
+        self.create_collection("fennec", "other")
+        record_uri = self.get_record_uri("fennec", "other", str(uuid.uuid4()))
+        self.endpoint_uri = record_uri + "/attachment"
+        resp = self.upload(files=[(self.file_field, b"image.jpg", b"x" * 2000)], status=413)
+        self.assertIn("(10 bytes)", resp.json["message"])